@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import pytest
+import os
+import numpy as np
+import netCDF4 as nc
+
+pytest.importorskip('pytest_benchmark')
+
+import ic_stability_metric
+from ocean_ic import grids, output
+from ocean_ic.fill import NearestFiller
+from ocean_ic.vertical import VerticalInterpolator
+from ocean_ic.weights import generate_weights
+
+import synthetic
+
+"""
+Time and measure the peak memory of each stage of the IC pipeline on
+synthetic grids.
+
+Run from the top of the repository with:
+
+    python -m pytest benchmarks/
+
+Results are saved under benchmarks/.benchmarks and can be compared between
+runs with --benchmark-compare. The peak memory of each stage is stored in the
+extra_info of each result.
+"""
+
+class Stages(object):
+    """
+    The inputs to each pipeline stage for one source/destination pair.
+    """
+
+    def __init__(self, src_name, dest_name):
+
+        self.src_name = src_name
+        self.dest_name = dest_name
+
+        self.src_grid = synthetic.make_grid(src_name)
+        self.dest_grid = synthetic.make_grid(dest_name)
+        self.src_temp, self.src_salt = synthetic.make_fields(self.src_grid)
+
+        if src_name == 'GODAS':
+            self.global_src_grid, self.extent = \
+                grids.extend_to_poles(self.src_grid)
+        else:
+            self.global_src_grid, self.extent = self.src_grid, None
+
+        self.filler = NearestFiller(self.global_src_grid)
+        self.vertical = VerticalInterpolator(self.src_grid.levels,
+                                             self.dest_grid.levels)
+        self.weights = synthetic.bilinear_weights(self.global_src_grid,
+                                                  self.dest_grid)
+        self.dest_mask = self.dest_grid.mask_3d()
+
+        self.vert_temp = self.vertical(self.src_temp)
+        self.filled_temp = self.extend_and_fill(self.vert_temp)
+        self.regridded_temp = self.apply_weights(self.filled_temp)
+        self.dest_temp = self.apply_mask(self.regridded_temp)
+
+        filled_salt = self.extend_and_fill(self.vertical(self.src_salt))
+        self.dest_salt = self.apply_mask(self.apply_weights(filled_salt))
+
+    def extend_and_fill(self, data):
+        if self.extent is not None:
+            data = grids.extend_data(data, self.extent)
+        return self.filler(data)
+
+    def apply_weights(self, data):
+        dest = self.weights.apply_levels(data)
+        return dest.reshape(self.dest_grid.shape)
+
+    def apply_mask(self, data):
+        return np.ma.array(data, mask=self.dest_mask)
+
+    def mask_levels(self, data):
+        """
+        Mask each level and fill the land with the output fill value, as is
+        done when a level is written.
+        """
+
+        out = np.empty(data.shape, dtype=data.dtype)
+        for k in range(data.shape[0]):
+            level = np.ma.array(data[k], mask=self.dest_mask[k])
+            out[k] = level.filled(-1.e20)
+        return out
+
+    def write(self, filename):
+        with nc.Dataset(filename, 'w') as f:
+            output.create_ic(f, self.dest_name, self.dest_grid)
+            output.write_field(f, self.dest_name, 'temp', self.dest_temp, 'C')
+
+
+@pytest.fixture(scope='module', params=synthetic.bench_pairs(),
+                ids=lambda p: '{}-{}'.format(*p))
+def stages(request):
+    return Stages(*request.param)
+
+
+def run(benchmark, func, *args, **kwargs):
+    """
+    Benchmark func(*args) and store its peak memory. kwargs may give the
+    number of rounds, 3 by default.
+    """
+
+    rounds = kwargs.get('rounds', 3)
+    benchmark.extra_info['peak_mem_mb'] = synthetic.peak_memory(func, *args)
+    return benchmark.pedantic(func, args, rounds=rounds, iterations=1)
+
+
+def test_vertical_interpolation(benchmark, stages):
+    run(benchmark, stages.vertical, stages.src_temp)
+
+
+def test_lateral_extension(benchmark, stages):
+    run(benchmark, stages.extend_and_fill, stages.vert_temp)
+
+
+def test_weight_generation(benchmark, stages, tmpdir):
+    weights = str(tmpdir.join('weights.nc'))
+
+    def generate():
+        if os.path.exists(weights):
+            os.remove(weights)
+        generate_weights(stages.global_src_grid, stages.dest_grid, weights)
+
+    run(benchmark, generate, rounds=1)
+
+
+def test_weight_application(benchmark, stages):
+    run(benchmark, stages.apply_weights, stages.filled_temp)
+
+
+def test_masking(benchmark, stages):
+    run(benchmark, stages.mask_levels, stages.regridded_temp)
+
+
+def test_writing(benchmark, stages, tmpdir):
+    run(benchmark, stages.write, str(tmpdir.join('ic.nc')))
+
+
+def test_stability_index(benchmark, stages):
+    run(benchmark, ic_stability_metric.calc_stability_index,
+        stages.dest_temp, stages.dest_salt, stages.dest_grid.levels)
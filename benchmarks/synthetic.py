@@ -0,0 +1,113 @@
+from __future__ import print_function
+
+import os
+import tracemalloc
+import numpy as np
+
+from ocean_ic import grids
+from ocean_ic.weights import RegridWeights, rectilinear_weights
+
+"""
+Synthetic reanalysis and model grids and fields for benchmarking.
+
+Nothing here needs network access or real grid definitions. The grids have
+the sizes of the real ones so that timings are representative.
+"""
+
+# name: (lons, lats, levels)
+GRID_SIZES = {
+    'GODAS': (np.arange(0.5, 360.0, 1.0), np.arange(-74.5, 64.6, 1/3.0), 40),
+    'ORAS4': (np.arange(0.5, 362.0, 1.0), np.linspace(-77.0, 89.0, 292), 42),
+    'MOM1': (np.arange(-279.5, 80.0, 1.0), np.linspace(-78.0, 89.5, 300), 50),
+    'MOM025': (np.arange(-279.875, 80.0, 0.25), np.linspace(-81.0, 89.9, 1080), 50),
+    'NEMO': (np.arange(-279.5, 82.0, 1.0), np.linspace(-78.0, 89.5, 292), 75),
+}
+
+# Source, destination pairs that are benchmarked by default. Set
+# OCEAN_IC_BENCH_PAIRS, e.g. to GODAS:MOM025, to choose others.
+DEFAULT_PAIRS = 'GODAS:MOM1,ORAS4:NEMO'
+
+def bench_pairs():
+    pairs = os.environ.get('OCEAN_IC_BENCH_PAIRS', DEFAULT_PAIRS)
+    return [tuple(p.split(':')) for p in pairs.split(',')]
+
+
+def make_levels(num_levels, max_depth=5500.0):
+    """
+    Level depths that get thicker with depth, like real ocean grids.
+    """
+
+    return max_depth*np.linspace(0.0, 1.0, num_levels + 1)[1:]**2 + 2.5
+
+
+def bottom_depth(x_t, y_t, max_depth=5500.0):
+    """
+    Smooth bathymetry with continents where it is <= 0.
+    """
+
+    x = np.deg2rad(x_t)
+    y = np.deg2rad(y_t)
+    depth = max_depth*(0.6 + 0.5*np.sin(2*x)*np.cos(3*y) +
+                       0.3*np.cos(5*x + 1.0)*np.sin(2*y))
+    depth[np.abs(y_t) > 85.0] = 0.0
+
+    return np.minimum(depth, max_depth)
+
+
+def make_grid(name):
+    """
+    A synthetic grid with the size of the named real grid.
+    """
+
+    lons, lats, num_levels = GRID_SIZES[name]
+    levels = make_levels(num_levels)
+    grid = grids.rectilinear_grid(lons, lats, levels, description=name)
+
+    depth = bottom_depth(grid.x_t, grid.y_t)
+    grid.mask = levels[:, np.newaxis, np.newaxis] > depth[np.newaxis, :, :]
+
+    return grid
+
+
+def make_fields(grid, seed=0):
+    """
+    Masked temperature (C) and salinity (psu) on grid.
+    """
+
+    rng = np.random.RandomState(seed)
+    shape = grid.shape
+    z = grid.levels[:, np.newaxis, np.newaxis]
+    lat = grid.y_t[np.newaxis, :, :]
+
+    temp = 2.0 + 26.0*np.exp(-z/700.0)*np.cos(np.deg2rad(lat)) + \
+            rng.normal(0.0, 0.2, shape)
+    salt = 34.7 + 0.8*np.exp(-z/1000.0)*np.cos(np.deg2rad(lat)) + \
+            rng.normal(0.0, 0.05, shape)
+
+    mask = grid.mask_3d()
+    return (np.ma.array(temp.astype('f4'), mask=mask),
+            np.ma.array(salt.astype('f4'), mask=mask))
+
+
+def bilinear_weights(src_grid, dest_grid):
+    """
+    Bilinear weights from a rectilinear global src_grid to dest_grid.
+    """
+
+    row, col, s = rectilinear_weights(src_grid, dest_grid)
+    return RegridWeights(row, col, s, src_grid.x_t.size, dest_grid.x_t.size)
+
+
+def peak_memory(func, *args):
+    """
+    Run func once and return its peak Python/numpy memory use in MB.
+    """
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024.0**2
@@ -3,14 +3,16 @@
 from __future__ import print_function
 
 import sys, os
+import csv
+import json
 import argparse
-import subprocess as sp
+import concurrent.futures as cf
 import netCDF4 as nc
 import numpy as np
 from seawater import eos80
 from scipy import ndimage as nd
 
-from regridder import regrid
+from ocean_ic.reader import expand_files
 
 """
 Calculate a 'stability metric' for the IC.
@@ -19,15 +21,75 @@ This counts the fraction of cells in a column which need to move to make it
 completely stable.
 """
 
-def level_of_first_masked(array):
+SALT_NAMES = ['vosaline', 'salt', 'SALT']
+TEMP_NAMES = ['votemper', 'temp', 'TEMP', 'pottmp', 'ptemp']
+DEPTH_NAMES = ['depth', 'zt', 'ZT', 'AZ_50', 'level', 'deptht']
 
-    assert len(array.shape) == 1
+def levels_of_first_masked(mask):
+    """
+    For every column of a 3d (depth, lat, lon) mask return the index of the
+    first masked level.
+
+    Columns that are not masked at all get the index of the last level, this
+    matches how the index has always been calculated.
+    """
+
+    assert len(mask.shape) == 3
+
+    return np.where(mask.any(axis=0), np.argmax(mask, axis=0),
+                    mask.shape[0] - 1)
+
+def lat_bands(lats, chunk_rows=None):
+    """
+    Split lats rows into slices of at most chunk_rows. None means one band.
+    """
+
+    if chunk_rows is None or chunk_rows <= 0:
+        chunk_rows = lats
+
+    return [slice(start, min(start + chunk_rows, lats))
+            for start in range(0, lats, chunk_rows)]
+
+class ICField(object):
+    """
+    The first time step of a 4d IC variable, read lazily so that only the
+    slices that are used are ever in memory. Values are converted to dtype
+    and then with value*scale + offset.
+    """
+
+    def __init__(self, var, scale=1, offset=0, dtype='f8'):
+        self.var = var
+        self.scale = scale
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.var.shape[1:]
+
+    def __getitem__(self, index):
+        data = self.var[(0,) + index].astype(self.dtype, copy=False)
+        if self.scale != 1:
+            data = data*self.scale
+        if self.offset != 0:
+            data = data + self.offset
+        return data
+
+def open_ic_field(f, var_name, dtype='f8'):
+    """
+    ICField for var_name in the open Dataset f that converts salt in kg/kg to
+    psu and temperature in K to C.
+    """
+
+    var = f.variables[var_name]
+    field = ICField(var, dtype=dtype)
+    units = getattr(var, 'units', None)
+    if units == 'kg/kg':
+        field.scale = 1000
+    elif units == 'K':
+        field.offset = -273.15
 
-    i = 0
-    for i in xrange(len(array)):
-        if array.mask[i]:
-            break
-    return i
+    return field
 
 def calc_density(temp, salt, levels):
 
@@ -35,123 +97,613 @@ def calc_density(temp, salt, levels):
     assert len(salt.shape) == 3
     assert len(levels.shape) == 1
 
-    num_levs = levels.shape[0]
-    lats = salt.shape[1]
-    lons = salt.shape[2]
-    depth = np.vstack(([levels]*lats*lons)).T.reshape(num_levs, lats, lons)
-
-    # Pressure in dbar
-    pressure = depth*0.1
+    # Pressure in dbar, broadcast along the lat and lon axes. It has the
+    # same precision as temp and salt so that float32 fields stay float32.
+    dtype = np.result_type(temp.dtype, salt.dtype)
+    pressure = np.asarray(levels, dtype=dtype)[:, np.newaxis, np.newaxis]*0.1
     density = eos80.dens(salt, temp, pressure)
 
     return density
 
 
-def calc_stability_index(temp, salt, levels):
+def stability_index_of_density(density):
+    """
+    Stability index for each column of a 3d density field.
+    """
 
-    density = calc_density(temp, salt, levels)
+    num_levs = density.shape[0]
+    if hasattr(density, 'mask'):
+        lev = levels_of_first_masked(np.ma.getmaskarray(density))
+    else:
+        lev = np.full(density.shape[1:], num_levs)
 
-    lats = salt.shape[1]
-    lons = salt.shape[2]
-    si_ret = np.zeros((lats, lons))
+    # Only the levels above the first masked one count. Pad the rest with inf
+    # so that they sort to the bottom of the column and are never a mismatch.
+    valid = np.arange(num_levs)[:, np.newaxis, np.newaxis] < lev
+    density = np.where(valid, np.ma.getdata(density), np.inf)
 
-    # The score for each column is the sum of the difference between the
-    # current and sorted column.
-    for lat in range(lats):
-        for lon in range(lons):
-            if hasattr(density, 'mask'):
-                lev = level_of_first_masked(density[:, lat, lon])
-                if lev == 0:
-                    continue
-            else:
-                lev = density.shape[0]
+    # The score for each column is the number of cells that differ between
+    # the current and sorted column, as a fraction of the column length.
+    mismatch = (np.sort(density, axis=0) != density) & valid
+    count = np.count_nonzero(mismatch, axis=0)
 
-            si = np.count_nonzero(np.sort(density[:lev, lat, lon]) - density[:lev, lat, lon])
-            si = si / float(lev)
-            si_ret[lat, lon] = si
+    si_ret = np.zeros(lev.shape, dtype=density.dtype)
+    np.divide(count, lev, out=si_ret, where=(lev > 0))
 
     return si_ret
 
-def make_more_stable_ic(ic_file, temp_var, salt_var):
+
+def calc_stability_index(temp, salt, levels, chunk_rows=None, dtype='f8'):
+    """
+    Stability index of every column, as dtype.
+
+    The density is calculated chunk_rows latitudes at a time so that peak
+    memory depends on the chunk size rather than the grid size.
+    """
+
+    si_ret = np.zeros(salt.shape[1:], dtype=dtype)
+    for band in lat_bands(salt.shape[1], chunk_rows):
+        density = calc_density(temp[:, band, :], salt[:, band, :], levels)
+        si_ret[band, :] = stability_index_of_density(density)
+
+    return si_ret
+
+def masked_gaussian_filter(data, sigma, modes):
+    """
+    Gaussian smoothing of a masked array that only uses unmasked values.
+
+    The filtered values are divided by the filtered mask so that masked
+    (land) points neither contribute nor pull the result towards zero.
+    Masked points stay masked.
+    """
+
+    mask = np.ma.getmaskarray(data)
+    weights = (~mask).astype(data.dtype)
+    values = np.where(mask, 0, np.ma.getdata(data))
+
+    num = nd.gaussian_filter(values, sigma, mode=modes)
+    den = nd.gaussian_filter(weights, sigma, mode=modes)
+    smoothed = np.divide(num, den, out=np.zeros_like(num), where=(den > 0))
+
+    return np.ma.array(smoothed, mask=mask)
+
+def smooth_field(field, out, sigma=(2, 3, 3), chunk_rows=None,
+                 truncate=4.0):
+    """
+    Smooth the 3d (depth, lat, lon) field into out one latitude band at a
+    time.
+
+    Each band is read with a halo of rows as wide as the Gaussian kernel so
+    the result is the same as smoothing the whole field at once. Longitude
+    is treated as periodic.
+    """
+
+    lats = field.shape[1]
+    halo = int(truncate*sigma[1] + 0.5)
+    modes = ('reflect', 'reflect', 'wrap')
+
+    for band in lat_bands(lats, chunk_rows):
+        start = max(band.start - halo, 0)
+        stop = min(band.stop + halo, lats)
+        data = field[:, start:stop, :]
+        smoothed = masked_gaussian_filter(data, sigma, modes)
+        out[0, :, band, :] = \
+            smoothed[:, band.start - start:band.stop - start, :]
+
+def copy_definition(src, dest, var_name):
+    """
+    Define var_name and the dimensions and coordinates it uses in dest, as
+    they are in src.
+    """
+
+    var = src.variables[var_name]
+    for dim in var.dimensions:
+        if dim in dest.dimensions:
+            continue
+        d = src.dimensions[dim]
+        dest.createDimension(dim, None if d.isunlimited() else len(d))
+        if dim in src.variables:
+            coord = copy_definition(src, dest, dim)
+            coord[:] = src.variables[dim][:]
+
+    fill_value = getattr(var, '_FillValue', None)
+    new = dest.createVariable(var_name, var.dtype, var.dimensions,
+                              fill_value=fill_value)
+    new.setncatts(dict((k, var.getncattr(k)) for k in var.ncattrs()
+                       if k != '_FillValue'))
+
+    return new
+
+def make_more_stable_ic(temp_ic, salt_ic, output_file, temp_var, salt_var,
+                        sigma=(2, 3, 3), chunk_rows=None, dtype='f8'):
+    """
+    Write a smoothed copy of temp and salt to output_file.
+
+    The fields are smoothed with a mask normalised Gaussian, see
+    masked_gaussian_filter(), chunk_rows latitudes at a time.
+    """
+
+    with nc.Dataset(output_file, 'w') as out:
+        for ic_file, var_name in [(temp_ic, temp_var), (salt_ic, salt_var)]:
+            with nc.Dataset(ic_file) as f:
+                var = copy_definition(f, out, var_name)
+                field = ICField(f.variables[var_name], dtype=dtype)
+                smooth_field(field, var, sigma, chunk_rows)
+
+def layer_thickness(levels):
+    """
+    Thickness of the layer around each level, with edges half way between
+    levels and at the surface.
+    """
+
+    levels = np.asarray(levels, dtype='f8')
+    edges = np.empty(len(levels) + 1)
+    edges[0] = 0.0
+    edges[1:-1] = (levels[:-1] + levels[1:]) / 2.0
+    edges[-1] = levels[-1] + (levels[-1] - edges[-2])
+
+    return np.diff(edges)
+
+def unstable_interfaces(temp, salt, pressure, valid, tol):
+    """
+    For 2d (depth, columns) fields return a (depth - 1, columns) boolean
+    array which is True where the cell above the interface is denser than
+    the one below when both are at the pressure of the lower cell.
+    """
+
+    p = pressure[1:, np.newaxis]
+    upper = eos80.dens(salt[:-1], temp[:-1], p)
+    lower = eos80.dens(salt[1:], temp[1:], p)
+
+    return (upper > lower + tol) & valid[1:]
+
+def convective_adjustment(temp, salt, levels, valid, tol=1e-5,
+                          max_iterations=1000):
+    """
+    Make the 2d (depth, columns) temp and salt statically stable, in place.
+
+    Each unstable pair of neighbouring cells is mixed to its thickness
+    weighted mean temperature and salinity, alternating between the pairs
+    starting on even and odd levels so that the pairs mixed together never
+    overlap. This is repeated until the column is stable to within tol
+    kg/m^3. Only the columns that are still unstable are worked on at each
+    iteration.
+
+    valid: boolean (depth, columns), True for ocean cells.
+    Returns the number of iterations and the columns that did not converge.
+    """
+
+    dz = layer_thickness(levels)
+    pressure = np.asarray(levels, dtype=temp.dtype)*0.1
+
+    unstable = unstable_interfaces(temp, salt, pressure, valid, tol)
+    active = np.flatnonzero(unstable.any(axis=0))
+    unstable = unstable[:, active]
+
+    iterations = 0
+    while active.size > 0 and iterations < max_iterations:
+        t = temp[:, active]
+        s = salt[:, active]
+        v = valid[:, active]
+
+        for parity in (0, 1):
+            if parity == 1:
+                unstable = unstable_interfaces(t, s, pressure, v, tol)
+            k, c = np.nonzero(unstable[parity::2])
+            k = 2*k + parity
+            w_upper = dz[k]
+            w_lower = dz[k + 1]
+            for f in (t, s):
+                mean = (w_upper*f[k, c] + w_lower*f[k + 1, c]) / \
+                        (w_upper + w_lower)
+                f[k, c] = mean
+                f[k + 1, c] = mean
+
+        temp[:, active] = t
+        salt[:, active] = s
+
+        unstable = unstable_interfaces(t, s, pressure, v, tol)
+        still = unstable.any(axis=0)
+        active = active[still]
+        unstable = unstable[:, still]
+        iterations += 1
+
+    return iterations, active
+
+class RepairReport(object):
+    """
+    What a stability repair changed.
+    """
+
+    def __init__(self):
+        self.columns = 0
+        self.columns_changed = 0
+        self.columns_not_converged = 0
+        self.iterations = 0
+        self.max_temp_change = 0.0
+        self.max_salt_change = 0.0
+
+    def add(self, temp_change, salt_change, iterations, not_converged):
+        """
+        Add the absolute changes to 2d (depth, columns) fields.
+        """
+
+        self.columns += temp_change.shape[1]
+        self.columns_changed += np.count_nonzero(
+                    (temp_change > 0).any(axis=0) | (salt_change > 0).any(axis=0))
+        self.columns_not_converged += len(not_converged)
+        self.iterations = max(self.iterations, iterations)
+        if temp_change.size > 0:
+            self.max_temp_change = max(self.max_temp_change,
+                                       float(temp_change.max()))
+            self.max_salt_change = max(self.max_salt_change,
+                                       float(salt_change.max()))
+
+    def merge(self, other):
+
+        self.columns += other.columns
+        self.columns_changed += other.columns_changed
+        self.columns_not_converged += other.columns_not_converged
+        self.iterations = max(self.iterations, other.iterations)
+        self.max_temp_change = max(self.max_temp_change, other.max_temp_change)
+        self.max_salt_change = max(self.max_salt_change, other.max_salt_change)
+
+    def summary(self):
+        return '\n'.join([
+            'Columns changed: {} of {}'.format(self.columns_changed,
+                                               self.columns),
+            'Columns not converged: {}'.format(self.columns_not_converged),
+            'Iterations: {}'.format(self.iterations),
+            'Largest temperature change: {:.4f}'.format(self.max_temp_change),
+            'Largest salinity change: {:.4f}'.format(self.max_salt_change)])
+
+def repair_stability(temp, salt, levels, tol=1e-5, max_iterations=1000):
+    """
+    Convectively adjust 3d (depth, lat, lon) masked temp and salt so every
+    column is statically stable. Returns the adjusted fields and a
+    RepairReport.
+    """
+
+    shape = temp.shape
+    mask = np.ma.getmaskarray(temp) | np.ma.getmaskarray(salt)
+    valid = ~mask.reshape((shape[0], -1))
+    # Only the contiguous ocean cells from the surface count.
+    valid = np.cumprod(valid, axis=0).astype(bool)
+
+    before_temp = np.ma.getdata(temp).reshape((shape[0], -1))
+    before_salt = np.ma.getdata(salt).reshape((shape[0], -1))
+    t = np.where(valid, before_temp, 0)
+    s = np.where(valid, before_salt, 0)
+
+    iterations, not_converged = convective_adjustment(t, s, levels, valid,
+                                                      tol, max_iterations)
+
+    t = np.where(valid, t, before_temp)
+    s = np.where(valid, s, before_salt)
+    report = RepairReport()
+    report.add(np.abs(t - before_temp), np.abs(s - before_salt), iterations,
+               not_converged)
+
+    t = t.reshape(shape)
+    s = s.reshape(shape)
+
+    return np.ma.array(t, mask=mask), np.ma.array(s, mask=mask), report
+
+def make_stable_ic(temp_ic, salt_ic, output_file, temp_var, salt_var, levels,
+                   chunk_rows=None, dtype='f8'):
+    """
+    Write a convectively adjusted copy of temp and salt to output_file,
+    chunk_rows latitudes at a time. Returns a RepairReport.
+    """
+
+    report = RepairReport()
+    with nc.Dataset(temp_ic) as tf, nc.Dataset(salt_ic) as sf, \
+            nc.Dataset(output_file, 'w') as out:
+        temp = open_ic_field(tf, temp_var, dtype)
+        salt = open_ic_field(sf, salt_var, dtype)
+        out_temp = copy_definition(tf, out, temp_var)
+        out_salt = copy_definition(sf, out, salt_var)
+
+        for band in lat_bands(salt.shape[1], chunk_rows):
+            t, s, band_report = repair_stability(temp[:, band, :],
+                                                 salt[:, band, :], levels)
+            out_temp[0, :, band, :] = (t - temp.offset) / temp.scale
+            out_salt[0, :, band, :] = (s - salt.offset) / salt.scale
+            report.merge(band_report)
+
+    return report
+
+def find_variable(f, names):
+    """
+    The first of names that is a variable of the open Dataset f.
+    """
+
+    present = set(f.variables)
+    for name in names:
+        if name in present:
+            return name
+
+    raise KeyError('None of {} in {}'.format(', '.join(names), f.filepath()))
+
+def find_levels(f, var_name):
+    """
+    Depth of the levels of var_name in the open Dataset f. This is the
+    coordinate of its depth dimension if there is one, otherwise the first of
+    DEPTH_NAMES.
+    """
+
+    dim = f.variables[var_name].dimensions[-3]
+    coords = [name for name, var in f.variables.items()
+              if var.dimensions == (dim,)]
+    if dim in coords:
+        name = dim
+    elif len(coords) == 1:
+        name = coords[0]
+    else:
+        name = find_variable(f, DEPTH_NAMES)
+
+    return f.variables[name][:]
+
+def detect_variables(tf, sf):
+    """
+    (temp_var, salt_var, levels) of the open temp and salt IC files.
+    """
+
+    temp_var = find_variable(tf, TEMP_NAMES)
+    salt_var = find_variable(sf, SALT_NAMES)
+
+    return temp_var, salt_var, find_levels(tf, temp_var)
+
+def write_stability_index(filename, si):
+
+    with nc.Dataset(filename, 'w') as f:
+        f.createDimension('x', si.shape[1])
+        f.createDimension('y', si.shape[0])
+        si_nc = f.createVariable('stability', si.dtype, ('y', 'x'))
+        si_nc[:] = si[:]
+
+def summarize(si, ocean, worst=5):
+    """
+    Summary of a stability index: the mean over all columns, the fraction of
+    the ocean columns that are unstable and the worst columns as (j, i,
+    stability).
+    """
+
+    flat = si.ravel()
+    n = min(worst, flat.size)
+    worst_columns = []
+    if n > 0:
+        top = np.argpartition(flat, flat.size - n)[flat.size - n:]
+        top = top[np.argsort(-flat[top], kind='stable')]
+        for j, i in zip(*np.unravel_index(top, si.shape)):
+            if si[j, i] > 0:
+                worst_columns.append((int(j), int(i), float(si[j, i])))
+
+    num_ocean = np.count_nonzero(ocean)
+    unstable = np.count_nonzero((si > 0) & ocean)
+
+    return {'mean': float(np.sum(si) / si.size),
+            'unstable_fraction': unstable / num_ocean if num_ocean else 0.0,
+            'worst_columns': worst_columns}
+
+def evaluate_ic(temp_ic, salt_ic, output_file, chunk_rows=None, dtype='f8',
+                worst=5):
+    """
+    Write the stability index of an IC to output_file and return its
+    summary, see summarize().
+    """
+
+    with nc.Dataset(salt_ic) as sf, nc.Dataset(temp_ic) as tf:
+        temp_var, salt_var, levels = detect_variables(tf, sf)
+        temp = open_ic_field(tf, temp_var, dtype)
+        salt = open_ic_field(sf, salt_var, dtype)
+        si = calc_stability_index(temp, salt, levels, chunk_rows, dtype)
+        ocean = ~np.ma.getmaskarray(salt[0, :, :])
+
+    write_stability_index(output_file, si)
+
+    summary = {'temp_ic': temp_ic, 'salt_ic': salt_ic,
+               'output_file': output_file, 'temp_var': temp_var,
+               'salt_var': salt_var}
+    summary.update(summarize(si, ocean, worst))
+
+    return summary
+
+def _evaluate_task(ic_file, output_file, chunk_rows, dtype, worst):
+    """
+    evaluate_ic() for an IC file that holds both temp and salt. Errors are
+    returned in the summary so that one bad file doesn't stop the batch.
+    """
+
+    try:
+        return evaluate_ic(ic_file, ic_file, output_file, chunk_rows, dtype,
+                           worst)
+    except Exception as e:
+        return {'temp_ic': ic_file, 'salt_ic': ic_file,
+                'output_file': output_file, 'error': str(e)}
+
+def evaluate_ics(ic_files, output_files, workers=1, chunk_rows=None,
+                 dtype='f8', worst=5):
+    """
+    Evaluate many IC files, each holding both temp and salt, with a pool of
+    workers processes. Returns their summaries in the order of ic_files.
+    """
+
+    tasks = [(ic, out, chunk_rows, dtype, worst)
+             for ic, out in zip(ic_files, output_files)]
+    if workers <= 1:
+        return [_evaluate_task(*task) for task in tasks]
+
+    with cf.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_evaluate_task, *zip(*tasks)))
+
+def stability_index_path(ic_file, output_dir=None):
     """
+    Where the stability index of ic_file goes: <name>_stability_index.nc
+    next to it or in output_dir.
     """
 
-    sigma = (2, 3, 3)
+    directory, name = os.path.split(ic_file)
+    if output_dir is not None:
+        directory = output_dir
+    name = os.path.splitext(name)[0] + '_stability_index.nc'
 
-    with nc.Dataset(ic_file, 'r+') as f:
-        temp = f.variables[temp_var]
-        temp[0, :, :, :] = nd.filters.gaussian_filter(temp[0, :, :, :], sigma)
-        salt = f.variables[salt_var]
-        salt[0, :, :, :] = nd.filters.gaussian_filter(salt[0, :, :, :], sigma)
+    return os.path.join(directory, name)
+
+SUMMARY_COLUMNS = ['temp_ic', 'salt_ic', 'output_file', 'temp_var',
+                   'salt_var', 'mean', 'unstable_fraction', 'worst_columns',
+                   'error']
+
+def write_summary(filename, summaries):
+    """
+    Write the summaries as JSON if filename ends in .json, otherwise as CSV
+    with the worst columns as j:i:stability separated by spaces.
+    """
+
+    if filename.endswith('.json'):
+        with open(filename, 'w') as f:
+            json.dump(summaries, f, indent=2)
+        return
+
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, SUMMARY_COLUMNS)
+        writer.writeheader()
+        for summary in summaries:
+            row = dict(summary)
+            row['worst_columns'] = ' '.join(
+                    '{}:{}:{:.4f}'.format(*c)
+                    for c in summary.get('worst_columns', []))
+            writer.writerow(row)
+
+def format_summaries(summaries):
+    """
+    A human readable table of the summaries.
+    """
+
+    lines = ['{:<40} {:>10} {:>10}  {}'.format('IC', 'mean', 'unstable',
+                                               'worst (j, i)')]
+    for s in summaries:
+        if 'error' in s:
+            lines.append('{:<40} failed: {}'.format(s['temp_ic'], s['error']))
+            continue
+        worst = ', '.join('({}, {}) {:.3f}'.format(*c)
+                          for c in s['worst_columns'][:3])
+        lines.append('{:<40} {:>10.5f} {:>10.5f}  {}'.format(
+                     s['temp_ic'], s['mean'], s['unstable_fraction'], worst))
+
+    return '\n'.join(lines)
+
+def batch_main(argv):
+    """
+    Stability index of many ICs at once.
+    """
+
+    parser = argparse.ArgumentParser(prog='ic_stability_metric.py batch',
+                    description="""Calculate the stability index of many IC
+                    files, each holding both temp and salt, in parallel. The
+                    index of each IC is written to
+                    <name>_stability_index.nc and a summary of all of them
+                    is printed.""")
+    parser.add_argument('ic_files', nargs='+',
+                        help="IC files or quoted glob patterns.")
+    parser.add_argument('--output_dir', default=None,
+                        help="""Directory for the stability index files.
+                                Defaults to the directory of each IC.""")
+    parser.add_argument('--summary', default=None,
+                        help="""Also write the summary to this file, as JSON
+                                if it ends in .json and CSV otherwise.""")
+    parser.add_argument('--worst', default=5, type=int,
+                        help="Number of worst columns listed per IC. Defaults to 5.")
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of ICs evaluated at once. Defaults to 1.")
+    parser.add_argument('--chunk_rows', default=None, type=int,
+                        help="""Number of latitude rows to calculate density
+                                for at a time. Defaults to the whole grid.""")
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float32', 'float64'],
+                        help="""Precision used to calculate density and of the
+                                stability index output. Defaults to float64.""")
+    args = parser.parse_args(argv)
+
+    try:
+        ic_files = expand_files(args.ic_files)
+    except IOError as e:
+        parser.error(str(e))
+    # The same file may match more than one pattern, and patterns such as
+    # ic_*.nc also match the output of an earlier run.
+    unique = []
+    seen = set()
+    for ic in ic_files:
+        if ic in seen or ic.endswith('_stability_index.nc'):
+            continue
+        seen.add(ic)
+        unique.append(ic)
+    ic_files = unique
+
+    output_files = [stability_index_path(ic, args.output_dir)
+                    for ic in ic_files]
+    if len(set(output_files)) != len(output_files):
+        parser.error('IC files with the same name need different '
+                     'directories, leave out --output_dir')
+
+    summaries = evaluate_ics(ic_files, output_files, args.workers,
+                             args.chunk_rows, args.dtype, args.worst)
+    print(format_summaries(summaries))
+    if args.summary:
+        write_summary(args.summary, summaries)
+
+    return 1 if any('error' in s for s in summaries) else 0
 
 def main():
 
-    parser = argparse.ArgumentParser()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(epilog="""Use
+                    'ic_stability_metric.py batch --help' to evaluate many
+                    ICs at once.""")
     parser.add_argument('temp_ic', help="The initial condition file containing temp")
     parser.add_argument('salt_ic', help="The initial condition file containing salt")
+    parser.add_argument('--output', default='./stability_index.nc',
+                        help="""File to write the stability index to.
+                                Defaults to ./stability_index.nc.""")
     parser.add_argument('--output_more_stable', action='store_true',
                         default=False, help="Output a more stable version of the IC.")
+    parser.add_argument('--repair', action='store_true', default=False,
+                        help="""Output a statically stable version of the IC,
+                                stable_ic.nc, made by convective adjustment of
+                                the unstable columns only.""")
+    parser.add_argument('--chunk_rows', default=None, type=int,
+                        help="""Number of latitude rows to calculate density
+                                for at a time. Smaller values use less memory.
+                                Defaults to the whole grid.""")
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float32', 'float64'],
+                        help="""Precision used to calculate density and of the
+                                stability index output. Defaults to float64.""")
     args = parser.parse_args()
 
-    salt_var_names = ['vosaline', 'salt', 'SALT']
-    temp_var_names = ['votemper', 'temp', 'TEMP', 'pottmp']
-    depth_var_names = ['depth', 'zt', 'ZT', 'AZ_50', 'level']
-
-    with nc.Dataset(args.salt_ic) as f:
-        for salt_var in salt_var_names:
-            if f.variables.has_key(salt_var):
-                salt = f.variables[salt_var][0, :, :, :]
-                try:
-                    if f.variables[salt_var].units == "kg/kg":
-                        salt *= 1000
-                except AttributeError, e:
-                    pass
-                break
-        else:
-             raise KeyError(salt_var)
-
-    with nc.Dataset(args.temp_ic) as f:
-        for temp_var in temp_var_names:
-            if f.variables.has_key(temp_var):
-                temp = f.variables[temp_var][0, :, :, :]
-                try:
-                    if f.variables[temp_var].units == "K":
-                        temp -= 273.15
-                except AttributeError, e:
-                    pass
-                break
-        else:
-            raise KeyError(temp_var)
-
-        for d in depth_var_names:
-            if f.variables.has_key(d):
-                depth = f.variables[d][:]
-                break
-        else:
-            raise KeyError(d)
-
-    si = calc_stability_index(temp, salt, depth)
-    lats = salt.shape[1]
-    lons = salt.shape[2]
+    summary = evaluate_ic(args.temp_ic, args.salt_ic, args.output,
+                          args.chunk_rows, args.dtype)
+    temp_var = summary['temp_var']
+    salt_var = summary['salt_var']
 
     if args.output_more_stable:
 
-        ret = sp.call(['nccopy', '-v', temp_var, args.temp_ic, './more_stable_ic.nc'])
-        assert ret == 0
-        ret = sp.call(['nccopy', '-v', salt_var, args.salt_ic, './more_stable_ic.nc'])
-        assert ret == 0
-
-        make_more_stable_ic('./more_stable_ic.nc', temp_var, salt_var)
+        make_more_stable_ic(args.temp_ic, args.salt_ic, './more_stable_ic.nc',
+                            temp_var, salt_var, chunk_rows=args.chunk_rows,
+                            dtype=args.dtype)
 
-    with nc.Dataset('./stability_index.nc', 'w') as f:
-        f.createDimension('x', lons)
-        f.createDimension('y', lats)
-        si_nc = f.createVariable('stability', 'f8', ('y', 'x'))
-
-        si_nc[:] = si[:]
+    if args.repair:
+        with nc.Dataset(args.temp_ic) as tf:
+            levels = find_levels(tf, temp_var)
+        report = make_stable_ic(args.temp_ic, args.salt_ic, './stable_ic.nc',
+                                temp_var, salt_var, levels,
+                                chunk_rows=args.chunk_rows, dtype=args.dtype)
+        print(report.summary())
 
     # Total score is sum of all columns divided by total columns
-    print('Average stability metric (high is bad) {}'.format(np.sum(si) / (lats*lons)))
+    print('Average stability metric (high is bad) {}'.format(summary['mean']))
 
     return 0
 
@@ -4,44 +4,146 @@ from __future__ import print_function
 
 import sys, os
 import argparse
-import netCDF4 as nc
-from regridder import regrid
+import subprocess as sp
 
-def main():
+from ocean_ic import grids, profiling
+from ocean_ic.cache import WeightsCache, make_key, default_cache_dir
+from ocean_ic.gridstore import GridStore, default_store_dir
+from ocean_ic.pipeline import RegridPipeline, regrid_fields
+from ocean_ic.parallel import regrid_ics_parallel
+from ocean_ic import server
+from ocean_ic import update
+
+def add_grid_arguments(parser, temp_help, salt_help):
+    """
+    Arguments shared by the single IC and batch commands. Without temp_help
+    and salt_help only the grids are asked for.
+    """
 
-    parser = argparse.ArgumentParser()
     parser.add_argument('reanalysis_name', help="""
                         Name of src data/grid, must be GODAS, ORAS4 or WOA""",
                         choices=['GODAS','ORAS4','WOA'])
     parser.add_argument('reanalysis_hgrid', help='Reanalysis horizontal grid spec file.')
     parser.add_argument('reanalysis_vgrid', help='Reanalysis vertical grid spec file.')
-    parser.add_argument('temp_reanalysis_file', help='Temperature file from reanalysis.')
-    parser.add_argument('salt_reanalysis_file', help='Salt file from reanalysis.')
+    if temp_help is not None:
+        parser.add_argument('temp_reanalysis_file', help=temp_help)
+        parser.add_argument('salt_reanalysis_file', help=salt_help)
 
     parser.add_argument('model_name', help="""
                         Name of model, must be MOM, MOM1 or NEMO""",
                         choices=['MOM','MOM1','NEMO'])
     parser.add_argument('model_hgrid', help='Model horizontal grid spec file.')
     parser.add_argument('model_vgrid', help='Model vertical grid spec file.')
-    parser.add_argument('output_file', help='Name of the destination/output file.')
+
+
+def add_grid_store_options(parser):
+
     parser.add_argument('--model_mask', default=None, help='Model land-sea mask file.')
-    parser.add_argument('--month', default=1, type=int,
-                        help="""Which month of the data to use.
-                                Assumes datasets containing 12 months.""")
+    parser.add_argument('--grid_store_dir', default=None,
+                        help="""Directory of preprocessed grids. Defaults to
+                                {}.""".format(default_store_dir()))
+    parser.add_argument('--no_grid_store', action='store_true', default=False,
+                        help="""Always read the grids from the grid definition
+                                files.""")
+
+
+def add_regrid_options(parser):
+
+    add_grid_store_options(parser)
     parser.add_argument('--use_mpi', action='store_true', default=False,
                         help="""Use MPI to when calculating the regridding weights.
                                This will speed up the calculation considerably.""")
+    parser.add_argument('--mpi', action='store_true', default=False,
+                        help="""Split the model grid into latitude bands over
+                                the MPI ranks of this run and regrid them in
+                                parallel, e.g. mpirun -n 8 makeic.py ... --mpi.
+                                Needs mpi4py.""")
+
+    parser.add_argument('--method', default='bilinear',
+                        choices=['bilinear', 'neareststod', 'conserve'],
+                        help="""Regridding method: bilinear, nearest source to
+                                destination or first order conservative.
+                                Defaults to bilinear.""")
+
+    parser.add_argument('--workers', default=1, type=int,
+                        help="""Number of processes used to regrid the variables
+                                and time slices. Defaults to 1.""")
+
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help="Compress the output with zlib and shuffle.")
+    parser.add_argument('--complevel', default=4, type=int,
+                        help="zlib compression level used with --compress.")
+    parser.add_argument('--least_significant_digit', default=None, type=int,
+                        help="""Quantize the output to this many decimal digits
+                                before compressing. Only used with --compress.""")
+
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float32', 'float64'],
+                        help="""Precision used for regridding and in the output.
+                                float32 halves the memory used and the size of
+                                the output. Defaults to float64.""")
+
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="""Read, regrid and write each variable a model
+                                level at a time, reading ahead on a
+                                background thread. Memory use is then a few
+                                2d levels of the model grid, however deep it
+                                is. For very high resolution model grids.""")
+
+    parser.add_argument('--update', action='store_true', default=False,
+                        help="""Bring an existing output file up to date instead
+                                of stopping. Only the variables whose
+                                reanalysis files changed or that are missing
+                                are regridded again, and after an edit of
+                                the model mask only the cells whose mask
+                                changed. An IC made with other grids or
+                                options is remade.""")
+
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="Print the time and memory used by each stage.")
+    parser.add_argument('--report', default=None,
+                        help="""Write the time and memory used by each stage
+                                and the bytes read and written per file to this
+                                JSON file.""")
 
     parser.add_argument('--mom_version', type=str, default='MOM5',
-                    help="""MOM version (e.g., MOM5, MOM6). Only used if model_name is MOM or MOM1. 
+                    help="""MOM version (e.g., MOM5, MOM6). Only used if model_name is MOM or MOM1.
                     Defaults to MOM5.""")
 
-    args = parser.parse_args()
+    parser.add_argument('--weights_cache_dir', default=None,
+                        help="""Directory used to cache regridding weights
+                                between runs. Defaults to {}.""".format(default_cache_dir()))
+    parser.add_argument('--weights_cache_size', default=10.0, type=float,
+                        help="""Maximum size of the weights cache in GB. The
+                                least recently used weights are removed
+                                first.""")
+    parser.add_argument('--no_weights_cache', action='store_true', default=False,
+                        help="Don't read or write the regridding weights cache.")
+    parser.add_argument('--keep_weights', action='store_true', default=False,
+                        help="""Keep the regridding weights file in the current
+                                directory when the cache is not used.""")
 
-    if os.path.exists(args.output_file):
-        print("Output file {} already exists, ".format(args.output_file) + \
-               "please move or delete.", file=sys.stderr)
-        return 1
+
+def parse_range(arg):
+    """
+    Parse a list of integers such as '1-12', '1,4,7' or '1990-1995,2000'.
+    """
+
+    values = []
+    for part in arg.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            values.extend(range(int(start), int(end) + 1))
+        else:
+            values.append(int(part))
+
+    return values
+
+
+def variables_to_regrid(reanalysis_name, model_name, temp_file, salt_file):
+    """
+    List of (src_file, src_var, dest_var) for the reanalysis and model.
+    """
 
     temp_vars = {
         "pottemp": {"src": None, "dest": None},
@@ -52,19 +154,19 @@ def main():
         "abssalt": {"src": None, "dest": None}
     }
     # Read in temperature and salinity data.
-    if args.reanalysis_name == 'ORAS4':
+    if reanalysis_name == 'ORAS4':
         temp_vars["pottemp"]["src"] = 'thetao'
         salt_vars["pracsalt"]["src"] = 'so'
-    elif args.reanalysis_name == 'GODAS':
+    elif reanalysis_name == 'GODAS':
         temp_vars["pottemp"]["src"] = 'pottmp'
         salt_vars["pracsalt"]["src"] = 'salt'
-    elif args.reanalysis_name == 'WOA':
+    elif reanalysis_name == 'WOA':
         temp_vars["pottemp"]["src"] = 'potential_temperature'
         temp_vars["contemp"]["src"] = 'conservative_temperature'
         salt_vars["pracsalt"]["src"] = 'practical_salinity'
         salt_vars["abssalt"]["src"] = 'absolute_salinity'
 
-    if 'MOM' in args.model_name:
+    if 'MOM' in model_name:
         # OM2 expects variables conservative temp and practical salt in variables called
         # "temp" and "salt"
         # OM3 expects potential temp and practical salt in variables called "ptemp" and "salt"
@@ -78,49 +180,557 @@ def main():
         salt_vars["pracsalt"]["dest"] = 'vosaline'
 
     temp_var_to_regrid = [
-        (args.temp_reanalysis_file, var["src"], var["dest"]) for _, var in temp_vars.items() if var["src"] is not None
+        (temp_file, var["src"], var["dest"]) for _, var in temp_vars.items() if var["src"] is not None
     ]
     salt_var_to_regrid = [
-        (args.salt_reanalysis_file, var["src"], var["dest"]) for _, var in salt_vars.items() if var["src"] is not None
+        (salt_file, var["src"], var["dest"]) for _, var in salt_vars.items() if var["src"] is not None
     ]
-    vars_to_regrid = temp_var_to_regrid + salt_var_to_regrid
-
-    # Regrid temp and salt, write out to the same file.
-    weights = None
-    for src_file, src_var, dest_var in vars_to_regrid:
-        weights = regrid.do_regridding(args.reanalysis_name, (args.reanalysis_hgrid,),
-                                       args.reanalysis_vgrid,
-                                       src_file, src_var,
-                                       args.model_name, args.model_hgrid,
-                                       args.model_vgrid,
-                                       args.output_file, dest_var, dest_mask=args.model_mask,
-                                       month=args.month, regrid_weights=weights,
-                                       use_mpi=args.use_mpi, write_ic=True, mom_version=args.mom_version)
-        if weights is None:
+    return temp_var_to_regrid + salt_var_to_regrid
+
+
+def load_grids(args):
+    """
+    Read the reanalysis and model grids, from the grid store unless
+    --no_grid_store is given. Grids that are not in the store yet are added.
+    """
+
+    src_files = [args.reanalysis_hgrid, args.reanalysis_vgrid]
+    src_args = (args.reanalysis_name, (args.reanalysis_hgrid,),
+                args.reanalysis_vgrid)
+    dest_files = [args.model_hgrid, args.model_vgrid, args.model_mask]
+    dest_args = (args.model_name, args.model_hgrid, args.model_vgrid,
+                 args.model_mask)
+
+    if args.no_grid_store:
+        return grids.load_src_grid(*src_args), grids.load_dest_grid(*dest_args)
+
+    store = GridStore(args.grid_store_dir)
+    src_grid = store.load(args.reanalysis_name, src_files,
+                          grids.load_src_grid, *src_args)
+    dest_grid = store.load(args.model_name, dest_files,
+                           grids.load_dest_grid, *dest_args)
+
+    return src_grid, dest_grid
+
+
+def build_pipeline(args):
+    """
+    Read the grids and set up the regridding.
+    """
+
+    with profiling.stage('load_grids'):
+        src_grid, dest_grid = load_grids(args)
+    weights_cache = None
+    cache_key = None
+    if not args.no_weights_cache:
+        weights_cache = WeightsCache(args.weights_cache_dir,
+                                     int(args.weights_cache_size*1024**3))
+        cache_key = make_key([args.reanalysis_hgrid, args.reanalysis_vgrid,
+                              args.model_hgrid, args.model_vgrid,
+                              args.model_mask],
+                             args.reanalysis_name, args.model_name,
+                             args.method)
+    return RegridPipeline(args.reanalysis_name, src_grid, dest_grid,
+                          use_mpi=args.use_mpi, method=args.method,
+                          weights_cache=weights_cache,
+                          cache_key=cache_key, dtype=args.dtype,
+                          stream=args.stream)
+
+
+def make_pipeline(args):
+    """
+    build_pipeline() that returns None if the weights could not be
+    generated.
+    """
+
+    try:
+        return build_pipeline(args)
+    except (OSError, sp.CalledProcessError) as e:
+        print("Failed to generate regridding weights: {}".format(e),
+              file=sys.stderr)
+        return None
+
+
+def cleanup_weights(pipeline, keep_weights):
+
+    if keep_weights or pipeline.weights_in_cache:
+        print("Regridding weights: {}".format(pipeline.weights_file))
+    else:
+        try:
+            os.remove(pipeline.weights_file)
+        except OSError:
+            pass
+
+
+def output_encoding(args):
+    """
+    Compression settings for output.create_field() from the options.
+    """
+
+    if not args.compress:
+        return None
+
+    return {'zlib': True, 'complevel': args.complevel, 'shuffle': True,
+            'least_significant_digit': args.least_significant_digit}
+
+
+def ic_parameters(args, pipeline):
+    """
+    The options and grids an IC depends on apart from its reanalysis files
+    and the model mask, which are recorded per variable. See
+    ocean_ic/update.py.
+    """
+
+    return {'reanalysis_name': args.reanalysis_name,
+            'model_name': args.model_name, 'method': args.method,
+            'dtype': args.dtype, 'mom_version': args.mom_version,
+            'grids': update.grids_key(pipeline.src_grid, pipeline.dest_grid)}
+
+
+def update_existing(pipeline, args, job, parameters, mask):
+    """
+    With --update bring the existing output file of job up to date in
+    place. Returns False if it has to be made from scratch instead.
+    """
+
+    temp_file, salt_file, output_file, month = job
+    if not args.update or not os.path.exists(output_file):
+        return False
+
+    fields = variables_to_regrid(args.reanalysis_name, args.model_name,
+                                 temp_file, salt_file)
+    done = update.update_ic(pipeline, fields, output_file, args.model_name,
+                            parameters, mask, month=month,
+                            encoding=output_encoding(args))
+    if done is None:
+        print("{} was made with other grids or options, remaking it.".format(
+              output_file))
+        return False
+
+    if done:
+        print("Updated {}: {}".format(output_file, ', '.join(
+              '{} ({})'.format(var, 'all' if action == 'all' else 'mask edits')
+              for var, action in done)))
+    else:
+        print("{} is up to date".format(output_file))
+
+    return True
+
+
+def make_ics(pipeline, args, jobs):
+    """
+    Regrid temp and salt into a list of (temp_file, salt_file, output_file,
+    month) ICs, using a pool of args.workers processes if more than one.
+
+    Each IC is written to a temporary file which is renamed once complete, so
+    an interrupted run never leaves a partial output file behind.
+    """
+
+    parameters = ic_parameters(args, pipeline)
+    mask = update.mask_key(args.model_mask)
+    jobs = [job for job in jobs
+            if not update_existing(pipeline, args, job, parameters, mask)]
+
+    ics = []
+    for temp_file, salt_file, output_file, month in jobs:
+        fields = variables_to_regrid(args.reanalysis_name, args.model_name,
+                                     temp_file, salt_file)
+        ics.append((output_file + '.tmp', fields, month))
+
+    encoding = output_encoding(args)
+    stamps = dict((tmp_file, (fields, month)) for tmp_file, fields, month in ics)
+
+    def finish(tmp_file):
+        fields, month = stamps[tmp_file]
+        update.stamp_ic(tmp_file, parameters, fields, month, mask)
+        os.replace(tmp_file, tmp_file[:-len('.tmp')])
+        print("Made {}".format(tmp_file[:-len('.tmp')]))
+
+    try:
+        if args.workers > 1:
+            regrid_ics_parallel(pipeline, ics, args.model_name, args.workers,
+                                mom_version=args.mom_version,
+                                on_complete=finish, encoding=encoding)
+        else:
+            for tmp_file, fields, month in ics:
+                regrid_fields(pipeline, fields, tmp_file, args.model_name,
+                              month=month, mom_version=args.mom_version,
+                              encoding=encoding)
+                finish(tmp_file)
+    finally:
+        for tmp_file, _, _ in ics:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+# Pipelines kept in memory by get_pipeline(), by pipeline_key().
+_pipelines = {}
+
+def pipeline_key(args):
+    """
+    The arguments that a pipeline depends on.
+    """
+
+    return (args.reanalysis_name, args.reanalysis_hgrid, args.reanalysis_vgrid,
+            args.model_name, args.model_hgrid, args.model_vgrid,
+            args.model_mask, args.method, args.dtype, args.stream,
+            args.no_weights_cache, args.weights_cache_dir, args.no_grid_store,
+            args.grid_store_dir)
+
+
+def get_pipeline(args):
+    """
+    Like build_pipeline() but the pipeline is kept in memory and reused by
+    later calls with the same grids, so that the grids, weights and fill
+    maps are only set up once per process.
+    """
+
+    key = pipeline_key(args)
+    pipeline = _pipelines.get(key)
+    if pipeline is None:
+        pipeline = build_pipeline(args)
+        # The weights are in memory now.
+        cleanup_weights(pipeline, args.keep_weights)
+        _pipelines[key] = pipeline
+
+    return pipeline
+
+
+def make_ics_mpi(pipeline, args, jobs, comm):
+    """
+    Like make_ics() with the regridding of each IC spread over the ranks of
+    comm. Rank 0 reads the reanalysis and writes the output.
+    """
+
+    from ocean_ic.mpi import DistributedRegridder
+
+    regridder = DistributedRegridder(comm, pipeline)
+    encoding = output_encoding(args)
+    rank = comm.Get_rank()
+
+    # Updates in place are done by rank 0 alone.
+    if rank == 0:
+        parameters = ic_parameters(args, pipeline)
+        mask = update.mask_key(args.model_mask)
+        jobs = [job for job in jobs
+                if not update_existing(pipeline, args, job, parameters, mask)]
+    jobs = comm.bcast(jobs, root=0)
+
+    for temp_file, salt_file, output_file, month in jobs:
+        fields = variables_to_regrid(args.reanalysis_name, args.model_name,
+                                     temp_file, salt_file)
+        tmp_file = output_file + '.tmp'
+        try:
+            regridder.regrid_fields(fields, tmp_file, args.model_name,
+                                    month=month, mom_version=args.mom_version,
+                                    encoding=encoding)
+        except Exception:
+            if rank == 0 and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        if rank == 0:
+            update.stamp_ic(tmp_file, parameters, fields, month, mask)
+            os.replace(tmp_file, output_file)
+            print("Made {}".format(output_file))
+
+
+def run_jobs_mpi(args, jobs):
+    """
+    run_jobs() under MPI. The pipeline is only set up on rank 0, which then
+    sends every other rank its share of the weights. An error on any rank
+    aborts the whole run, since the other ranks would wait for it forever.
+    """
+
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    report = None
+    if rank == 0 and (args.profile or args.report):
+        report = profiling.RunReport()
+        report.info['mpi_ranks'] = comm.Get_size()
+        report.info['num_ics'] = len(jobs)
+
+    with profiling.active(report):
+        pipeline = None
+        if rank == 0:
+            pipeline = make_pipeline(args)
+        if not comm.bcast(pipeline is not None, root=0):
             return 1
+
+        try:
+            make_ics_mpi(pipeline, args, jobs, comm)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            sys.stderr.flush()
+            comm.Abort(1)
+        finally:
+            if rank == 0:
+                cleanup_weights(pipeline, args.keep_weights)
+
+    if report is not None:
+        if args.profile:
+            print(report.summary())
+        if args.report:
+            report.write(args.report)
+
+    return 0
+
+
+def run_jobs(args, jobs, warm=False):
+    """
+    Read the grids and set up the regridding once, then make each IC in
+    jobs. With --profile or --report the time and memory used by each stage
+    is recorded.
+
+    warm: use get_pipeline() so the pipeline outlives the call. Errors are
+    then raised rather than returned.
+    """
+
+    if args.mpi:
+        return run_jobs_mpi(args, jobs)
+
+    report = None
+    if args.profile or args.report:
+        report = profiling.RunReport()
+        report.info['workers'] = args.workers
+        report.info['num_ics'] = len(jobs)
+
+    with profiling.active(report):
+        if warm:
+            pipeline = get_pipeline(args)
+        else:
+            pipeline = make_pipeline(args)
+            if pipeline is None:
+                return 1
+        profiling.set_info('weights_file', pipeline.weights_file)
+        profiling.set_info('weights_from_cache', pipeline.weights_cached)
+
+        try:
+            make_ics(pipeline, args, jobs)
+        finally:
+            if not warm:
+                cleanup_weights(pipeline, args.keep_weights)
+
+    if args.profile:
+        print(report.summary())
+    if args.report:
+        report.write(args.report)
+
+    return 0
+
+
+def make_options(**options):
+    """
+    The makeic.py options as parsed from the command line, with the
+    defaults for any that are not given. Raises TypeError for unknown
+    options.
+    """
+
+    parser = argparse.ArgumentParser()
+    add_regrid_options(parser)
+    args = parser.parse_args([])
+
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError('Unknown option {}'.format(name))
+        setattr(args, name, value)
+
+    return args
+
+
+def make_ic(reanalysis_name, reanalysis_hgrid, reanalysis_vgrid,
+            temp_file, salt_file, model_name, model_hgrid, model_vgrid,
+            output_file, month=1, **options):
+    """
+    Make an IC in this process and return the name of the output file.
+
+    The arguments are the same as those of makeic.py and options are any of
+    its long options, e.g. model_mask, dtype='float32' or workers=4. The
+    grids, weights and fill maps are kept in memory so later calls with the
+    same grids only regrid.
+
+    Raises IOError if output_file exists, unless update=True is given, and
+    OSError or CalledProcessError if the regridding weights could not be
+    made.
+    """
+
+    args = make_options(**options)
+    if os.path.exists(output_file) and not args.update:
+        raise IOError('Output file {} already exists'.format(output_file))
+
+    args.reanalysis_name = reanalysis_name
+    args.reanalysis_hgrid = reanalysis_hgrid
+    args.reanalysis_vgrid = reanalysis_vgrid
+    args.model_name = model_name
+    args.model_hgrid = model_hgrid
+    args.model_vgrid = model_vgrid
+    run_jobs(args, [(temp_file, salt_file, output_file, month)], warm=True)
+
+    return output_file
+
+
+def batch_main(argv):
+    """
+    Make many ICs, e.g. one for every month of several years, from a single
+    grid and regridding setup.
+    """
+
+    parser = argparse.ArgumentParser(prog='makeic.py batch', description="""
+                    Make an IC for every requested month and year. The
+                    reanalysis file names and output_pattern may contain
+                    {year} and {month} which are filled in with
+                    str.format(), e.g. pottmp.{year}.nc and
+                    ic_{year}{month:02d}.nc.""")
+    add_grid_arguments(parser, 'Temperature file name pattern.',
+                       'Salt file name pattern.')
+    parser.add_argument('--output_pattern', required=True,
+                        help='Name pattern of the destination/output files.')
+    parser.add_argument('--months', default='1-12', type=parse_range,
+                        help="Months to use, e.g. 1-12 or 1,4,7. Defaults to 1-12.")
+    parser.add_argument('--years', default=None, type=parse_range,
+                        help="Years to use, e.g. 1990-2019.")
+    add_regrid_options(parser)
+
+    args = parser.parse_args(argv)
+
+    patterns = [args.temp_reanalysis_file, args.salt_reanalysis_file,
+                args.output_pattern]
+    if args.years is None and any('{year' in p for p in patterns):
+        parser.error('--years is needed when a file name contains {year}')
+
+    years = args.years if args.years is not None else [None]
+    jobs = []
+    for year in years:
+        for month in args.months:
+            output_file = args.output_pattern.format(year=year, month=month)
+            if os.path.exists(output_file) and not args.update:
+                print("Skipping {}, it already exists.".format(output_file))
+                continue
+            temp_file = args.temp_reanalysis_file.format(year=year, month=month)
+            salt_file = args.salt_reanalysis_file.format(year=year, month=month)
+            jobs.append((temp_file, salt_file, output_file, month))
+
+    if not jobs:
+        return 0
+
+    return run_jobs(args, jobs)
+
+
+def preprocess_main(argv):
+    """
+    Convert the grid definitions into the grid store so that later runs
+    start quickly.
+    """
+
+    parser = argparse.ArgumentParser(prog='makeic.py preprocess',
+                    description="""Read the reanalysis and model grid
+                    definitions and keep them in the grid store as memory
+                    mapped arrays, which later runs open in milliseconds.""")
+    add_grid_arguments(parser, None, None)
+    add_grid_store_options(parser)
+
+    args = parser.parse_args(argv)
+    if args.no_grid_store:
+        parser.error('--no_grid_store makes no sense with preprocess')
+
+    load_grids(args)
+    print("Grids stored in {}".format(GridStore(args.grid_store_dir).store_dir))
+
+    return 0
+
+
+def serve_main(argv):
+    """
+    Keep the grids and weights loaded and make ICs on request.
+    """
+
+    parser = argparse.ArgumentParser(prog='makeic.py serve',
+                    description="""Set up the regridding for one reanalysis
+                    and model grid pair and then make ICs as they are
+                    requested over a UNIX socket or HTTP. See
+                    ocean_ic/server.py for the job format.""")
+    add_grid_arguments(parser, None, None)
+    parser.add_argument('--socket', default=None,
+                        help="Path of the UNIX socket to listen on.")
+    parser.add_argument('--port', default=None, type=int,
+                        help="Listen for HTTP on this port instead.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen for HTTP on. Defaults to 127.0.0.1.")
+    add_regrid_options(parser)
+
+    args = parser.parse_args(argv)
+    if (args.socket is None) == (args.port is None):
+        parser.error('Give one of --socket or --port')
+    for option in ['mpi', 'update', 'profile', 'report']:
+        if getattr(args, option):
+            parser.error('--{} is not supported by serve'.format(option))
+
+    pipeline = make_pipeline(args)
+    if pipeline is None:
+        return 1
+    cleanup_weights(pipeline, args.keep_weights)
+
+    def fields(temp_file, salt_file):
+        return variables_to_regrid(args.reanalysis_name, args.model_name,
+                                   temp_file, salt_file)
+
+    ic_server = server.ICServer(pipeline, args.model_name, fields,
+                                workers=args.workers,
+                                mom_version=args.mom_version,
+                                encoding=output_encoding(args),
+                                parameters=ic_parameters(args, pipeline),
+                                mask=update.mask_key(args.model_mask))
+    address = args.socket if args.port is None else (args.host, args.port)
+    listener = server.listen(ic_server, address)
+    print("Serving on {}".format(address))
     try:
-        os.remove(weights)
-    except OSError:
+        listener.serve_forever()
+    except KeyboardInterrupt:
         pass
+    finally:
+        listener.server_close()
+        ic_server.close()
+
+    return 0
+
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'preprocess':
+        return preprocess_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return serve_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(epilog="""
+                    Use 'makeic.py batch --help' to make many ICs in one
+                    run, 'makeic.py preprocess --help' to prepare the
+                    grids for fast startup and 'makeic.py serve --help' to
+                    make ICs on request.""")
+    add_grid_arguments(parser, """Temperature file from reanalysis. May be a
+                                  quoted glob pattern matching several files
+                                  split along time.""",
+                       'Salt file from reanalysis, may be a quoted glob pattern.')
+    parser.add_argument('output_file', help='Name of the destination/output file.')
+    parser.add_argument('--month', default=1, type=int,
+                        help="""Which month of the data to use.
+                                Assumes datasets containing 12 months.""")
+    add_regrid_options(parser)
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.output_file) and not args.update:
+        print("Output file {} already exists, ".format(args.output_file) + \
+               "please move, delete or use --update.", file=sys.stderr)
+        return 1
 
-    # May need to scale the salt.
-    with nc.Dataset(args.output_file, 'r+') as f:
-        for salt_name in ['vosaline', 'salt', 'asalt']:
-            try:
-                salt_var = f.variables[salt_name]
-                if salt_var.units == 'kg/kg':
-                    salt_var.units = 'psu'
-                    salt_var[:] *= 1000
-            except KeyError:
-                pass
-        for temp_name in ['votemper', 'temp', 'ptemp']:
-            try:
-                temp_var = f.variables[temp_name]
-                if temp_var.units == 'K':
-                    temp_var.units = 'C'
-                    temp_var[:] -= 273.15
-            except KeyError:
-                pass
+    return run_jobs(args, [(args.temp_reanalysis_file,
+                            args.salt_reanalysis_file,
+                            args.output_file, args.month)])
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -5,9 +5,8 @@ from __future__ import print_function
 import sys, os
 import argparse
 import subprocess as sp
-import netCDF4 as nc
 
-from regridder import regrid
+import makeic
 
 """
 Create ocean model IC based on reanalysis data.
@@ -45,6 +44,21 @@ def main():
     parser.add_argument('model_name', help="""
                         Name of model, must be MOM, MOM1 or NEMO""")
     parser.add_argument('output_file', help='Name of the destination/output file.')
+    parser.add_argument('--weights_cache_dir', default=None,
+                        help="Directory used to cache regridding weights between runs.")
+    parser.add_argument('--weights_cache_size', default=10.0, type=float,
+                        help="""Maximum size of the weights cache in GB. The
+                                least recently used weights are removed
+                                first.""")
+    parser.add_argument('--no_weights_cache', action='store_true', default=False,
+                        help="Don't read or write the regridding weights cache.")
+    parser.add_argument('--keep_weights', action='store_true', default=False,
+                        help="""Keep the regridding weights file in the current
+                                directory when the cache is not used.""")
+    parser.add_argument('--grid_store_dir', default=None,
+                        help="Directory of preprocessed grids.")
+    parser.add_argument('--no_grid_store', action='store_true', default=False,
+                        help="Always read the grids from grid_defs.")
     args = parser.parse_args()
 
     assert args.model_name == 'MOM' or args.model_name == 'MOM1' or \
@@ -75,23 +89,32 @@ def main():
         model_hgrid = os.path.join(grid_defs, 'ocean_hgrid.nc')
         model_vgrid = os.path.join(grid_defs, 'ocean_vgrid.nc')
         model_mask = os.path.join(grid_defs, 'ocean_mask.nc')
-        mm_arg = ['--model_mask', model_mask]
     elif args.model_name == 'MOM1':
         model_hgrid = os.path.join(grid_defs, 'grid_spec.nc')
         model_vgrid = os.path.join(grid_defs, 'grid_spec.nc')
         model_mask = os.path.join(grid_defs, 'grid_spec.nc')
-        mm_arg = ['--model_mask', model_mask]
     else:
         model_hgrid = os.path.join(grid_defs, 'coordinates.nc')
         model_vgrid = os.path.join(grid_defs, 'data_1m_potential_temperature_nomask.nc')
         model_mask = None
-        mm_arg = []
 
-    args = [args.reanalysis_name, reanalysis_hgrids[0], reanalysis_vgrid,
-            args.temp_reanalysis_file, args.salt_reanalysis_file, args.model_name,
-            model_hgrid, model_vgrid, args.output_file] + mm_arg
-    exe = os.path.join(os.path.dirname(__file__), 'makeic.py')
-    return sp.call([exe] + args)
+    try:
+        makeic.make_ic(args.reanalysis_name, reanalysis_hgrids[0],
+                       reanalysis_vgrid, args.temp_reanalysis_file,
+                       args.salt_reanalysis_file, args.model_name,
+                       model_hgrid, model_vgrid, args.output_file,
+                       model_mask=model_mask,
+                       weights_cache_dir=args.weights_cache_dir,
+                       weights_cache_size=args.weights_cache_size,
+                       no_weights_cache=args.no_weights_cache,
+                       keep_weights=args.keep_weights,
+                       grid_store_dir=args.grid_store_dir,
+                       no_grid_store=args.no_grid_store)
+    except (OSError, sp.CalledProcessError) as e:
+        print("Failed to make IC: {}".format(e), file=sys.stderr)
+        return 1
+
+    return 0
 
 
 if __name__ == '__main__':
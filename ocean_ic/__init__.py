@@ -0,0 +1,3 @@
+"""
+Library routines used by makeic.py and friends to create ocean model ICs.
+"""
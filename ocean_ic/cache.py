@@ -0,0 +1,249 @@
+from __future__ import print_function
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+"""
+Persistent on-disk cache of regridding weights and other per grid pair
+arrays such as the lateral fill index maps.
+
+Weights are stored under a key made from the content of the grid definition
+files and the regridding method, so a cache entry is reused by every run with
+the same grid pair no matter where the grid files live. The content hashes
+are remembered by path, size and modification time, so an unchanged grid
+file is only read the first time.
+"""
+
+DEFAULT_MAX_BYTES = 10*1024**3
+
+def default_cache_dir():
+    """
+    $XDG_CACHE_HOME/ocean-ic, falling back to ~/.cache/ocean-ic.
+    """
+
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(base, 'ocean-ic')
+
+
+def file_digest(filename, blocksize=1024*1024):
+    """
+    sha1 of the content of a file.
+    """
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def digests_dir():
+    return os.path.join(default_cache_dir(), 'digests')
+
+
+def cached_digest(filename):
+    """
+    file_digest() of filename, remembered on disk under its path, size and
+    modification time.
+    """
+
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    stat_key = '{}\0{}\0{}'.format(path, st.st_size, st.st_mtime_ns)
+    memo = os.path.join(digests_dir(),
+                        hashlib.sha1(stat_key.encode('utf-8')).hexdigest())
+
+    try:
+        with open(memo) as f:
+            digest = f.read().strip()
+        if len(digest) == 40:
+            return digest
+    except (IOError, OSError):
+        pass
+
+    digest = file_digest(path)
+    # The memo is only an optimisation, so failing to write it is fine.
+    try:
+        if not os.path.exists(digests_dir()):
+            os.makedirs(digests_dir())
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_digest_', dir=digests_dir())
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(digest)
+            os.replace(tmp, memo)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except (IOError, OSError):
+        pass
+
+    return digest
+
+
+def make_key(files, *params):
+    """
+    Cache key for a set of grid definition files and extra parameters such as
+    the grid names and regridding method. Files that are None are ignored,
+    a file used twice (e.g. hgrid and vgrid) only counts once.
+    """
+
+    h = hashlib.sha1()
+    seen = set()
+    for filename in files:
+        if filename is None:
+            continue
+        path = os.path.realpath(filename)
+        if path in seen:
+            continue
+        seen.add(path)
+        h.update(cached_digest(path).encode('ascii'))
+    for p in params:
+        h.update(str(p).encode('utf-8'))
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+class WeightsCache(object):
+    """
+    A directory of weights files with a size limit and least recently used
+    eviction.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, 'weights_{}.nc'.format(key))
+
+    def get(self, key):
+        """
+        Return the path of the cached weights for key, or None.
+        """
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        # Mark as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return path
+
+    def tmp_path(self):
+        """
+        A unique path inside the cache directory to generate weights into
+        before they are added with put().
+        """
+
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_weights_', suffix='.nc',
+                                   dir=self.cache_dir)
+        os.close(fd)
+        os.remove(tmp)
+
+        return tmp
+
+    def put(self, key, weights_file):
+        """
+        Move weights_file into the cache and return its new path. The move is
+        atomic when weights_file comes from tmp_path().
+        """
+
+        path = self.path(key)
+        os.replace(weights_file, path)
+        self.evict(keep=path)
+
+        return path
+
+    def array_path(self, key):
+        return os.path.join(self.cache_dir, 'array_{}.npy'.format(key))
+
+    def load_array(self, key, mmap_mode=None):
+        """
+        Return the array cached under key, or None.
+        """
+
+        path = self.array_path(key)
+        try:
+            array = np.load(path, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return array
+
+    def save_array(self, key, array):
+        """
+        Add an array to the cache, atomically.
+        """
+
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_array_', suffix='.npy',
+                                   dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp, self.array_path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict(keep=self.array_path(key))
+
+    def entries(self):
+        """
+        List of (mtime, size, path) for all cached files, oldest first.
+        """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not ((name.startswith('weights_') and name.endswith('.nc')) or
+                    (name.startswith('array_') and name.endswith('.npy'))):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+
+        if self.max_bytes is None:
+            return
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
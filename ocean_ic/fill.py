@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+"""
+Lateral fill of land and missing points before horizontal regridding.
+
+Every masked point takes the value of the nearest valid point, where nearest
+is measured as the straight line distance between points on the unit sphere.
+This is the same ordering as great-circle distance and handles the periodic
+longitude and the poles without special cases.
+"""
+
+def to_cartesian(lon, lat):
+    """
+    3d Cartesian coordinates of points on the unit sphere.
+    """
+
+    lon = np.deg2rad(np.asarray(lon, dtype='f8'))
+    lat = np.deg2rad(np.asarray(lat, dtype='f8'))
+
+    return np.column_stack((np.cos(lat)*np.cos(lon),
+                            np.cos(lat)*np.sin(lon),
+                            np.sin(lat)))
+
+
+def mask_digest(mask):
+    """
+    Short hash of a boolean mask used to recognise masks seen before.
+    """
+
+    mask = np.ascontiguousarray(mask, dtype=bool)
+    h = hashlib.sha1(np.packbits(mask).tobytes())
+    h.update(str(mask.shape).encode('ascii'))
+
+    return h.hexdigest()
+
+
+def fill_masked(data, index):
+    """
+    Replace the masked points of data using an index map from
+    NearestFiller.index(). data is a masked array whose mask is the same on
+    every level.
+    """
+
+    values = np.ma.getdata(data)
+    shape = values.shape
+    values = values.reshape((-1, shape[-2]*shape[-1]))
+
+    return values[:, index].reshape(shape)
+
+
+class NearestFiller(object):
+    """
+    Nearest neighbour fill on a fixed horizontal grid.
+
+    The index map for a mask is built once with a KD-tree and then reused for
+    every level, variable and month with the same mask. If cache is given
+    (a WeightsCache) the index maps are also kept on disk next to the
+    regridding weights, under a key made from cache_key and the mask.
+    """
+
+    def __init__(self, grid, cache=None, cache_key=None):
+
+        self.shape = grid.x_t.shape
+        self.points = to_cartesian(grid.x_t.ravel(), grid.y_t.ravel())
+        self.cache = cache
+        self.cache_key = cache_key
+        self._indices = {}
+
+    def _disk_key(self, digest):
+        h = hashlib.sha1(self.cache_key.encode('ascii'))
+        h.update(digest.encode('ascii'))
+        return h.hexdigest()
+
+    def index(self, mask):
+        """
+        Flat index of the nearest unmasked point for every point of the 2d
+        mask. Unmasked points map to themselves.
+        """
+
+        assert mask.shape == self.shape
+        digest = mask_digest(mask)
+        index = self._indices.get(digest)
+        if index is not None:
+            return index
+
+        use_disk = self.cache is not None and self.cache_key is not None
+        if use_disk:
+            index = self.cache.load_array(self._disk_key(digest))
+
+        if index is None:
+            index = self._build_index(mask.ravel())
+            if use_disk:
+                self.cache.save_array(self._disk_key(digest), index)
+
+        self._indices[digest] = index
+        return index
+
+    def _build_index(self, mask):
+
+        valid = np.flatnonzero(~mask)
+        if valid.size == 0:
+            raise ValueError('Cannot fill, all points are masked.')
+
+        index = np.arange(mask.size)
+        masked = np.flatnonzero(mask)
+        if masked.size > 0:
+            tree = cKDTree(self.points[valid])
+            _, nearest = tree.query(self.points[masked])
+            index[masked] = valid[nearest]
+
+        return index
+
+    def __call__(self, data):
+        """
+        Fill the masked points of data, a masked array whose mask is the same
+        on every level.
+        """
+
+        mask = np.ma.getmaskarray(data)
+        if not np.any(mask):
+            return np.ma.getdata(data)
+
+        return fill_masked(data, self.index(mask.reshape((-1,) + self.shape)[0]))
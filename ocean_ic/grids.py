@@ -0,0 +1,265 @@
+from __future__ import print_function
+
+import numpy as np
+import netCDF4 as nc
+
+"""
+Grid definitions used by the IC pipeline.
+
+The reanalysis and model grids are read once with the esmgrids classes used by
+the regridder and then converted to a plain Grid so that the rest of the
+pipeline only deals with numpy arrays.
+"""
+
+class Grid(object):
+    """
+    Horizontal and vertical definition of a source or destination grid.
+
+    x_t, y_t: 2d arrays of cell centre longitudes and latitudes.
+    levels: 1d array of level depths in metres, positive down.
+    mask: boolean land mask, True over land. Either 2d or 3d.
+    clon_t, clat_t: cell corners with shape (4, ny, nx), anticlockwise.
+    """
+
+    def __init__(self, x_t, y_t, levels, mask=None, clon_t=None, clat_t=None,
+                 area_t=None, description=''):
+
+        self.x_t = np.asarray(x_t)
+        self.y_t = np.asarray(y_t)
+        assert len(self.x_t.shape) == 2
+        assert self.x_t.shape == self.y_t.shape
+
+        self.levels = np.asarray(levels)
+        assert len(self.levels.shape) == 1
+
+        if mask is None:
+            mask = np.zeros(self.x_t.shape, dtype=bool)
+        self.mask = np.asarray(mask, dtype=bool)
+        assert self.mask.shape[-2:] == self.x_t.shape
+
+        self.clon_t = clon_t
+        self.clat_t = clat_t
+        self.area_t = area_t
+        self.description = description
+
+    @property
+    def num_levels(self):
+        return self.levels.shape[0]
+
+    @property
+    def num_lat_points(self):
+        return self.x_t.shape[0]
+
+    @property
+    def num_lon_points(self):
+        return self.x_t.shape[1]
+
+    @property
+    def shape(self):
+        return (self.num_levels, self.num_lat_points, self.num_lon_points)
+
+    def mask_3d(self):
+        """
+        Return the land mask broadcast to all levels.
+        """
+
+        if len(self.mask.shape) == 3:
+            return self.mask
+        return np.broadcast_to(self.mask, self.shape)
+
+
+def _cell_edges(centres, lower=None, upper=None):
+    """
+    Edges of a 1d axis half way between centres, extrapolated at the ends.
+    """
+
+    edges = np.empty(len(centres) + 1)
+    edges[1:-1] = (centres[1:] + centres[:-1]) / 2.0
+    edges[0] = centres[0] - (edges[1] - centres[0])
+    edges[-1] = centres[-1] + (centres[-1] - edges[-2])
+    if lower is not None or upper is not None:
+        edges = np.clip(edges, lower, upper)
+
+    return edges
+
+
+def rectilinear_grid(lons, lats, levels, mask=None, description=''):
+    """
+    Make a Grid from 1d longitude and latitude axes.
+    """
+
+    lons = np.asarray(lons, dtype='f8')
+    lats = np.asarray(lats, dtype='f8')
+
+    x_t, y_t = np.meshgrid(lons, lats)
+
+    lon_edges = _cell_edges(lons)
+    lat_edges = _cell_edges(lats, -90.0, 90.0)
+    x_c, y_c = np.meshgrid(lon_edges, lat_edges)
+
+    # Corners go anticlockwise from the bottom left.
+    clon_t = np.array([x_c[:-1, :-1], x_c[:-1, 1:], x_c[1:, 1:], x_c[1:, :-1]])
+    clat_t = np.array([y_c[:-1, :-1], y_c[:-1, 1:], y_c[1:, 1:], y_c[1:, :-1]])
+
+    return Grid(x_t, y_t, levels, mask, clon_t, clat_t, description=description)
+
+
+def is_rectilinear(grid):
+    """
+    True if the grid centres can be described by 1d lon and lat axes.
+    """
+
+    return np.all(grid.x_t == grid.x_t[0, :]) and \
+        np.all(grid.y_t == grid.y_t[:, :1])
+
+
+def extend_to_poles(grid):
+    """
+    Extend a latitudinally limited rectilinear grid (e.g. GODAS) to cover the
+    whole globe. The new rows are masked so that they are filled from the
+    nearest valid data.
+
+    Returns the global grid and the number of rows added to the south and
+    north.
+    """
+
+    assert is_rectilinear(grid)
+
+    lons = grid.x_t[0, :]
+    lats = grid.y_t[:, 0]
+
+    dlat_s = lats[1] - lats[0]
+    dlat_n = lats[-1] - lats[-2]
+    south = np.arange(lats[0] - dlat_s, -90.0, -dlat_s)[::-1]
+    north = np.arange(lats[-1] + dlat_n, 90.0, dlat_n)
+
+    new_lats = np.concatenate((south, lats, north))
+
+    mask = grid.mask
+    pad = [(0, 0)]*(len(mask.shape) - 2) + [(len(south), len(north)), (0, 0)]
+    mask = np.pad(mask, pad, mode='constant', constant_values=True)
+
+    global_grid = rectilinear_grid(lons, new_lats, grid.levels, mask,
+                                   description=grid.description + ' (global)')
+
+    return global_grid, (len(south), len(north))
+
+
+def extend_data(data, extent):
+    """
+    Pad the last but one (latitude) axis of data with masked rows to match a
+    grid returned by extend_to_poles().
+    """
+
+    south, north = extent
+    pad = [(0, 0)]*(len(data.shape) - 2) + [(south, north), (0, 0)]
+    mask = np.pad(np.ma.getmaskarray(data), pad, mode='constant',
+                  constant_values=True)
+    values = np.pad(np.ma.getdata(data), pad, mode='edge')
+
+    return np.ma.array(values, mask=mask)
+
+
+def write_scrip(grid, filename, use_mask=False):
+    """
+    Write the horizontal part of a grid out as a SCRIP file for
+    ESMF_RegridWeightGen.
+
+    use_mask: mark the points that are land on every level as masked so that
+    no weights are made for them.
+    """
+
+    assert grid.clon_t is not None and grid.clat_t is not None
+
+    ny, nx = grid.x_t.shape
+    with nc.Dataset(filename, 'w') as f:
+        f.title = grid.description
+        f.createDimension('grid_size', nx*ny)
+        f.createDimension('grid_corners', 4)
+        f.createDimension('grid_rank', 2)
+
+        grid_dims = f.createVariable('grid_dims', 'i4', ('grid_rank',))
+        grid_dims[:] = [nx, ny]
+
+        for name in ['grid_center_lat', 'grid_center_lon']:
+            v = f.createVariable(name, 'f8', ('grid_size',))
+            v.units = 'degrees'
+        f.variables['grid_center_lat'][:] = grid.y_t.flatten()
+        f.variables['grid_center_lon'][:] = grid.x_t.flatten()
+
+        # Source data is filled before regridding and the model mask is
+        # applied afterwards so by default nothing is masked here.
+        imask = f.createVariable('grid_imask', 'i4', ('grid_size',))
+        if use_mask:
+            land = grid.mask
+            if len(land.shape) == 3:
+                land = land.all(axis=0)
+            imask[:] = np.where(land.flatten(), 0, 1)
+        else:
+            imask[:] = 1
+
+        for name in ['grid_corner_lat', 'grid_corner_lon']:
+            v = f.createVariable(name, 'f8', ('grid_size', 'grid_corners'))
+            v.units = 'degrees'
+        f.variables['grid_corner_lat'][:] = \
+            grid.clat_t.reshape(4, nx*ny).T
+        f.variables['grid_corner_lon'][:] = \
+            grid.clon_t.reshape(4, nx*ny).T
+
+
+def from_esmgrid(esm_grid):
+    """
+    Convert an esmgrids grid object into a Grid.
+    """
+
+    mask = getattr(esm_grid, 'mask_t', None)
+    if mask is None:
+        mask = getattr(esm_grid, 'mask', None)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+
+    return Grid(esm_grid.x_t, esm_grid.y_t, esm_grid.z, mask,
+                esm_grid.clon_t, esm_grid.clat_t,
+                getattr(esm_grid, 'area_t', None),
+                description=getattr(esm_grid, 'description', ''))
+
+
+def load_src_grid(src_name, src_hgrids, src_vgrid):
+    """
+    Read the reanalysis grid.
+    """
+
+    if src_name == 'ORAS4':
+        from esmgrids.oras_grid import OrasGrid
+        src_grid = OrasGrid(src_hgrids[0], src_vgrid, description='ORAS4')
+    elif src_name == 'GODAS':
+        from esmgrids.godas_grid import GodasGrid
+        src_grid = GodasGrid(src_hgrids[0], src_vgrid, description='GODAS')
+    else:
+        assert src_name == 'WOA'
+        from esmgrids.woa_grid import WoaGrid
+        src_grid = WoaGrid(src_hgrids[0], description='WOA')
+
+    return from_esmgrid(src_grid)
+
+
+def load_dest_grid(dest_name, dest_hgrid, dest_vgrid, dest_mask=None):
+    """
+    Read the model grid.
+    """
+
+    if dest_name == 'MOM':
+        from esmgrids.mom_grid import MomGrid
+        dest_grid = MomGrid.fromfile(dest_hgrid, dest_vgrid,
+                                     mask_file=dest_mask, description='MOM')
+    elif dest_name == 'MOM1':
+        from esmgrids.mom1_grid import Mom1Grid
+        dest_grid = Mom1Grid(dest_hgrid, dest_vgrid, mask_file=dest_mask,
+                             description='MOM1')
+    else:
+        assert dest_name == 'NEMO'
+        from esmgrids.nemo_grid import NemoGrid
+        dest_grid = NemoGrid(dest_hgrid, dest_vgrid, mask_file=dest_mask,
+                             description='NEMO')
+
+    return from_esmgrid(dest_grid)
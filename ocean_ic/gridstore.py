@@ -0,0 +1,205 @@
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from .grids import Grid
+from .cache import default_cache_dir
+
+"""
+Store of grids converted to memory mapped .npy files.
+
+Reading the grid definitions with esmgrids decodes every coordinate and mask
+array from NetCDF, which takes seconds for the large model grids. Once a
+grid has been stored it is opened with np.load(mmap_mode='r') instead, which
+takes milliseconds and lets all the processes on a node share the same
+pages.
+
+Stored grids are keyed by the grid name and the path, size and modification
+time of the grid definition files, so they are remade when a file changes.
+"""
+
+FORMAT_VERSION = 1
+
+ARRAYS = ['x_t', 'y_t', 'levels', 'mask', 'clon_t', 'clat_t', 'area_t']
+
+def default_store_dir():
+    return os.path.join(default_cache_dir(), 'grids')
+
+
+def grid_key(name, files):
+    """
+    Key for grid name read from files. Files that are None are ignored.
+    """
+
+    h = hashlib.sha1('{}\0{}'.format(FORMAT_VERSION, name).encode('utf-8'))
+    for filename in files:
+        if filename is None:
+            continue
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        h.update('\0{}\0{}\0{}'.format(path, st.st_size,
+                                       st.st_mtime_ns).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def save_grid(grid, directory):
+    """
+    Write the arrays of grid as .npy files into directory.
+    """
+
+    arrays = []
+    for name in ARRAYS:
+        array = getattr(grid, name)
+        if array is None:
+            continue
+        np.save(os.path.join(directory, name + '.npy'),
+                np.ascontiguousarray(array))
+        arrays.append(name)
+
+    with open(os.path.join(directory, 'grid.json'), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'arrays': arrays,
+                   'description': grid.description}, f)
+
+
+def load_grid(directory, mmap_mode='r'):
+    """
+    Open a grid written by save_grid(). The arrays are memory mapped and
+    read-only by default.
+    """
+
+    with open(os.path.join(directory, 'grid.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported grid store version {} in {}'.format(
+                         meta['version'], directory))
+
+    files = dict((name, os.path.join(directory, name + '.npy'))
+                 for name in meta['arrays'])
+
+    return open_grid(files, meta['description'], mmap_mode)
+
+
+def open_grid(files, description='', mmap_mode='r'):
+    """
+    Make a grid from a dict of array name to .npy file, see share_grid().
+    """
+
+    arrays = dict((name, np.load(filename, mmap_mode=mmap_mode))
+                  for name, filename in files.items())
+
+    return Grid(arrays['x_t'], arrays['y_t'], arrays['levels'],
+                arrays.get('mask'), arrays.get('clon_t'),
+                arrays.get('clat_t'), arrays.get('area_t'),
+                description=description)
+
+
+def mapped_file(array):
+    """
+    The .npy file that the whole of array is memory mapped from, or None.
+    """
+
+    base = array
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+        base = base.base
+    if not isinstance(base, np.memmap) or base.filename is None or \
+            not base.filename.endswith('.npy'):
+        return None
+
+    if array.shape != base.shape or array.dtype != base.dtype or \
+            array.ctypes.data != base.ctypes.data:
+        return None
+
+    return base.filename
+
+
+def share_grid(grid, directory, prefix):
+    """
+    Files from which other processes can memory map the arrays of grid.
+    Arrays that are already memory mapped, e.g. from the grid store, are
+    shared from their own files, the others are saved in directory with
+    names starting with prefix. Returns a dict for open_grid().
+    """
+
+    files = {}
+    for name in ARRAYS:
+        array = getattr(grid, name)
+        if array is None:
+            continue
+        filename = mapped_file(array)
+        if filename is None:
+            filename = os.path.join(directory, '{}_{}.npy'.format(prefix, name))
+            np.save(filename, np.ascontiguousarray(array))
+        files[name] = filename
+
+    return files
+
+
+class GridStore(object):
+    """
+    A directory of stored grids, one subdirectory per grid.
+    """
+
+    def __init__(self, store_dir=None):
+
+        if store_dir is None:
+            store_dir = default_store_dir()
+        self.store_dir = store_dir
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def path(self, key):
+        return os.path.join(self.store_dir, key)
+
+    def get(self, key):
+        """
+        Return the grid stored under key, or None.
+        """
+
+        path = self.path(key)
+        if not os.path.exists(os.path.join(path, 'grid.json')):
+            return None
+
+        return load_grid(path)
+
+    def put(self, key, grid):
+        """
+        Store grid under key. The grid appears atomically so other processes
+        never see a partly written grid.
+        """
+
+        tmp = tempfile.mkdtemp(prefix='.tmp_grid_', dir=self.store_dir)
+        try:
+            save_grid(grid, tmp)
+            try:
+                os.rename(tmp, self.path(key))
+            except OSError:
+                # Another process stored the same grid first.
+                if not os.path.exists(os.path.join(self.path(key),
+                                                   'grid.json')):
+                    raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        return self.path(key)
+
+    def load(self, name, files, loader, *args):
+        """
+        The grid name read from files, from the store if it is there,
+        otherwise with loader(*args) after which it is added to the store.
+        """
+
+        key = grid_key(name, files)
+        grid = self.get(key)
+        if grid is None:
+            self.put(key, loader(*args))
+            grid = self.get(key)
+
+        return grid
@@ -0,0 +1,214 @@
+from __future__ import print_function
+
+import numpy as np
+import netCDF4 as nc
+from scipy import sparse
+
+from . import output
+from . import profiling
+from .reader import read_src_field
+from .weights import RegridWeights
+
+"""
+Regrid with the destination grid split over MPI ranks.
+
+The destination grid is split into latitude bands, one per rank. Each rank
+holds only the rows of the weight matrix for its band, with the columns
+renumbered to the source points those rows use (the halo of the band).
+
+For every field rank 0 reads the source, does the vertical interpolation
+and lateral fill, which are cheap on the coarse reanalysis grid, and sends
+each rank the source halo it needs. For conservative weights the halo holds
+the masked source, its mask and the filled source, see
+RegridWeights.apply_masked(). The ranks apply their weights and mask
+in parallel and send their band back to rank 0 a level at a time. Rank 0
+puts each level together and writes it whole, so every compressed chunk
+of the output is written once, and parallel NetCDF is not needed.
+
+Run under MPI, e.g.:
+
+    mpirun -n 4 ./makeic.py ... --mpi
+"""
+
+def band_rows(num_rows, size, rank):
+    """
+    The slice of destination rows that belongs to rank.
+    """
+
+    start = (num_rows*rank) // size
+    stop = (num_rows*(rank + 1)) // size
+
+    return slice(start, stop)
+
+
+def local_weights(matrix, rows, num_lons):
+    """
+    The rows of a CSR weight matrix for a band of destination rows, with the
+    columns renumbered to the source halo. Returns the local matrix and the
+    halo, the source points it uses.
+    """
+
+    band = matrix[rows.start*num_lons:rows.stop*num_lons, :]
+    halo = np.unique(band.indices)
+    indices = np.searchsorted(halo, band.indices).astype(band.indices.dtype)
+    local = sparse.csr_matrix((band.data, indices, band.indptr),
+                              shape=(band.shape[0], len(halo)))
+
+    return local, halo
+
+
+class DistributedRegridder(object):
+    """
+    The part of a RegridPipeline held by each rank of comm.
+
+    pipeline: the RegridPipeline on rank 0, ignored on other ranks.
+    """
+
+    def __init__(self, comm, pipeline=None):
+
+        self.comm = comm
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+
+        if rank == 0:
+            self.pipeline = pipeline
+            dest_grid = pipeline.dest_grid
+            dest_mask = pipeline.dest_mask
+            info = {'shape': dest_grid.shape, 'dtype': pipeline.dtype,
+                    'batch_levels': pipeline.batch_levels,
+                    'method': pipeline.method}
+        else:
+            self.pipeline = None
+            info = None
+        info = comm.bcast(info, root=0)
+
+        self.shape = info['shape']
+        self.dtype = info['dtype']
+        self.batch_levels = info['batch_levels']
+        self.method = info['method']
+        num_lons = self.shape[2]
+
+        # Rank 0 splits the weights and mask and sends each rank its part.
+        if rank == 0:
+            self.halos = []
+            matrix = pipeline.weights.matrix
+            for r in range(size):
+                rows = band_rows(self.shape[1], size, r)
+                local, halo = local_weights(matrix, rows, num_lons)
+                mask = np.ascontiguousarray(dest_mask[:, rows, :])
+                self.halos.append(halo)
+                if r == 0:
+                    part = (local, mask)
+                else:
+                    comm.send((local, mask), dest=r, tag=1)
+        else:
+            part = comm.recv(source=0, tag=1)
+
+        local, self.mask = part
+        self.rows = band_rows(self.shape[1], size, rank)
+        self.weights = RegridWeights.from_csr(local)
+
+    def regrid_band(self, data=None, var=None):
+        """
+        Regrid this rank's band of one field. data is the prepared source
+        field, see RegridPipeline.prepare(), and is only needed on rank 0.
+        Returns a masked (levels, band rows, lons) array.
+        """
+
+        comm = self.comm
+        if comm.Get_rank() == 0:
+            if self.method == 'conserve':
+                valid = ~np.ma.getmaskarray(data)
+                values = np.where(valid, np.ma.getdata(data), 0)
+                data = np.concatenate((values, valid.astype(values.dtype),
+                                       self.pipeline.fill(data)))
+            for r in range(1, comm.Get_size()):
+                halo = np.ascontiguousarray(data[:, self.halos[r]])
+                comm.send((halo.shape, halo.dtype.str), dest=r, tag=2)
+                comm.Send(halo, dest=r, tag=3)
+            halo = data[:, self.halos[0]]
+        else:
+            shape, dtype = comm.recv(source=0, tag=2)
+            halo = np.empty(shape, dtype=dtype)
+            comm.Recv(halo, source=0, tag=3)
+
+        with profiling.stage('apply_weights', var=var):
+            if self.method == 'conserve':
+                values, valid, filled = np.split(halo, 3)
+                mask = self.mask.reshape((self.mask.shape[0], -1))
+                dest = self.weights.apply_masked(
+                            np.ma.array(values, mask=(valid == 0)),
+                            lambda: filled, mask, self.batch_levels)
+            else:
+                dest = self.weights.apply_levels(halo, self.batch_levels)
+            dest = dest.reshape(self.mask.shape).astype(self.dtype, copy=False)
+
+        return np.ma.array(dest, mask=self.mask)
+
+    def regrid_fields(self, fields, output_file, model_name, month=1,
+                      mom_version='MOM5', encoding=None):
+        """
+        Like pipeline.regrid_fields(), called on every rank.
+        """
+
+        comm = self.comm
+        rank = comm.Get_rank()
+
+        f = None
+        if rank == 0:
+            f = nc.Dataset(output_file, 'w')
+            output.create_ic(f, model_name, self.pipeline.dest_grid,
+                             mom_version)
+        try:
+            for src_file, src_var, dest_var in fields:
+                data = None
+                if rank == 0:
+                    with profiling.stage('read', var=dest_var):
+                        src_data, units, long_name = \
+                            read_src_field(src_file, src_var, month)
+                    data = self.pipeline.prepare(src_data, dest_var)
+
+                band = self.regrid_band(data, dest_var)
+
+                if rank == 0:
+                    with profiling.stage('write', var=dest_var):
+                        self._write(f, model_name, dest_var, band, units,
+                                    long_name, encoding)
+                else:
+                    for k in range(band.shape[0]):
+                        comm.Send(np.ascontiguousarray(band.data[k]), dest=0,
+                                  tag=5)
+        finally:
+            if f is not None:
+                f.close()
+
+    def _write(self, f, model_name, var_name, band, units, long_name,
+               encoding):
+        """
+        Write the field a level at a time, putting each level together from
+        the band of rank 0 and those sent by the other ranks. Each level is
+        one chunk of the output, so compressed chunks are written once
+        rather than once per rank.
+        """
+
+        comm = self.comm
+        units, scale, offset = output.unit_conversion(var_name, units)
+        var = output.create_field(f, model_name, var_name, units, long_name,
+                                  encoding=encoding, dtype=self.dtype)
+
+        level = np.empty(self.shape[1:], dtype=self.dtype)
+        for k in range(self.shape[0]):
+            for r in range(comm.Get_size()):
+                rows = band_rows(self.shape[1], comm.Get_size(), r)
+                if r == 0:
+                    level[rows, :] = band.data[k]
+                else:
+                    data = np.empty((rows.stop - rows.start, self.shape[2]),
+                                    dtype=self.dtype)
+                    comm.Recv(data, source=r, tag=5)
+                    level[rows, :] = data
+            # The writer knows the whole mask.
+            output.write_level(f, var, k,
+                               np.ma.array(level,
+                                           mask=self.pipeline.dest_mask[k]),
+                               scale, offset)
@@ -0,0 +1,170 @@
+from __future__ import print_function
+
+import numpy as np
+
+from . import profiling
+from .reader import netcdf_lock
+
+"""
+Create MOM and NEMO initial condition files.
+"""
+
+def dimensions(model_name):
+    """
+    Names of the (time, depth, lat, lon) dimensions used in the IC.
+    """
+
+    if 'MOM' in model_name:
+        return ('time', 'ZT', 'GRID_Y_T', 'GRID_X_T')
+    else:
+        return ('time_counter', 'z', 'y', 'x')
+
+
+def create_ic(f, model_name, dest_grid, mom_version='MOM5'):
+    """
+    Define the dimensions and coordinates of an IC in the open Dataset f.
+    """
+
+    time, depth, lat, lon = dimensions(model_name)
+
+    f.createDimension(time)
+    f.createDimension(depth, dest_grid.num_levels)
+    f.createDimension(lat, dest_grid.num_lat_points)
+    f.createDimension(lon, dest_grid.num_lon_points)
+
+    if 'MOM' in model_name:
+        f.mom_version = mom_version
+
+        x = f.createVariable(lon, 'f8', (lon,))
+        x.long_name = 'Nominal Longitude of T-cell center'
+        x.units = 'degrees_east'
+        x.cartesian_axis = 'X'
+        x[:] = dest_grid.x_t[0, :]
+
+        y = f.createVariable(lat, 'f8', (lat,))
+        y.long_name = 'Nominal Latitude of T-cell center'
+        y.units = 'degrees_north'
+        y.cartesian_axis = 'Y'
+        y[:] = dest_grid.y_t[:, 0]
+
+        z = f.createVariable(depth, 'f8', (depth,))
+        z.long_name = 'zt'
+        z.units = 'meters'
+        z.cartesian_axis = 'Z'
+        z.positive = 'down'
+        z[:] = dest_grid.levels
+
+        t = f.createVariable(time, 'f8', (time,))
+        t.long_name = 'time'
+        t.units = 'days since 0001-01-01 00:00:00'
+        t.calendar = 'NOLEAP'
+        t.cartesian_axis = 'T'
+        t[0] = 0.0
+    else:
+        x = f.createVariable('nav_lon', 'f8', (lat, lon))
+        x.long_name = 'Longitude'
+        x.units = 'degrees_east'
+        x[:] = dest_grid.x_t
+
+        y = f.createVariable('nav_lat', 'f8', (lat, lon))
+        y.long_name = 'Latitude'
+        y.units = 'degrees_north'
+        y[:] = dest_grid.y_t
+
+        z = f.createVariable('deptht', 'f8', (depth,))
+        z.long_name = 'Vertical T levels'
+        z.units = 'm'
+        z.positive = 'down'
+        z[:] = dest_grid.levels
+
+        t = f.createVariable(time, 'f8', (time,))
+        t.long_name = 'Time axis'
+        t.units = 'seconds since 0001-01-01 00:00:00'
+        t[0] = 0.0
+
+
+# Destination variables that may need their units converted.
+SALT_NAMES = ['vosaline', 'salt', 'asalt']
+TEMP_NAMES = ['votemper', 'temp', 'ptemp']
+
+def unit_conversion(var_name, units):
+    """
+    Units of var_name in the IC and the (scale, offset) that convert the
+    regridded values to them. Salt in kg/kg becomes psu and temperature in
+    K becomes C.
+    """
+
+    if var_name in SALT_NAMES and units == 'kg/kg':
+        return 'psu', 1000.0, 0.0
+    if var_name in TEMP_NAMES and units == 'K':
+        return 'C', 1.0, -273.15
+
+    return units, 1.0, 0.0
+
+
+def create_field(f, model_name, var_name, units, long_name='',
+                 fill_value=-1.e20, encoding=None, dtype='f8'):
+    """
+    Create a 4d (time, depth, lat, lon) field in the IC.
+
+    Each level is stored in its own chunk, which is how models read the IC.
+    encoding: optional dict of netCDF4 compression settings: zlib,
+    complevel, shuffle and least_significant_digit.
+    dtype: type of the variable in the file, 'f8' or 'f4'.
+    """
+
+    dims = dimensions(model_name)
+    chunksizes = (1, 1, len(f.dimensions[dims[2]]), len(f.dimensions[dims[3]]))
+
+    kwargs = {}
+    if encoding is not None:
+        kwargs = dict((k, v) for k, v in encoding.items() if v is not None)
+
+    var = f.createVariable(var_name, dtype, dims, fill_value=fill_value,
+                           chunksizes=chunksizes, **kwargs)
+    var.units = units
+    var.long_name = long_name
+    var.missing_value = np.array(fill_value, dtype=var.dtype)
+
+    return var
+
+
+def write_field(f, model_name, var_name, data, units, long_name='',
+                encoding=None, time_index=0, dtype='f8'):
+    """
+    Create var_name and write the 3d masked array data to it one level at a
+    time, converting the units of each level in memory on the way.
+    """
+
+    units, scale, offset = unit_conversion(var_name, units)
+    var = create_field(f, model_name, var_name, units, long_name,
+                       encoding=encoding, dtype=dtype)
+    write_levels(f, var, data, scale, offset, time_index)
+
+    return var
+
+
+def write_levels(f, var, data, scale=1.0, offset=0.0, time_index=0):
+    """
+    Write the 3d masked array data to the existing var one level at a time,
+    as data*scale + offset.
+    """
+
+    for k in range(data.shape[0]):
+        write_level(f, var, k, data[k, :, :], scale, offset, time_index)
+
+
+def write_level(f, var, k, level, scale=1.0, offset=0.0, time_index=0):
+    """
+    Write the 2d masked array level to level k of var as level*scale +
+    offset.
+    """
+
+    if scale != 1.0:
+        level = level*scale
+    if offset != 0.0:
+        level = level + offset
+    with netcdf_lock:
+        var[time_index, k, :, :] = level
+        profiling.add_bytes(f.filepath(),
+                            written=level.size*var.dtype.itemsize)
@@ -0,0 +1,215 @@
+from __future__ import print_function
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import concurrent.futures as cf
+import netCDF4 as nc
+
+from . import output
+from . import profiling
+from . import update
+from .gridstore import open_grid, share_grid
+from .pipeline import regrid_fields
+from .reader import read_src_field
+from .weights import save_csr, load_csr
+
+"""
+Regrid many fields and ICs with a pool of worker processes.
+
+The workers only read and regrid. The weights and grids are passed to them
+through memory-mapped .npy files rather than being pickled, and all NetCDF
+output is done by the parent process.
+"""
+
+_pipeline = None
+_profile = False
+
+# Grids of a pipeline that are shared with the workers by file.
+GRIDS = ['src_grid', 'global_src_grid', 'dest_grid']
+
+def _init_worker(pipeline, shared_dir, grid_files, profile):
+
+    global _pipeline, _profile
+
+    pipeline.weights = load_csr(shared_dir)
+    for name, (files, description) in grid_files.items():
+        setattr(pipeline, name, open_grid(files, description))
+    pipeline.dest_mask = pipeline.dest_grid.mask_3d()
+    _pipeline = pipeline
+    _profile = profile
+
+
+def _regrid_task(src_file, src_var, dest_var, month):
+    """
+    Read and regrid one field. Also returns the profiling report of the task
+    if the parent has an active report.
+    """
+
+    report = profiling.RunReport() if _profile else None
+    with profiling.active(report):
+        with profiling.stage('read', var=dest_var):
+            src_data, units, long_name = read_src_field(src_file, src_var,
+                                                        month)
+        dest_data = _pipeline.regrid(src_data, dest_var)
+
+    if report is not None:
+        report = {'stages': report.stages, 'files': report.files}
+    return dest_data, units, long_name, report
+
+
+def _ic_task(fields, output_file, model_name, month, mom_version, encoding,
+             stamp=None):
+    """
+    Make a whole IC in a worker, see regrid_fields(). The IC is written to a
+    temporary file that is renamed once complete. stamp is the
+    (parameters, mask) to record in the IC for later updates, see
+    update.stamp_ic(). Returns the time the task started and how long it
+    took.
+    """
+
+    start = time.time()
+    tmp_file = output_file + '.tmp'
+    try:
+        regrid_fields(_pipeline, fields, tmp_file, model_name, month,
+                      mom_version, encoding)
+        if stamp is not None:
+            parameters, mask = stamp
+            update.stamp_ic(tmp_file, parameters, fields, month, mask)
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return start, time.time() - start
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes which each hold a copy of pipeline. The
+    weights and grids are shared between them through memory-mapped files;
+    grids that are already mapped from the grid store are shared from there.
+    Only the 2d model mask is passed, each worker broadcasts it to 3d.
+    """
+
+    def __init__(self, pipeline, workers, profile=False):
+
+        self.shared_dir = tempfile.mkdtemp(prefix='ocean_ic_weights_')
+        try:
+            save_csr(pipeline.weights, self.shared_dir)
+            worker_pipeline = copy.copy(pipeline)
+            worker_pipeline.weights = None
+            worker_pipeline.dest_mask = None
+            grid_files = {}
+            for name in GRIDS:
+                grid = getattr(pipeline, name)
+                grid_files[name] = (share_grid(grid, self.shared_dir, name),
+                                    grid.description)
+                setattr(worker_pipeline, name, None)
+
+            self.executor = cf.ProcessPoolExecutor(workers,
+                                initializer=_init_worker,
+                                initargs=(worker_pipeline, self.shared_dir,
+                                          grid_files, profile))
+        except Exception:
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+            raise
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def close(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _OpenIC(object):
+    """
+    An output file that is still waiting for some of its fields.
+    """
+
+    def __init__(self, output_file, num_fields, model_name, dest_grid,
+                 mom_version):
+
+        self.output_file = output_file
+        self.remaining = num_fields
+        self.f = nc.Dataset(output_file, 'w')
+        output.create_ic(self.f, model_name, dest_grid, mom_version)
+
+
+def regrid_ics_parallel(pipeline, ics, model_name, workers, mom_version='MOM5',
+                        on_complete=None, max_pending=None, encoding=None):
+    """
+    Regrid ICs using a pool of workers processes.
+
+    ics: list of (output_file, fields, month), fields as for regrid_fields().
+    on_complete: called with the output file name after each IC is written
+    and closed.
+    max_pending: maximum number of fields being worked on or waiting to be
+    written, this bounds memory use. Defaults to twice the number of workers.
+    encoding: compression settings passed to output.create_field().
+    """
+
+    if max_pending is None:
+        max_pending = 2*workers
+
+    tasks = [(output_file, src_file, src_var, dest_var, month)
+             for output_file, fields, month in ics
+             for src_file, src_var, dest_var in fields]
+    num_fields = {}
+    for output_file, fields, _ in ics:
+        num_fields[output_file] = len(fields)
+
+    report = profiling.get_report()
+    open_ics = {}
+    try:
+        with WorkerPool(pipeline, workers, report is not None) as pool:
+            pending = {}
+            tasks = iter(tasks)
+            while True:
+                for task in tasks:
+                    output_file, src_file, src_var, dest_var, month = task
+                    future = pool.submit(_regrid_task, src_file, src_var,
+                                         dest_var, month)
+                    pending[future] = (output_file, dest_var)
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    output_file, dest_var = pending.pop(future)
+                    dest_data, units, long_name, task_report = future.result()
+                    if task_report is not None:
+                        report.merge(task_report)
+
+                    ic = open_ics.get(output_file)
+                    if ic is None:
+                        ic = _OpenIC(output_file, num_fields[output_file],
+                                     model_name, pipeline.dest_grid,
+                                     mom_version)
+                        open_ics[output_file] = ic
+
+                    with profiling.stage('write', var=dest_var):
+                        output.write_field(ic.f, model_name, dest_var,
+                                           dest_data, units, long_name,
+                                           encoding, dtype=pipeline.dtype)
+
+                    ic.remaining -= 1
+                    if ic.remaining == 0:
+                        ic.f.close()
+                        del open_ics[output_file]
+                        if on_complete is not None:
+                            on_complete(output_file)
+    finally:
+        for ic in open_ics.values():
+            ic.f.close()
@@ -0,0 +1,277 @@
+from __future__ import print_function
+
+import os
+import tempfile
+import numpy as np
+import netCDF4 as nc
+
+from . import grids
+from . import output
+from . import profiling
+from .fill import NearestFiller
+from .reader import SourceField, read_src_field, prefetch
+from .vertical import VerticalInterpolator
+from .weights import RegridWeights, read_weights, generate_weights
+
+"""
+Regrid several reanalysis fields onto a model grid in one pass.
+
+The grids, vertical interpolation and horizontal weights are set up once by
+RegridPipeline and then applied to every field.
+
+A pipeline made with stream=True takes each field through all the stages a
+model level at a time: read, vertical interpolation, fill, weights, mask
+and write. Then level k is written before level k + 1 is made. The source
+levels are read ahead on a background thread, so memory use is a few 2d
+levels however deep the grid.
+"""
+
+# Number of source levels read ahead when streaming.
+PREFETCH_LEVELS = 2
+
+class RegridPipeline(object):
+    """
+    Everything needed to take a reanalysis field to the model grid.
+
+    regrid_weights: ESMF weights file to use. It is created if it doesn't
+    exist. If None the weights are taken from weights_cache under
+    cache_key, or generated into a new file in the current directory.
+    method: ESMF regridding method. With conservative ('conserve') weights
+    source land is left out rather than filled: each model cell gets the
+    area weighted mean of the source ocean it overlaps, and only cells that
+    overlap no source ocean are regridded from the filled source.
+    dtype: precision of the whole pipeline, 'f4' halves the memory used
+    and the size of the output.
+    weights_dtype: precision the weights are held in, defaults to dtype.
+    batch_levels: number of levels regridded by each sparse product.
+    stream: regrid_fields() works a level at a time, see regrid_levels().
+    """
+
+    def __init__(self, src_name, src_grid, dest_grid, regrid_weights=None,
+                 use_mpi=False, method='bilinear', weights_cache=None,
+                 cache_key=None, dtype='f8', weights_dtype=None,
+                 batch_levels=16, stream=False):
+
+        self.src_name = src_name
+        self.src_grid = src_grid
+        self.dest_grid = dest_grid
+        self.dtype = np.dtype(dtype)
+        if weights_dtype is None:
+            weights_dtype = self.dtype
+
+        # GODAS is limited latitudinally so extend it to cover the globe.
+        if src_name == 'GODAS':
+            self.global_src_grid, self.extent = grids.extend_to_poles(src_grid)
+        else:
+            self.global_src_grid, self.extent = src_grid, None
+
+        self.vertical = VerticalInterpolator(src_grid.levels,
+                                             dest_grid.levels, self.dtype)
+
+        # weights_cached is True when existing weights came from the cache,
+        # weights_in_cache when the weights file belongs to the cache and
+        # must not be removed.
+        self.weights_cached = False
+        self.weights_in_cache = False
+        if regrid_weights is None and weights_cache is not None:
+            assert cache_key is not None
+            regrid_weights = weights_cache.get(cache_key)
+            self.weights_cached = regrid_weights is not None
+            if regrid_weights is None:
+                tmp = weights_cache.tmp_path()
+                try:
+                    generate_weights(self.global_src_grid, dest_grid, tmp,
+                                     method, use_mpi)
+                    regrid_weights = weights_cache.put(cache_key, tmp)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+            self.weights_in_cache = True
+
+        if regrid_weights is None:
+            fd, regrid_weights = tempfile.mkstemp(prefix='regrid_weights_',
+                                                  suffix='.nc', dir='.')
+            os.close(fd)
+            os.remove(regrid_weights)
+        if not os.path.exists(regrid_weights):
+            generate_weights(self.global_src_grid, dest_grid, regrid_weights,
+                             method, use_mpi)
+        self.weights_file = regrid_weights
+        self.method = method
+        self.weights = read_weights(regrid_weights, weights_dtype,
+                                    normalize=(method == 'conserve'))
+        self.batch_levels = batch_levels
+        self.stream = stream
+
+        assert self.weights.n_a == self.global_src_grid.x_t.size
+        assert self.weights.n_b == dest_grid.x_t.size
+
+        self.dest_mask = dest_grid.mask_3d()
+
+        # Nearest neighbour fill of land and missing source points. The fill
+        # index maps are cached with the weights when there is a cache.
+        self.filler = NearestFiller(self.global_src_grid, weights_cache,
+                                    cache_key)
+
+    def prepare(self, src_data, var=None):
+        """
+        The source side of regrid(): vertical interpolation and lateral fill.
+        Returns a (levels, source points) array ready for the weights. For
+        conserve the fill is left to apply_weights() and the array is
+        masked.
+        """
+
+        with profiling.stage('vertical', var=var):
+            data = self.vertical(src_data)
+        with profiling.stage('lateral_fill', var=var):
+            if self.extent is not None:
+                data = grids.extend_data(data, self.extent)
+            if self.method != 'conserve':
+                data = self.filler(data)
+
+        return data.reshape((data.shape[0], -1))
+
+    def fill(self, data):
+        """
+        Lateral fill of a masked (levels, source points) array from
+        prepare().
+        """
+
+        shape = (data.shape[0],) + self.global_src_grid.x_t.shape
+        return self.filler(data.reshape(shape)).reshape(data.shape)
+
+    def apply_weights(self, data, dest_mask, weights=None, var=None):
+        """
+        Apply weights, by default all of them, to data from prepare().
+        dest_mask is the model mask of the rows of the weights, with levels
+        first. Returns an unmasked (levels, destination points) array.
+        """
+
+        if weights is None:
+            weights = self.weights
+
+        if self.method != 'conserve':
+            with profiling.stage('apply_weights', var=var):
+                return weights.apply_levels(data, self.batch_levels)
+
+        def fill():
+            with profiling.stage('lateral_fill', var=var):
+                return self.fill(data)
+
+        with profiling.stage('apply_weights', var=var):
+            dest_mask = dest_mask.reshape((dest_mask.shape[0], -1))
+            return weights.apply_masked(data, fill, dest_mask,
+                                        self.batch_levels)
+
+    def regrid(self, src_data, var=None):
+        """
+        Regrid a single 3d reanalysis field, returns a masked array on the
+        model grid. var is only used to label profiling stages.
+        """
+
+        data = self.prepare(src_data, var)
+
+        dest = self.apply_weights(data, self.dest_mask, var=var)
+        dest = dest.reshape(self.dest_grid.shape).astype(self.dtype,
+                                                          copy=False)
+
+        with profiling.stage('mask', var=var):
+            return np.ma.array(dest, mask=self.dest_mask)
+
+    def regrid_levels(self, src_levels, var=None):
+        """
+        Streaming regrid(). src_levels is an iterable of the 2d source
+        levels from the surface down, and the model levels are yielded one
+        at a time as 2d masked arrays. The vertical stage includes waiting
+        for the source levels.
+        """
+
+        levels = self.vertical.levels(src_levels)
+        for k in range(self.dest_grid.shape[0]):
+            with profiling.stage('vertical', var=var):
+                data = next(levels)
+            with profiling.stage('lateral_fill', var=var):
+                if self.extent is not None:
+                    data = grids.extend_data(data, self.extent)
+                if self.method != 'conserve':
+                    data = self.filler(data)
+            dest = self.apply_weights(data.reshape((1, -1)),
+                                      self.dest_mask[k:k + 1], var=var)
+            dest = dest.reshape(self.dest_grid.shape[1:])
+            dest = dest.astype(self.dtype, copy=False)
+            with profiling.stage('mask', var=var):
+                dest = np.ma.array(dest, mask=self.dest_mask[k])
+            yield dest
+
+    def regrid_columns(self, src_data, columns, var=None):
+        """
+        Regrid only the destination columns with the given flat horizontal
+        indices. Returns an unmasked (levels, len(columns)) array.
+        """
+
+        columns = np.asarray(columns)
+        data = self.prepare(src_data, var)
+
+        num_levels = self.dest_grid.shape[0]
+        rows = RegridWeights.from_csr(self.weights.matrix[columns, :])
+        dest_mask = self.dest_mask.reshape((num_levels, -1))[:, columns]
+        dest = self.apply_weights(data, dest_mask, rows, var)
+
+        return dest.astype(self.dtype, copy=False)
+
+
+def regrid_field(pipeline, f, model_name, src_file, src_var, dest_var,
+                 month=1, encoding=None):
+    """
+    Regrid one field into the open IC f. The variable is created unless it
+    is there already. With pipeline.stream the field is read, regridded and
+    written a level at a time, otherwise all at once.
+    """
+
+    if pipeline.stream:
+        field = SourceField(src_file, src_var)
+        units, long_name = field.units, field.long_name
+        src_levels = prefetch(field.read_levels(field.time_index(month)),
+                              PREFETCH_LEVELS)
+        levels = pipeline.regrid_levels(src_levels, dest_var)
+    else:
+        with profiling.stage('read', var=dest_var):
+            src_data, units, long_name = read_src_field(src_file, src_var,
+                                                        month)
+        dest_data = pipeline.regrid(src_data, dest_var)
+
+    units, scale, offset = output.unit_conversion(dest_var, units)
+    var = f.variables.get(dest_var)
+    if var is None:
+        var = output.create_field(f, model_name, dest_var, units, long_name,
+                                  encoding=encoding, dtype=pipeline.dtype)
+
+    if pipeline.stream:
+        try:
+            for k, level in enumerate(levels):
+                with profiling.stage('write', var=dest_var):
+                    output.write_level(f, var, k, level, scale, offset)
+        finally:
+            src_levels.close()
+    else:
+        with profiling.stage('write', var=dest_var):
+            output.write_levels(f, var, dest_data, scale, offset)
+
+    return var
+
+
+def regrid_fields(pipeline, fields, output_file, model_name, month=1,
+                  mom_version='MOM5', encoding=None):
+    """
+    Regrid fields and write them all to output_file.
+
+    fields: list of (src_file, src_var, dest_var) tuples.
+    encoding: compression settings passed to output.create_field().
+    """
+
+    with nc.Dataset(output_file, 'w') as f:
+        output.create_ic(f, model_name, pipeline.dest_grid, mom_version)
+
+        for src_file, src_var, dest_var in fields:
+            regrid_field(pipeline, f, model_name, src_file, src_var, dest_var,
+                         month, encoding)
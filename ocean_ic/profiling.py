@@ -0,0 +1,211 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import resource
+import contextlib
+
+"""
+Per-stage timing and memory instrumentation.
+
+A RunReport collects the wall time, CPU time and peak RSS of each pipeline
+stage, the bytes read and written per file and other facts about a run such
+as whether the weights came from the cache. The pipeline records into the
+active report, if there is one, through stage(), add_bytes() and
+set_info(), so they cost nothing when no report is active.
+
+Usage from Python:
+
+    report = RunReport()
+    with profiling.active(report):
+        ... make ICs ...
+    report.write('report.json')
+"""
+
+_report = None
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process, if the OS allows it (Linux >= 4.0).
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    """
+    Peak RSS of this process in MB.
+    """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere.
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0**2
+    return maxrss / 1024.0
+
+
+class RunReport(object):
+    """
+    Metrics for one run of the IC tool.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.files = {}
+        self.info = {}
+        self.start = time.time()
+        # Peak RSS of the run up to the last reset and the number of stages
+        # currently open.
+        self.peak_rss_mb = 0.0
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """
+        Time the enclosed block and record its peak RSS. labels, e.g. the
+        variable name, are stored with the stage.
+
+        The peak RSS is only reset at the start of an outermost stage, so a
+        nested stage doesn't lose the peak of the stage around it.
+        """
+
+        peak_is_stage = False
+        if self.depth == 0:
+            self.peak_rss_mb = max(self.peak_rss_mb, _peak_rss_mb())
+            peak_is_stage = _reset_peak_rss()
+        self.depth += 1
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            record = {'stage': name,
+                      'wall_time': time.perf_counter() - wall,
+                      'cpu_time': time.process_time() - cpu,
+                      'peak_rss_mb': _peak_rss_mb(),
+                      # False if peak_rss_mb is the peak of the whole process
+                      # or of the enclosing stage so far rather than of this
+                      # stage.
+                      'peak_rss_is_stage': peak_is_stage,
+                      'pid': os.getpid()}
+            record.update(labels)
+            self.stages.append(record)
+
+    def add_bytes(self, filename, read=0, written=0):
+        counts = self.files.setdefault(filename, {'bytes_read': 0,
+                                                  'bytes_written': 0})
+        counts['bytes_read'] += read
+        counts['bytes_written'] += written
+
+    def merge(self, other):
+        """
+        Add the stages and file counts of a report from another process.
+        """
+
+        self.stages.extend(other['stages'])
+        for filename, counts in other['files'].items():
+            self.add_bytes(filename, counts['bytes_read'],
+                           counts['bytes_written'])
+
+    def totals(self):
+        """
+        Wall and CPU time summed by stage name.
+        """
+
+        totals = {}
+        for s in self.stages:
+            t = totals.setdefault(s['stage'], {'wall_time': 0.0,
+                                               'cpu_time': 0.0,
+                                               'peak_rss_mb': 0.0,
+                                               'count': 0})
+            t['wall_time'] += s['wall_time']
+            t['cpu_time'] += s['cpu_time']
+            t['peak_rss_mb'] = max(t['peak_rss_mb'], s['peak_rss_mb'])
+            t['count'] += 1
+
+        return totals
+
+    def as_dict(self):
+        return {'info': self.info,
+                'total_wall_time': time.time() - self.start,
+                'peak_rss_mb': max(self.peak_rss_mb, _peak_rss_mb()),
+                'stages': self.stages,
+                'totals': self.totals(),
+                'files': self.files}
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def summary(self):
+        """
+        A human readable table of the time spent in each stage.
+        """
+
+        lines = ['{:<20} {:>6} {:>10} {:>10} {:>12}'.format(
+                    'stage', 'count', 'wall (s)', 'cpu (s)', 'peak (MB)')]
+        for name, t in sorted(self.totals().items(),
+                              key=lambda kv: -kv[1]['wall_time']):
+            lines.append('{:<20} {:>6} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+                         name, t['count'], t['wall_time'], t['cpu_time'],
+                         t['peak_rss_mb']))
+        for key, value in sorted(self.info.items()):
+            lines.append('{}: {}'.format(key, value))
+
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def active(report):
+    """
+    Make report the active report within the enclosed block.
+    """
+
+    global _report
+
+    previous = _report
+    _report = report
+    try:
+        yield report
+    finally:
+        _report = previous
+
+
+def get_report():
+    return _report
+
+
+def stage(name, **labels):
+    """
+    Record a stage in the active report, does nothing if there isn't one.
+    """
+
+    if _report is None:
+        return contextlib.nullcontext()
+    return _report.stage(name, **labels)
+
+
+def add_bytes(filename, read=0, written=0):
+    if _report is not None:
+        _report.add_bytes(filename, read, written)
+
+
+def set_info(key, value):
+    if _report is not None:
+        _report.info[key] = value
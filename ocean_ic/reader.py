@@ -0,0 +1,243 @@
+from __future__ import print_function
+
+import glob
+import queue
+import threading
+import numpy as np
+import netCDF4 as nc
+
+from . import profiling
+
+"""
+Read single time slices of reanalysis fields.
+
+Only the requested time slice is read, one level at a time, so memory use
+is bounded by a single 3d field no matter how many months the files hold,
+or by a single level with read_levels(). A
+field may be spread over several files along the time axis, e.g. ORAS4
+archives with one file per month; these are opened one at a time rather
+than concatenated.
+"""
+
+# The netCDF library is not thread safe. Reads on a prefetch() thread and
+# writes on the main thread both hold this lock.
+netcdf_lock = threading.RLock()
+
+def expand_files(src_files):
+    """
+    Turn a file name, glob pattern or list of either into a sorted list of
+    file names.
+    """
+
+    if isinstance(src_files, (list, tuple)):
+        patterns = src_files
+    else:
+        patterns = [src_files]
+
+    files = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise IOError('No files match {}'.format(pattern))
+            files.extend(matches)
+        else:
+            files.append(pattern)
+
+    return files
+
+
+def unpacked_dtype(var):
+    """
+    dtype of the values of var once netCDF4 has applied scale_factor and
+    add_offset, which may differ from the packed dtype on disk.
+    """
+
+    packing = [np.asarray(var.getncattr(a)) for a in ['scale_factor',
+                                                      'add_offset']
+               if a in var.ncattrs()]
+    if not packing:
+        return var.dtype
+
+    dtype = np.result_type(*packing)
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.dtype('f8')
+    return dtype
+
+
+class SourceField(object):
+    """
+    A reanalysis variable, possibly split over several files along time.
+
+    Nothing is read until read_time() is called, apart from the length of
+    the time axis in each file.
+    """
+
+    def __init__(self, src_files, var_name):
+
+        self.files = expand_files(src_files)
+        self.var_name = var_name
+
+        # (file, number of time steps) for each file.
+        self.time_extents = []
+        for filename in self.files:
+            with nc.Dataset(filename) as f:
+                var = f.variables[var_name]
+                if len(var.shape) == 4:
+                    self.time_extents.append((filename, var.shape[0]))
+                else:
+                    assert len(var.shape) == 3
+                    self.time_extents.append((filename, None))
+                if filename == self.files[0]:
+                    self.units = getattr(var, 'units', '')
+                    self.long_name = getattr(var, 'long_name', var_name)
+                    self.level_shape = var.shape[-3:]
+                    self.dtype = unpacked_dtype(var)
+
+    @property
+    def num_times(self):
+        return sum(n if n is not None else 1 for _, n in self.time_extents)
+
+    def locate(self, t):
+        """
+        File and time index within that file of global time index t.
+        """
+
+        for filename, n in self.time_extents:
+            n = n if n is not None else 1
+            if t < n:
+                return filename, t
+            t -= n
+
+        raise IndexError('Time index out of range for {}'.format(self.var_name))
+
+    def time_index(self, month=1):
+        """
+        Time index of month. The files must hold 12 months, or a single
+        time which is used for every month. Anything else, e.g. several
+        years, raises a ValueError rather than silently using the first
+        year; use read_time() with an explicit time index instead.
+        """
+
+        if self.num_times == 1:
+            return 0
+        if self.num_times != 12:
+            raise ValueError('{} has {} times in {}, expected 12 months or a '
+                             'single time'.format(self.var_name,
+                                                  self.num_times,
+                                                  ', '.join(self.files)))
+
+        return month - 1
+
+    def read_levels(self, t):
+        """
+        Generator of the levels of time index t as 2d masked arrays, read
+        one at a time.
+        """
+
+        filename, t = self.locate(t)
+
+        with netcdf_lock:
+            f = nc.Dataset(filename)
+        try:
+            var = f.variables[self.var_name]
+            for k in range(self.level_shape[0]):
+                with netcdf_lock:
+                    if len(var.shape) == 4:
+                        level = var[t, k, :, :]
+                    else:
+                        level = var[k, :, :]
+                profiling.add_bytes(filename, read=np.ma.getdata(level).nbytes)
+                yield np.ma.array(np.ma.getdata(level),
+                                  mask=np.ma.getmaskarray(level))
+        finally:
+            with netcdf_lock:
+                f.close()
+
+    def read_time(self, t, out=None):
+        """
+        Read time index t into a masked array, level by level.
+        """
+
+        if out is None:
+            data = np.empty(self.level_shape, dtype=self.dtype)
+        else:
+            data = out
+        mask = np.zeros(self.level_shape, dtype=bool)
+
+        for k, level in enumerate(self.read_levels(t)):
+            data[k, :, :] = level.data
+            mask[k, :, :] = level.mask
+
+        return np.ma.array(data, mask=mask, copy=False)
+
+    def read_month(self, month=1):
+        """
+        Read one month, see time_index().
+        """
+
+        return self.read_time(self.time_index(month))
+
+
+def prefetch(items, size=2):
+    """
+    Iterate over items on a background thread, keeping up to size of them
+    ready ahead of the caller, so that e.g. reading the next level overlaps
+    with the work done on this one. Errors are raised in the caller. Closing
+    the returned generator stops the thread.
+    """
+
+    ready = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = ready.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_src_field(src_file, src_var, month=1):
+    """
+    Read one month of a 3d reanalysis field.
+
+    src_file may be a file name, glob pattern or list of files.
+    Returns the masked data and the units and long_name attributes.
+    """
+
+    field = SourceField(src_file, src_var)
+
+    return field.read_month(month), field.units, field.long_name
@@ -0,0 +1,236 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import socketserver
+import http.client
+import http.server
+
+from . import parallel
+
+"""
+Make ICs on request with the grids and regridding weights kept loaded.
+
+An ICServer holds a pool of worker processes that each have the pipeline
+for one reanalysis and model grid pair. Jobs are accepted over a UNIX
+socket, one JSON object per line, or over HTTP as the JSON body of a POST.
+A job names the reanalysis files, the month and the output file:
+
+    {"temp_file": "pottmp.2016.nc", "salt_file": "salt.2016.nc",
+     "month": 3, "output_file": "ic_201603.nc"}
+
+and the reply gives the status and latency of the job:
+
+    {"status": "ok", "output_file": "ic_201603.nc", "latency": 2.1,
+     "queue_time": 0.0, "run_time": 2.1}
+
+{"command": "stats"} (or GET over HTTP) returns the number of jobs done
+and their latencies. A job whose output file exists or is being made by
+another job is refused. ICs are stamped like those of makeic.py so that
+--update recognises them later. Every worker works on one IC at a time, so memory use
+is bounded by the number of workers no matter how many jobs are queued.
+"""
+
+class ICServer(object):
+    """
+    Run IC jobs on a WorkerPool.
+
+    fields: function of (temp_file, salt_file) that returns the fields to
+    regrid, as for regrid_fields().
+    parameters, mask: what to record in each IC for later updates, see
+    update.stamp_ic(). ICs are not stamped if parameters is None.
+    """
+
+    def __init__(self, pipeline, model_name, fields, workers=1,
+                 mom_version='MOM5', encoding=None, parameters=None,
+                 mask=None):
+
+        self.model_name = model_name
+        self.fields = fields
+        self.mom_version = mom_version
+        self.encoding = encoding
+        self.stamp = None if parameters is None else (parameters, mask)
+        self.pool = parallel.WorkerPool(pipeline, workers)
+
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.failed = 0
+        # Output files of the jobs being worked on.
+        self.writing = set()
+
+    def close(self):
+        self.pool.close()
+
+    def stats(self):
+
+        with self.lock:
+            latencies = list(self.latencies)
+            failed = self.failed
+
+        stats = {'status': 'ok', 'jobs_done': len(latencies),
+                 'jobs_failed': failed}
+        if latencies:
+            stats['mean_latency'] = sum(latencies) / len(latencies)
+            stats['max_latency'] = max(latencies)
+
+        return stats
+
+    def run_job(self, job):
+        """
+        Make the IC described by the job dict and wait for it to finish.
+        Returns the reply dict.
+        """
+
+        if job.get('command') == 'stats':
+            return self.stats()
+
+        try:
+            temp_file = job['temp_file']
+            salt_file = job['salt_file']
+            output_file = job['output_file']
+            month = int(job.get('month', 1))
+        except (KeyError, TypeError, ValueError) as e:
+            return {'status': 'error', 'error': 'Bad job: {}'.format(e)}
+
+        path = os.path.realpath(output_file)
+        with self.lock:
+            if path in self.writing:
+                return {'status': 'error',
+                        'error': 'Output file {} is being made by another '
+                                 'job'.format(output_file)}
+            if os.path.exists(output_file):
+                return {'status': 'error',
+                        'error': 'Output file {} already exists'.format(
+                                 output_file)}
+            self.writing.add(path)
+
+        submitted = time.time()
+        try:
+            future = self.pool.submit(parallel._ic_task,
+                                      self.fields(temp_file, salt_file),
+                                      output_file, self.model_name, month,
+                                      self.mom_version, self.encoding,
+                                      self.stamp)
+            started, run_time = future.result()
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            print('Failed {}: {}'.format(output_file, e), file=sys.stderr)
+            return {'status': 'error', 'error': str(e)}
+        finally:
+            with self.lock:
+                self.writing.discard(path)
+
+        latency = time.time() - submitted
+        with self.lock:
+            self.latencies.append(latency)
+        print('Made {} in {:.2f}s'.format(output_file, latency))
+
+        return {'status': 'ok', 'output_file': output_file,
+                'latency': latency,
+                'queue_time': max(started - submitted, 0.0),
+                'run_time': run_time}
+
+    def run_request(self, body):
+        """
+        Run a job from its JSON text and return the JSON reply.
+        """
+
+        try:
+            job = json.loads(body)
+            if not isinstance(job, dict):
+                raise ValueError('a job must be a JSON object')
+        except ValueError as e:
+            reply = {'status': 'error', 'error': 'Bad request: {}'.format(e)}
+        else:
+            reply = self.run_job(job)
+
+        return json.dumps(reply)
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.ic_server.run_request(line.decode('utf-8'))
+            self.wfile.write(reply.encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def _reply(self, reply):
+        body = reply.encode('utf-8')
+        status = 200 if json.loads(reply)['status'] == 'ok' else 400
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        self._reply(self.server.ic_server.run_request(body))
+
+    def do_GET(self):
+        self._reply(json.dumps(self.server.ic_server.stats()))
+
+    def log_message(self, format, *args):
+        # Jobs are logged by ICServer.
+        pass
+
+
+def listen(ic_server, address):
+    """
+    A socketserver that passes requests on address to ic_server. address is
+    the path of a UNIX socket or a (host, port) tuple for HTTP. Call
+    serve_forever() on the result to start serving.
+    """
+
+    if isinstance(address, tuple):
+        server = http.server.ThreadingHTTPServer(address, _HTTPHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _UnixHandler)
+    server.ic_server = ic_server
+
+    return server
+
+
+def request(address, job, timeout=None):
+    """
+    Send a job dict to the server at address and return the reply dict.
+    """
+
+    body = json.dumps(job)
+    if isinstance(address, tuple):
+        conn = http.client.HTTPConnection(address[0], address[1],
+                                          timeout=timeout)
+        try:
+            conn.request('POST', '/', body,
+                          {'Content-Type': 'application/json'})
+            return json.loads(conn.getresponse().read().decode('utf-8'))
+        finally:
+            conn.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        sock.sendall(body.encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+    finally:
+        sock.close()
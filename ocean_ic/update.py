@@ -0,0 +1,224 @@
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import numpy as np
+import netCDF4 as nc
+
+from . import output
+from . import profiling
+from .pipeline import regrid_field
+from .reader import expand_files, read_src_field
+
+"""
+Bring an existing IC up to date instead of remaking it.
+
+Every IC records what it was made from. The global attribute
+ocean_ic_parameters holds the reanalysis and model names, the regridding
+method, the precision and a hash of the grid definitions. Each variable
+holds a hash of the reanalysis files, variable and month it was regridded
+from (ocean_ic_input) and of the model mask it was masked with
+(ocean_ic_mask). Files are identified by path, size and modification time,
+like the grid store does, so making an IC never reads more of the
+reanalysis than the month it needs.
+
+An update then does the least work that gives the same IC as a fresh run:
+
+- if the parameters differ the whole IC has to be remade,
+- variables that are missing or whose input changed are regridded in full,
+- variables whose mask changed are regridded only in the columns that hold
+  a cell whose mask changed, and only those cells are rewritten,
+- everything else is left alone.
+"""
+
+PARAMETERS_ATTR = 'ocean_ic_parameters'
+INPUT_ATTR = 'ocean_ic_input'
+MASK_ATTR = 'ocean_ic_mask'
+
+def file_key(filename):
+    """
+    Hash of the path, size and modification time of filename.
+    """
+
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    key = '{}\0{}\0{}'.format(path, st.st_size, st.st_mtime_ns)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def input_key(src_file, src_var, month):
+    """
+    Hash of the reanalysis files of a variable and the month used.
+    """
+
+    h = hashlib.sha1()
+    for filename in expand_files(src_file):
+        h.update(file_key(filename).encode('ascii'))
+    h.update('\0{}\0{}'.format(src_var, month).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def mask_key(mask_file):
+    """
+    Hash of the model mask file, which may be None.
+    """
+
+    if mask_file is None:
+        return 'none'
+
+    return file_key(mask_file)
+
+
+def grids_key(src_grid, dest_grid):
+    """
+    Hash of the coordinates and levels of both grids. The destination mask
+    is left out since it is recorded per variable.
+    """
+
+    h = hashlib.sha1()
+    for grid in [src_grid, dest_grid]:
+        for name in ['x_t', 'y_t', 'levels']:
+            h.update(np.ascontiguousarray(getattr(grid, name),
+                                          dtype='f8').tobytes())
+            h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def stamp_var(var, key, mask):
+    var.setncattr(INPUT_ATTR, key)
+    var.setncattr(MASK_ATTR, mask)
+
+
+def stamp_ic(output_file, parameters, fields, month, mask):
+    """
+    Record what the fields of output_file were made from.
+
+    parameters: dict of everything else the IC depends on, see
+    plan_update().
+    """
+
+    with nc.Dataset(output_file, 'r+') as f:
+        f.setncattr(PARAMETERS_ATTR, json.dumps(parameters, sort_keys=True))
+        for src_file, src_var, dest_var in fields:
+            stamp_var(f.variables[dest_var],
+                      input_key(src_file, src_var, month), mask)
+
+
+def plan_update(f, parameters, fields, month, mask):
+    """
+    What has to be redone to bring the open IC f up to date.
+
+    Returns None if the IC was made with other parameters, or with none
+    recorded, and has to be remade. Otherwise a list of (field, action,
+    input_key) for each field, where action is 'all', 'mask' or None if the
+    variable is up to date.
+    """
+
+    if PARAMETERS_ATTR not in f.ncattrs() or \
+            json.loads(f.getncattr(PARAMETERS_ATTR)) != parameters:
+        return None
+
+    plan = []
+    for field in fields:
+        src_file, src_var, dest_var = field
+        key = input_key(src_file, src_var, month)
+        var = f.variables.get(dest_var)
+        if var is None or getattr(var, INPUT_ATTR, None) != key:
+            action = 'all'
+        elif getattr(var, MASK_ATTR, None) != mask:
+            action = 'mask'
+        else:
+            action = None
+        plan.append((field, action, key))
+
+    return plan
+
+
+def changed_cells(var, dest_mask, time_index=0):
+    """
+    Flat horizontal indices, one array per level, of the cells of var that
+    are masked differently to dest_mask.
+    """
+
+    cells = []
+    for k in range(dest_mask.shape[0]):
+        old = np.ma.getmaskarray(var[time_index, k, :, :])
+        cells.append(np.flatnonzero(old != dest_mask[k]))
+
+    return cells
+
+
+def update_cells(f, pipeline, var, src_data, units, cells, time_index=0):
+    """
+    Regrid the columns that hold cells and rewrite those cells of var.
+    Returns the number of cells rewritten.
+    """
+
+    columns = np.unique(np.concatenate(cells))
+    if len(columns) == 0:
+        return 0
+
+    values = pipeline.regrid_columns(src_data, columns, var.name)
+    _, scale, offset = output.unit_conversion(var.name, units)
+
+    with profiling.stage('write', var=var.name):
+        for k, level_cells in enumerate(cells):
+            if len(level_cells) == 0:
+                continue
+            level = var[time_index, k, :, :]
+            data = np.ma.getdata(level).copy()
+            mask = np.ma.getmaskarray(level).copy()
+            new = values[k, np.searchsorted(columns, level_cells)]
+            data.flat[level_cells] = new*scale + offset
+            mask.flat[level_cells] = pipeline.dest_mask[k].flat[level_cells]
+            var[time_index, k, :, :] = np.ma.array(data, mask=mask)
+            profiling.add_bytes(f.filepath(),
+                                written=data.size*var.dtype.itemsize)
+
+    return sum(len(c) for c in cells)
+
+
+def update_ic(pipeline, fields, output_file, model_name, parameters, mask,
+              month=1, encoding=None):
+    """
+    Bring the fields of the existing output_file up to date in place.
+
+    Returns None if the IC has to be remade, see plan_update(), otherwise a
+    list of the (dest_var, action) that were done. A variable is marked out
+    of date while it is rewritten, so an interrupted update is finished by
+    the next one.
+    """
+
+    with nc.Dataset(output_file, 'r+') as f:
+        plan = plan_update(f, parameters, fields, month, mask)
+        if plan is None:
+            return None
+
+        done = []
+        for (src_file, src_var, dest_var), action, key in plan:
+            if action is None:
+                continue
+
+            var = f.variables.get(dest_var)
+            if var is not None:
+                var.setncattr(INPUT_ATTR, '')
+                f.sync()
+
+            if action == 'all':
+                var = regrid_field(pipeline, f, model_name, src_file, src_var,
+                                   dest_var, month, encoding)
+            else:
+                with profiling.stage('read', var=dest_var):
+                    src_data, units, _ = read_src_field(src_file, src_var,
+                                                        month)
+                cells = changed_cells(var, pipeline.dest_mask)
+                update_cells(f, pipeline, var, src_data, units, cells)
+
+            stamp_var(var, key, mask)
+            done.append((dest_var, action))
+
+    return done
@@ -0,0 +1,168 @@
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+
+from .fill import mask_digest
+
+"""
+Linear interpolation of reanalysis columns onto model levels.
+"""
+
+class VerticalInterpolator(object):
+    """
+    Interpolate from src_levels to dest_levels.
+
+    The bracketing source levels and weights only depend on the two level
+    sets so they are calculated once, as a sparse matrix with two entries per
+    row, and every field is interpolated with a single product of this matrix
+    and all of its columns. Where the model is deeper than the valid data in
+    a column the deepest value is extended down; the columns this applies to
+    and their clamped level indices only depend on the mask, so they are
+    kept for each mask seen and reused for every variable and month.
+
+    dtype: precision of the interpolation, fields are converted to it.
+    """
+
+    def __init__(self, src_levels, dest_levels, dtype='f8'):
+
+        src_levels = np.asarray(src_levels, dtype='f8')
+        dest_levels = np.asarray(dest_levels, dtype='f8')
+        assert len(src_levels.shape) == 1 and len(dest_levels.shape) == 1
+        assert np.all(np.diff(src_levels) > 0)
+
+        self.src_levels = src_levels
+        self.dest_levels = dest_levels
+        self.dtype = np.dtype(dtype)
+
+        self._extensions = {}
+
+        if len(src_levels) == 1:
+            self.upper = np.zeros(len(dest_levels), dtype=int)
+            self.lower = self.upper
+            self.weight = np.zeros(len(dest_levels), dtype=self.dtype)
+            self.matrix = self._make_matrix()
+            return
+
+        lower = np.searchsorted(src_levels, dest_levels, side='right')
+        lower = np.clip(lower, 1, len(src_levels) - 1)
+        upper = lower - 1
+
+        weight = (dest_levels - src_levels[upper]) / \
+                    (src_levels[lower] - src_levels[upper])
+        # Don't extrapolate above the shallowest or below the deepest level.
+        self.weight = np.clip(weight, 0.0, 1.0).astype(self.dtype)
+        self.upper = upper
+        self.lower = lower
+        self.matrix = self._make_matrix()
+
+    def _make_matrix(self):
+        """
+        Sparse (dest levels, src levels) interpolation matrix.
+        """
+
+        n = len(self.dest_levels)
+        rows = np.repeat(np.arange(n), 2)
+        cols = np.column_stack((self.upper, self.lower)).ravel()
+        vals = np.column_stack((1.0 - self.weight, self.weight)).ravel()
+
+        # Duplicate entries (upper == lower) are summed.
+        return sp.csr_matrix((vals, (rows, cols)),
+                             shape=(n, len(self.src_levels)),
+                             dtype=self.dtype)
+
+    def extension(self, mask):
+        """
+        The columns of a 3d mask that need the deepest valid value extended
+        down, as (columns, upper, lower, empty): flat column indices, the
+        clamped bracketing levels of those columns and a 2d boolean array of
+        the columns without any valid data.
+        """
+
+        digest = mask_digest(mask)
+        ext = self._extensions.get(digest)
+        if ext is not None:
+            return ext
+
+        valid = ~mask.reshape((mask.shape[0], -1))
+        # Number of contiguous valid levels from the surface.
+        bottom = np.where(valid.all(axis=0), valid.shape[0],
+                          np.argmin(valid, axis=0))
+
+        # Columns where the interpolation would reach below the valid data.
+        columns = np.flatnonzero(bottom <= self.lower.max())
+        deepest = np.maximum(bottom[columns] - 1, 0)[np.newaxis, :]
+        upper = np.minimum(self.upper[:, np.newaxis], deepest)
+        lower = np.minimum(self.lower[:, np.newaxis], deepest)
+        empty = (bottom == 0).reshape(mask.shape[1:])
+
+        ext = (columns, upper, lower, empty)
+        self._extensions[digest] = ext
+        return ext
+
+    def __call__(self, data):
+        """
+        Interpolate a 3d masked array. Columns without any valid data stay
+        masked.
+        """
+
+        assert len(data.shape) == 3
+        assert data.shape[0] == len(self.src_levels)
+
+        values = np.ma.getdata(data).reshape((data.shape[0], -1))
+        values = values.astype(self.dtype, copy=False)
+        columns, upper, lower, empty = \
+            self.extension(np.ma.getmaskarray(data))
+
+        dest = np.asarray(self.matrix.dot(values))
+        if columns.size > 0:
+            short = values[:, columns]
+            w = self.weight[:, np.newaxis]
+            dest[:, columns] = \
+                (1.0 - w)*np.take_along_axis(short, upper, axis=0) + \
+                w*np.take_along_axis(short, lower, axis=0)
+
+        dest = dest.reshape((len(self.dest_levels),) + data.shape[1:])
+        mask = np.broadcast_to(empty, dest.shape)
+        return np.ma.array(dest, mask=mask)
+
+    def levels(self, src_levels):
+        """
+        Interpolate a field given as an iterable of 2d masked source levels
+        from the surface down. Each model level is yielded as a 2d masked
+        array as soon as the source levels it needs have been read, and only
+        those are kept, so memory use doesn't depend on the depth. Gives the
+        same result as __call__().
+        """
+
+        src_levels = iter(src_levels)
+        window = {}
+        read = 0
+
+        for k in range(len(self.dest_levels)):
+            upper, lower = self.upper[k], self.lower[k]
+            while read <= lower:
+                level = next(src_levels)
+                values = np.ma.getdata(level).astype(self.dtype, copy=False)
+                valid = ~np.ma.getmaskarray(level)
+                if read == 0:
+                    empty = ~valid
+                    # Columns valid on every level read so far and their
+                    # deepest value.
+                    contiguous = valid.copy()
+                    deepest = values.copy()
+                else:
+                    contiguous &= valid
+                    np.copyto(deepest, values, where=contiguous)
+                window[read] = values
+                read += 1
+            for j in [j for j in window if j < upper]:
+                del window[j]
+
+            w = self.weight[k]
+            dest = (1.0 - w)*window[upper] + w*window[lower]
+            # Where the valid data ends above the lower level the deepest
+            # value is extended down.
+            np.copyto(dest, deepest, where=~contiguous)
+
+            yield np.ma.array(dest, mask=empty)
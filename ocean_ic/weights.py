@@ -0,0 +1,339 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import multiprocessing as mp
+import subprocess as sp
+import numpy as np
+import netCDF4 as nc
+from scipy import sparse
+
+from . import grids
+from . import profiling
+
+"""
+Generate, read and apply ESMF regridding weights.
+
+Bilinear and nearest neighbour weights from rectilinear sources such as
+GODAS and WOA are calculated here directly; ESMF_RegridWeightGen is only
+used for curvilinear sources and conservative weights. Both are written in
+the ESMF weights file layout.
+"""
+
+# Methods that rectilinear_weights() can do.
+PYTHON_METHODS = ['bilinear', 'neareststod']
+
+class RegridWeights(object):
+    """
+    Sparse regridding weights in the ESMF layout: dest[row] += S*src[col].
+
+    row and col are zero based. The weights are held as a single CSR matrix
+    of shape (n_b, n_a) so that a whole stack of levels can be regridded with
+    one sparse-dense product.
+    """
+
+    def __init__(self, row, col, s, n_a, n_b, dtype='f8'):
+
+        self.n_a = n_a
+        self.n_b = n_b
+
+        matrix = sparse.coo_matrix((np.asarray(s, dtype=dtype),
+                                    (np.asarray(row), np.asarray(col))),
+                                   shape=(n_b, n_a)).tocsr()
+        # Use 32 bit indices wherever they fit, this halves the index memory
+        # on large grids.
+        if max(n_a, n_b, matrix.nnz) < np.iinfo(np.int32).max:
+            matrix.indices = matrix.indices.astype(np.int32)
+            matrix.indptr = matrix.indptr.astype(np.int32)
+        self.matrix = matrix
+
+    @classmethod
+    def from_csr(cls, matrix):
+        """
+        Wrap an existing (n_b, n_a) CSR matrix without copying it.
+        """
+
+        weights = cls.__new__(cls)
+        weights.n_b, weights.n_a = matrix.shape
+        weights.matrix = matrix
+
+        return weights
+
+    def scale_rows(self, scale):
+        """
+        Multiply the weights of each destination point by scale, in place.
+        """
+
+        m = self.matrix
+        m.data *= np.repeat(np.asarray(scale, dtype=m.dtype), np.diff(m.indptr))
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    def apply(self, src):
+        """
+        Regrid a single 2d level. Returns a 1d array of length n_b.
+        """
+
+        src = np.asarray(src).reshape(-1)
+        assert src.shape[0] == self.n_a
+
+        return self.matrix.dot(src)
+
+    def apply_levels(self, src, batch_levels=16):
+        """
+        Regrid a (levels, ...) stack of source levels. Returns an array of
+        shape (levels, n_b).
+
+        Levels are done batch_levels at a time which bounds the size of the
+        temporary arrays.
+        """
+
+        src = np.asarray(src)
+        num_levels = src.shape[0]
+        src = src.reshape(num_levels, -1)
+        assert src.shape[1] == self.n_a
+
+        dtype = np.result_type(self.matrix.dtype, src.dtype)
+        dest = np.empty((num_levels, self.n_b), dtype=dtype)
+        for start in range(0, num_levels, batch_levels):
+            end = min(start + batch_levels, num_levels)
+            dest[start:end, :] = self.matrix.dot(src[start:end, :].T).T
+
+        return dest
+
+    def apply_masked(self, src, fill, dest_mask=None, batch_levels=16):
+        """
+        Regrid a masked (levels, n_a) stack leaving out the masked source
+        points, for conservative weights. Each destination point gets the
+        weighted mean of the valid source points it overlaps,
+        W.(src*valid) / W.valid, with the numerator and denominator of all
+        levels made by one sparse product.
+
+        Destination points that overlap no valid source and are not masked
+        in dest_mask, a (levels, n_b) boolean array, are regridded from
+        fill() instead. fill returns src with its masked points filled, it
+        is only called if there are such points.
+        """
+
+        num_levels = src.shape[0]
+        valid = ~np.ma.getmaskarray(src)
+        values = np.where(valid, np.ma.getdata(src), 0)
+
+        both = self.apply_levels(np.concatenate((values,
+                                                 valid.astype(values.dtype))),
+                                 batch_levels)
+        num, den = both[:num_levels], both[num_levels:]
+        dest = np.zeros_like(num)
+        np.divide(num, den, out=dest, where=(den > 0))
+
+        empty = (den <= 0)
+        if dest_mask is not None:
+            empty &= ~dest_mask
+        if np.any(empty):
+            filled = fill()
+            for k in np.flatnonzero(empty.any(axis=1)):
+                points = np.flatnonzero(empty[k])
+                dest[k, points] = self.matrix[points, :].dot(filled[k])
+
+        return dest
+
+
+def read_weights(weights_file, dtype='f8', normalize=False):
+    """
+    Read an ESMF_RegridWeightGen weights file.
+
+    dtype: type used to store the weights, 'f4' halves their memory use.
+    normalize: divide the weights of each destination point by the fraction
+    of it that is covered by the source grid, frac_b in the weights file.
+    For conservative weights this turns ESMF's default destination area
+    normalisation into fractional area normalisation, so partly covered
+    destination cells get the mean of the source cells they overlap. It is
+    done once here rather than on every regridded field.
+    """
+
+    with profiling.stage('read_weights'):
+        frac_b = None
+        with nc.Dataset(weights_file) as f:
+            n_a = len(f.dimensions['n_a'])
+            n_b = len(f.dimensions['n_b'])
+            row = f.variables['row'][:] - 1
+            col = f.variables['col'][:] - 1
+            s = f.variables['S'][:]
+            if normalize and 'frac_b' in f.variables:
+                frac_b = np.ma.getdata(f.variables['frac_b'][:])
+        profiling.add_bytes(weights_file, read=row.nbytes + col.nbytes + s.nbytes)
+
+        weights = RegridWeights(row, col, s, n_a, n_b, dtype)
+        if frac_b is not None:
+            scale = np.zeros(n_b)
+            np.divide(1.0, frac_b, out=scale, where=(frac_b > 0))
+            weights.scale_rows(scale)
+
+        return weights
+
+
+def save_csr(weights, directory):
+    """
+    Save the CSR arrays of weights as .npy files in directory so that they can
+    be memory-mapped by load_csr().
+    """
+
+    m = weights.matrix
+    np.save(os.path.join(directory, 'data.npy'), m.data)
+    np.save(os.path.join(directory, 'indices.npy'), m.indices)
+    np.save(os.path.join(directory, 'indptr.npy'), m.indptr)
+    np.save(os.path.join(directory, 'shape.npy'), np.array(m.shape))
+
+
+def load_csr(directory, mmap_mode='r'):
+    """
+    Load weights saved by save_csr(). With the default mmap_mode the arrays are
+    shared with every other process that maps the same files.
+    """
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'),
+                       mmap_mode=mmap_mode)
+
+    shape = tuple(np.load(os.path.join(directory, 'shape.npy')))
+    matrix = sparse.csr_matrix((load('data'), load('indices'), load('indptr')),
+                               shape=shape, copy=False)
+
+    return RegridWeights.from_csr(matrix)
+
+
+def write_weights(weights_file, row, col, s, n_a, n_b):
+    """
+    Write weights in the ESMF_RegridWeightGen file layout. row and col are
+    zero based.
+    """
+
+    with nc.Dataset(weights_file, 'w') as f:
+        f.createDimension('n_a', n_a)
+        f.createDimension('n_b', n_b)
+        f.createDimension('n_s', len(s))
+        f.createVariable('row', 'i4', ('n_s',))[:] = np.asarray(row) + 1
+        f.createVariable('col', 'i4', ('n_s',))[:] = np.asarray(col) + 1
+        f.createVariable('S', 'f8', ('n_s',))[:] = s
+        # The source always covers the whole destination.
+        f.createVariable('frac_b', 'f8', ('n_b',))[:] = 1.0
+
+
+def _axis_position(axis, values, periodic):
+    """
+    Index of the axis point at or below each value and the fractional
+    distance to the next point. axis must be increasing. Values outside a
+    non-periodic axis are clamped to its ends.
+    """
+
+    n = len(axis)
+    if periodic:
+        values = np.mod(values - axis[0], 360.0) + axis[0]
+        i = np.searchsorted(axis, values, side='right') - 1
+        i1 = (i + 1) % n
+        w = np.mod(values - axis[i], 360.0) / np.mod(axis[i1] - axis[i], 360.0)
+    else:
+        values = np.clip(values, axis[0], axis[-1])
+        i = np.clip(np.searchsorted(axis, values, side='right') - 1, 0, n - 2)
+        i1 = i + 1
+        w = (values - axis[i]) / (axis[i1] - axis[i])
+
+    return i, i1, w
+
+
+def rectilinear_weights(src_grid, dest_grid, method='bilinear'):
+    """
+    Bilinear or nearest neighbour ('neareststod') weights from a
+    rectilinear src_grid to any dest_grid, found with searchsorted on the
+    source axes. Returns zero based (row, col, S) as in ESMF weights.
+
+    Longitude is treated as periodic if the source axis goes all the way
+    around. Destination points beyond the first or last source latitude
+    take the values of that latitude.
+    """
+
+    assert method in PYTHON_METHODS
+    assert grids.is_rectilinear(src_grid)
+
+    lons = np.asarray(src_grid.x_t[0, :], dtype='f8')
+    lats = np.asarray(src_grid.y_t[:, 0], dtype='f8')
+    nx = len(lons)
+    assert np.all(np.diff(lons) > 0)
+
+    # Latitude may run north to south.
+    flip = lats[0] > lats[-1]
+    if flip:
+        lats = lats[::-1]
+
+    dlon = lons[-1] - lons[-2]
+    periodic = abs(lons[-1] + dlon - lons[0] - 360.0) < 1e-6*360.0
+    i, i1, wx = _axis_position(lons, dest_grid.x_t.ravel(), periodic)
+    j, j1, wy = _axis_position(lats, dest_grid.y_t.ravel(), False)
+    if flip:
+        j, j1 = len(lats) - 1 - j, len(lats) - 1 - j1
+
+    if method == 'neareststod':
+        cols = np.where(wy < 0.5, j, j1)*nx + np.where(wx < 0.5, i, i1)
+        return np.arange(len(cols)), cols, np.ones(len(cols))
+
+    rows = np.tile(np.arange(len(i)), 4)
+    cols = np.concatenate((j*nx + i, j*nx + i1, j1*nx + i1, j1*nx + i))
+    s = np.concatenate(((1 - wx)*(1 - wy), wx*(1 - wy), wx*wy, (1 - wx)*wy))
+
+    keep = s > 0
+    return rows[keep], cols[keep], s[keep]
+
+
+def esmf_command(src_scrip, dest_scrip, weights_file, method='bilinear',
+                 use_mpi=False):
+    """
+    Build the ESMF_RegridWeightGen command line.
+    """
+
+    cmd = ['ESMF_RegridWeightGen', '-s', src_scrip, '-d', dest_scrip,
+           '-m', method, '-w', weights_file, '--ignore_unmapped']
+    if use_mpi:
+        cmd = ['mpirun', '-np', str(mp.cpu_count())] + cmd
+
+    return cmd
+
+
+def generate_weights(src_grid, dest_grid, weights_file, method='bilinear',
+                     use_mpi=False):
+    """
+    Calculate regridding weights from src_grid to dest_grid. Weights from
+    rectilinear grids are calculated in Python when the method allows,
+    otherwise with ESMF_RegridWeightGen. Raises CalledProcessError if ESMF
+    fails.
+    """
+
+    if method in PYTHON_METHODS and grids.is_rectilinear(src_grid):
+        with profiling.stage('generate_weights', method=method,
+                             generator='python'):
+            row, col, s = rectilinear_weights(src_grid, dest_grid, method)
+            write_weights(weights_file, row, col, s, src_grid.x_t.size,
+                          dest_grid.x_t.size)
+        return weights_file
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src_scrip = os.path.join(tmpdir, 'src_grid.nc')
+        dest_scrip = os.path.join(tmpdir, 'dest_grid.nc')
+        grids.write_scrip(src_grid, src_scrip)
+        # Conservative weights are normalised by the ocean fraction of each
+        # destination cell, so leave land out of the destination.
+        grids.write_scrip(dest_grid, dest_scrip,
+                          use_mask=(method == 'conserve'))
+
+        cmd = esmf_command(src_scrip, dest_scrip, weights_file, method,
+                           use_mpi)
+        with profiling.stage('generate_weights', method=method), \
+                open(os.devnull, 'w') as devnull:
+            sp.check_call(cmd, stdout=devnull)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return weights_file
@@ -0,0 +1,37 @@
+from __future__ import print_function
+
+import pytest
+import numpy as np
+
+from ocean_ic import grids
+from ocean_ic.pipeline import RegridPipeline
+
+from test_pipeline import write_identity_weights
+
+"""
+Fixtures shared by the tests of the tools built on RegridPipeline.
+"""
+
+@pytest.fixture
+def coarse_grid():
+    """
+    A small global rectilinear grid with two levels.
+    """
+
+    lons = np.arange(0.5, 360, 20.0)
+    lats = np.arange(-80, 90, 20.0)
+    return grids.rectilinear_grid(lons, lats, [5.0, 15.0])
+
+
+@pytest.fixture
+def identity_pipeline(coarse_grid, tmpdir):
+    """
+    A pipeline from coarse_grid to itself with identity weights, so the
+    output is the input.
+    """
+
+    weights = str(tmpdir.join('weights.nc'))
+    write_identity_weights(weights, coarse_grid.x_t.size)
+
+    return RegridPipeline('GODAS', coarse_grid, coarse_grid,
+                          regrid_weights=weights)
@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+import os
+import time
+import numpy as np
+
+from ocean_ic import cache, grids
+from ocean_ic.cache import WeightsCache, make_key
+from ocean_ic.gridstore import GridStore, grid_key, open_grid, share_grid
+
+class TestWeightsCache():
+
+    def test_key_depends_on_content(self, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+        a = tmpdir.join('a.nc')
+        b = tmpdir.join('b.nc')
+        a.write('grid A')
+        b.write('grid A')
+
+        # Same content in a different place gives the same key.
+        assert make_key([str(a)], 'bilinear') == make_key([str(b)], 'bilinear')
+        assert make_key([str(a)], 'bilinear') != make_key([str(a)], 'conserve')
+
+        b.write('grid B')
+        later = time.time() + 10
+        os.utime(str(b), (later, later))
+        assert make_key([str(a)], 'bilinear') != make_key([str(b)], 'bilinear')
+
+        # Unchanged files aren't read again.
+        def no_read(filename):
+            raise AssertionError('{} read again'.format(filename))
+        key = make_key([str(a)], 'bilinear')
+        monkeypatch.setattr(cache, 'file_digest', no_read)
+        assert make_key([str(a)], 'bilinear') == key
+
+    def test_put_get(self, tmpdir):
+
+        cache = WeightsCache(str(tmpdir.join('cache')))
+        assert cache.get('k') is None
+
+        tmp = cache.tmp_path()
+        with open(tmp, 'w') as f:
+            f.write('weights')
+        path = cache.put('k', tmp)
+
+        assert not os.path.exists(tmp)
+        assert cache.get('k') == path
+
+    def test_lru_eviction(self, tmpdir):
+
+        cache = WeightsCache(str(tmpdir.join('cache')), max_bytes=25)
+
+        for i, key in enumerate(['a', 'b', 'c']):
+            tmp = cache.tmp_path()
+            with open(tmp, 'w') as f:
+                f.write('x'*10)
+            cache.put(key, tmp)
+            # Make sure mtimes differ.
+            os.utime(cache.path(key), (time.time() + i, time.time() + i))
+            if key == 'b':
+                # Use 'a' so that 'b' is now the least recently used.
+                cache.get('a')
+                os.utime(cache.path('a'), (time.time() + 5, time.time() + 5))
+
+        assert cache.get('a') is not None
+        assert cache.get('b') is None
+        assert cache.get('c') is not None
+
+
+class TestGridStore():
+
+    def test_load(self, tmpdir):
+
+        grid_file = tmpdir.join('hgrid.nc')
+        grid_file.write('grid')
+        lons = np.arange(0.5, 360, 10.0)
+        lats = np.arange(-85, 90, 10.0)
+        mask = np.zeros((len(lats), len(lons)), dtype=bool)
+        mask[0, :] = True
+        grid = grids.rectilinear_grid(lons, lats, [5.0, 15.0], mask,
+                                      description='test')
+
+        loads = []
+        def loader(name):
+            loads.append(name)
+            return grid
+
+        store = GridStore(str(tmpdir.join('grids')))
+        for _ in range(2):
+            stored = store.load('MOM', [str(grid_file), None], loader, 'MOM')
+            # A read-only view of the memory mapped file.
+            assert isinstance(stored.x_t.base, np.memmap)
+            assert not stored.x_t.flags.writeable
+            assert np.array_equal(stored.x_t, grid.x_t)
+            assert np.array_equal(stored.clat_t, grid.clat_t)
+            assert np.array_equal(stored.mask, grid.mask)
+            assert stored.area_t is None
+            assert stored.description == 'test'
+        assert loads == ['MOM']
+
+        # The grid is read again when the definition file changes.
+        key = grid_key('MOM', [str(grid_file)])
+        os.utime(str(grid_file), (time.time() + 10, time.time() + 10))
+        assert grid_key('MOM', [str(grid_file)]) != key
+        assert grid_key('NEMO', [str(grid_file)]) != key
+
+    def test_share(self, tmpdir):
+
+        grid = grids.rectilinear_grid(np.arange(0.5, 360, 10.0),
+                                      np.arange(-85, 90, 10.0), [5.0, 15.0])
+        store = GridStore(str(tmpdir.join('grids')))
+        stored = store.load('MOM', [], lambda: grid)
+
+        shared = str(tmpdir.join('shared'))
+        os.mkdir(shared)
+
+        # Grids from the store are shared from their own files.
+        files = share_grid(stored, shared, 'dest')
+        assert all(f.startswith(store.store_dir) for f in files.values())
+        assert os.listdir(shared) == []
+
+        files = share_grid(grid, shared, 'dest')
+        assert all(f.startswith(shared) for f in files.values())
+        for g in [open_grid(files), open_grid(share_grid(stored, shared, 'x'))]:
+            assert isinstance(g.mask.base, np.memmap)
+            assert g.mask.shape == grid.x_t.shape
+            assert np.array_equal(g.clon_t, grid.clon_t)
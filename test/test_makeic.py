@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+import pytest
+import os
+import json
+import time
+import numpy as np
+import netCDF4 as nc
+
+import makeic
+from ocean_ic import grids
+
+from test_pipeline import write_src_file
+
+class TestBatch():
+
+    def test_parse_range(self):
+        assert makeic.parse_range('1-3') == [1, 2, 3]
+        assert makeic.parse_range('1,4,7') == [1, 4, 7]
+        assert makeic.parse_range('1990-1991,2000') == [1990, 1991, 2000]
+
+    def test_batch_needs_years(self, tmpdir, capsys):
+
+        argv = ['GODAS', 'hgrid', 'vgrid', 'pottmp.{year}.nc', 'salt.nc',
+                'MOM', 'hgrid', 'vgrid', '--output_pattern',
+                str(tmpdir.join('ic_{month:02d}.nc'))]
+        with pytest.raises(SystemExit):
+            makeic.batch_main(argv)
+        assert '--years' in capsys.readouterr().err
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_batch(self, identity_pipeline, tmpdir, monkeypatch, workers):
+
+        shape = (12,) + identity_pipeline.src_grid.shape
+        for year in [2001, 2002]:
+            write_src_file(str(tmpdir.join('pottmp.{}.nc'.format(year))),
+                           'pottmp', np.full(shape, 283.15), 'K')
+            write_src_file(str(tmpdir.join('salt.{}.nc'.format(year))),
+                           'salt', np.full(shape, 0.035), 'kg/kg')
+
+        calls = []
+        def make_pipeline(args):
+            calls.append(args)
+            return identity_pipeline
+        monkeypatch.setattr(makeic, 'make_pipeline', make_pipeline)
+
+        pattern = str(tmpdir.join('ic_{year}{month:02d}.nc'))
+        existing = pattern.format(year=2001, month=2)
+        open(existing, 'w').close()
+
+        argv = ['GODAS', 'hgrid', 'vgrid',
+                str(tmpdir.join('pottmp.{year}.nc')),
+                str(tmpdir.join('salt.{year}.nc')),
+                'MOM', 'hgrid', 'vgrid', '--output_pattern', pattern,
+                '--months', '1-3', '--years', '2001-2002',
+                '--workers', str(workers),
+                '--report', str(tmpdir.join('report.json'))]
+        assert makeic.batch_main(argv) == 0
+
+        with open(str(tmpdir.join('report.json'))) as f:
+            report = json.load(f)
+        stages = set(s['stage'] for s in report['stages'])
+        assert {'read', 'vertical', 'apply_weights', 'write'} <= stages
+        # One read per variable and IC.
+        assert report['totals']['read']['count'] == 2*5
+        assert report['info']['weights_from_cache'] is False
+        written = [v['bytes_written'] for v in report['files'].values()]
+        assert sum(written) > 0
+
+        # The grids are only set up once.
+        assert len(calls) == 1
+        # Existing outputs are left alone.
+        assert os.path.getsize(existing) == 0
+
+        for year in [2001, 2002]:
+            for month in [1, 2, 3]:
+                output = pattern.format(year=year, month=month)
+                assert os.path.exists(output)
+                if output == existing:
+                    continue
+                with nc.Dataset(output) as f:
+                    assert f.variables['salt'].units == 'psu'
+                    assert np.allclose(f.variables['salt'][:], 35.0)
+                    assert np.allclose(f.variables['ptemp'][:], 10.0)
+
+    def test_make_ic(self, identity_pipeline, tmpdir, monkeypatch):
+
+        shape = (12,) + identity_pipeline.src_grid.shape
+        temp_file = str(tmpdir.join('pottmp.nc'))
+        salt_file = str(tmpdir.join('salt.nc'))
+        write_src_file(temp_file, 'pottmp',
+                       np.arange(12.0)[:, None, None, None] + np.zeros(shape),
+                       'C')
+        write_src_file(salt_file, 'salt', np.full(shape, 35.0), 'psu')
+
+        calls = []
+        def build_pipeline(args):
+            calls.append(args)
+            return identity_pipeline
+        monkeypatch.setattr(makeic, 'build_pipeline', build_pipeline)
+        monkeypatch.setattr(makeic, '_pipelines', {})
+
+        for month in [1, 2]:
+            output = str(tmpdir.join('ic_{}.nc'.format(month)))
+            assert makeic.make_ic('GODAS', 'hgrid', 'vgrid', temp_file,
+                                  salt_file, 'MOM', 'hgrid', 'vgrid', output,
+                                  month=month, dtype='float32') == output
+            with nc.Dataset(output) as f:
+                assert np.allclose(f.variables['ptemp'][:], month - 1)
+
+        # The pipeline is kept warm between calls.
+        assert len(calls) == 1
+        assert calls[0].dtype == 'float32'
+
+        with pytest.raises(IOError):
+            makeic.make_ic('GODAS', 'hgrid', 'vgrid', temp_file, salt_file,
+                           'MOM', 'hgrid', 'vgrid', output)
+        with pytest.raises(TypeError):
+            makeic.make_options(no_such_option=True)
+
+    def test_update(self, identity_pipeline, tmpdir, monkeypatch, capsys):
+
+        shape = (12,) + identity_pipeline.src_grid.shape
+        temp_file = str(tmpdir.join('pottmp.nc'))
+        salt_file = str(tmpdir.join('salt.nc'))
+        write_src_file(temp_file, 'pottmp', np.full(shape, 10.0), 'C')
+        write_src_file(salt_file, 'salt', np.full(shape, 35.0), 'psu')
+
+        monkeypatch.setattr(makeic, 'build_pipeline',
+                            lambda args: identity_pipeline)
+        monkeypatch.setattr(makeic, '_pipelines', {})
+
+        output = str(tmpdir.join('ic.nc'))
+        def make_ic(**options):
+            makeic.make_ic('GODAS', 'hgrid', 'vgrid', temp_file, salt_file,
+                           'MOM', 'hgrid', 'vgrid', output, update=True,
+                           **options)
+            return capsys.readouterr().out
+
+        assert 'Made' in make_ic()
+        assert 'is up to date' in make_ic()
+
+        write_src_file(temp_file, 'pottmp', np.full(shape, 12.0), 'C')
+        later = time.time() + 10
+        os.utime(temp_file, (later, later))
+        assert 'Updated {}: ptemp (all)'.format(output) in make_ic()
+        with nc.Dataset(output) as f:
+            assert np.allclose(f.variables['ptemp'][:], 12.0)
+            assert np.allclose(f.variables['salt'][:], 35.0)
+
+        assert 'remaking' in make_ic(mom_version='MOM6')
+
+
+def test_preprocess(coarse_grid, tmpdir, monkeypatch):
+
+    for name in ['pottmp.nc', 'hgrid.nc', 'vgrid.nc']:
+        tmpdir.join(name).write(name)
+
+    loads = []
+    def load(*args):
+        loads.append(args[0])
+        return coarse_grid
+    monkeypatch.setattr(grids, 'load_src_grid', load)
+    monkeypatch.setattr(grids, 'load_dest_grid', load)
+
+    store = str(tmpdir.join('grids'))
+    argv = ['GODAS', str(tmpdir.join('pottmp.nc')), str(tmpdir.join('pottmp.nc')),
+            'MOM', str(tmpdir.join('hgrid.nc')), str(tmpdir.join('vgrid.nc')),
+            '--grid_store_dir', store]
+    assert makeic.preprocess_main(argv) == 0
+    assert loads == ['GODAS', 'MOM']
+
+    # Later runs open the stored grids without reading the definitions.
+    args = makeic.argparse.Namespace(reanalysis_name='GODAS',
+                                     reanalysis_hgrid=argv[1],
+                                     reanalysis_vgrid=argv[2],
+                                     model_name='MOM', model_hgrid=argv[4],
+                                     model_vgrid=argv[5], model_mask=None,
+                                     grid_store_dir=store, no_grid_store=False)
+    src_grid, dest_grid = makeic.load_grids(args)
+    assert loads == ['GODAS', 'MOM']
+    assert np.array_equal(dest_grid.y_t, coarse_grid.y_t)
@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import pytest
+import os
+import sys
+import shutil
+import subprocess as sp
+import numpy as np
+import netCDF4 as nc
+
+# mpirun runs this file as a script, see mpi_main().
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(my_dir, '..'))
+
+from ocean_ic import grids
+from ocean_ic.mpi import band_rows, local_weights
+from ocean_ic.pipeline import RegridPipeline, regrid_fields
+
+from test_pipeline import write_src_file
+
+NUM_RANKS = 4
+
+def make_pipeline(directory):
+    """
+    A coarse global source and a finer regional destination, which has a
+    number of rows that doesn't divide evenly between the ranks.
+    """
+
+    src_grid = grids.rectilinear_grid(np.arange(0.5, 360, 10.0),
+                                      np.arange(-85, 90, 10.0), [5.0, 15.0])
+    dest_grid = grids.rectilinear_grid(np.arange(0.25, 360, 7.5),
+                                       np.linspace(-60, 60, 27), [5.0, 15.0])
+    dest_grid.mask = np.zeros(dest_grid.x_t.shape, dtype=bool)
+    dest_grid.mask[:3, :] = True
+
+    return RegridPipeline('ORAS4', src_grid, dest_grid,
+                          regrid_weights=os.path.join(directory, 'weights.nc'))
+
+
+def fields(directory):
+    return [(os.path.join(directory, 'temp.nc'), 'pottmp', 'temp'),
+            (os.path.join(directory, 'salt.nc'), 'salt', 'salt')]
+
+
+def mpi_main(directory):
+    """
+    Run under mpirun by test_mpirun().
+    """
+
+    from mpi4py import MPI
+    from ocean_ic.mpi import DistributedRegridder
+
+    comm = MPI.COMM_WORLD
+    pipeline = make_pipeline(directory) if comm.Get_rank() == 0 else None
+    regridder = DistributedRegridder(comm, pipeline)
+    regridder.regrid_fields(fields(directory),
+                            os.path.join(directory, 'ic_mpi.nc'), 'MOM',
+                            month=2)
+
+
+class TestMPI():
+
+    def test_local_weights(self, tmpdir):
+
+        pipeline = make_pipeline(str(tmpdir))
+        matrix = pipeline.weights.matrix
+        num_rows, num_lons = pipeline.dest_grid.shape[1:]
+        src = np.random.random(matrix.shape[1])
+
+        dest = []
+        for rank in range(NUM_RANKS):
+            rows = band_rows(num_rows, NUM_RANKS, rank)
+            local, halo = local_weights(matrix, rows, num_lons)
+            assert local.shape == ((rows.stop - rows.start)*num_lons, len(halo))
+            # Each band only needs part of the source.
+            assert len(halo) < matrix.shape[1]
+            dest.append(local.dot(src[halo]))
+
+        assert np.allclose(np.concatenate(dest), matrix.dot(src))
+
+    @pytest.mark.skipif(shutil.which('mpirun') is None,
+                        reason='mpirun not found')
+    def test_mpirun(self, tmpdir):
+
+        pytest.importorskip('mpi4py')
+
+        directory = str(tmpdir)
+        pipeline = make_pipeline(directory)
+        shape = (12,) + pipeline.src_grid.shape
+        write_src_file(os.path.join(directory, 'temp.nc'), 'pottmp',
+                       np.random.random(shape)*30.0 + 273.15, 'K')
+        write_src_file(os.path.join(directory, 'salt.nc'), 'salt',
+                       np.random.random(shape)*5.0 + 32.0, 'psu')
+
+        serial = os.path.join(directory, 'ic.nc')
+        regrid_fields(pipeline, fields(directory), serial, 'MOM', month=2)
+
+        sp.check_call(['mpirun', '-n', str(NUM_RANKS), sys.executable,
+                       os.path.realpath(__file__), directory], timeout=300)
+
+        with nc.Dataset(serial) as f, \
+                nc.Dataset(os.path.join(directory, 'ic_mpi.nc')) as f_mpi:
+            for var in ['temp', 'salt']:
+                expected = f.variables[var][:]
+                result = f_mpi.variables[var][:]
+                assert f_mpi.variables[var].units == f.variables[var].units
+                assert np.array_equal(result.mask, expected.mask)
+                assert np.ma.allclose(result, expected)
+
+
+if __name__ == '__main__':
+    mpi_main(sys.argv[1])
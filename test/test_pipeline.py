@@ -0,0 +1,438 @@
+from __future__ import print_function
+
+import pytest
+import os
+import threading
+import tracemalloc
+import numpy as np
+import netCDF4 as nc
+
+from ocean_ic import grids, profiling
+from ocean_ic.vertical import VerticalInterpolator
+from ocean_ic.fill import NearestFiller
+from ocean_ic.cache import WeightsCache
+from ocean_ic.pipeline import RegridPipeline, regrid_fields
+from ocean_ic.weights import RegridWeights, rectilinear_weights, \
+                             write_weights
+from ocean_ic.reader import SourceField, read_src_field, prefetch
+
+def write_identity_weights(filename, size):
+
+    with nc.Dataset(filename, 'w') as f:
+        f.createDimension('n_a', size)
+        f.createDimension('n_b', size)
+        f.createDimension('n_s', size)
+        f.createVariable('row', 'i4', ('n_s',))[:] = np.arange(1, size + 1)
+        f.createVariable('col', 'i4', ('n_s',))[:] = np.arange(1, size + 1)
+        f.createVariable('S', 'f8', ('n_s',))[:] = 1.0
+
+def write_src_file(filename, var_name, data, units):
+
+    with nc.Dataset(filename, 'w') as f:
+        f.createDimension('time', data.shape[0])
+        f.createDimension('z', data.shape[1])
+        f.createDimension('y', data.shape[2])
+        f.createDimension('x', data.shape[3])
+        var = f.createVariable(var_name, 'f4', ('time', 'z', 'y', 'x'),
+                               fill_value=-9.99e33)
+        var.units = units
+        var[:] = data
+
+
+class TestPipeline():
+
+    @pytest.fixture
+    def grid(self):
+        lons = np.arange(0.5, 360, 10.0)
+        lats = np.arange(-85, 90, 10.0)
+        return grids.rectilinear_grid(lons, lats, [5.0, 15.0, 30.0])
+
+    def test_vertical_extends_deepest(self):
+
+        interp = VerticalInterpolator([10.0, 20.0, 30.0], [5.0, 15.0, 40.0])
+        data = np.ma.array(np.array([1.0, 2.0, 3.0]).reshape(3, 1, 1))
+        data[2, 0, 0] = np.ma.masked
+
+        dest = interp(data)
+        assert np.allclose(dest[:, 0, 0], [1.0, 1.5, 2.0])
+
+    def test_vertical_matches_columns(self):
+
+        src_levels = np.array([5.0, 15.0, 30.0, 60.0, 100.0])
+        dest_levels = np.array([2.0, 10.0, 25.0, 40.0, 80.0, 150.0])
+        interp = VerticalInterpolator(src_levels, dest_levels)
+
+        depth = np.random.randint(0, 6, size=(4, 6))
+        mask = np.arange(5)[:, np.newaxis, np.newaxis] >= depth
+        data = np.ma.array(np.random.random((5, 4, 6)), mask=mask)
+
+        dest = interp(data)
+        for j in range(4):
+            for i in range(6):
+                n = depth[j, i]
+                if n == 0:
+                    assert np.all(dest.mask[:, j, i])
+                    continue
+                expected = np.interp(dest_levels, src_levels[:n],
+                                     data.data[:n, j, i])
+                assert np.allclose(dest[:, j, i], expected)
+
+        # The bottom extension is worked out once per mask.
+        assert interp.extension(data.mask) is interp.extension(data.mask)
+
+        # Streaming a level at a time gives the same result.
+        levels = np.ma.stack(list(interp.levels(data)))
+        assert np.array_equal(levels.mask, dest.mask)
+        assert np.ma.allclose(levels, dest)
+
+    def test_nearest_fill(self, grid, tmpdir):
+
+        data = np.ma.array(np.zeros((2,) + grid.x_t.shape))
+        # Only 10.5E and 180.5E are valid, 350.5E is nearest to 10.5E
+        # across the periodic boundary.
+        data[:, :, :] = np.ma.masked
+        data[:, :, 1] = 7.0
+        data[:, :, 18] = 3.0
+
+        cache = WeightsCache(str(tmpdir.join('cache')))
+        filler = NearestFiller(grid, cache, 'key')
+        filled = filler(data)
+
+        assert not np.ma.is_masked(filled)
+        assert np.all(filled[:, :, -1] == 7.0)
+        assert np.all(filled[:, :, 17] == 3.0)
+        assert np.array_equal(filled[0], filled[1])
+
+        # The index map is reused from memory and from the disk cache.
+        mask = data.mask[0]
+        assert filler.index(mask) is filler.index(mask)
+        assert len(cache.entries()) == 1
+        other = NearestFiller(grid, cache, 'key')
+        assert np.array_equal(other.index(mask), filler.index(mask))
+
+    def test_read_multi_file(self, grid, tmpdir):
+
+        shape = (12,) + grid.shape
+        data = np.random.random(shape).astype('f4')
+        data[:, 2, 0, 0] = -9.99e33
+
+        whole = str(tmpdir.join('thetao_all.nc'))
+        write_src_file(whole, 'thetao', data, 'degC')
+        for month in range(12):
+            write_src_file(str(tmpdir.join('thetao_{:02d}.nc'.format(month + 1))),
+                           'thetao', data[month:month + 1], 'degC')
+
+        field = SourceField(str(tmpdir.join('thetao_??.nc')), 'thetao')
+        assert len(field.files) == 12
+        assert field.num_times == 12
+
+        for month in [1, 7, 12]:
+            expected, units, _ = read_src_field(whole, 'thetao', month)
+            got = field.read_month(month)
+            assert units == 'degC'
+            assert np.array_equal(got.mask, expected.mask)
+            assert got.mask[2, 0, 0]
+            assert np.ma.allclose(got, data[month - 1])
+
+        # Several years are ambiguous.
+        years = SourceField([whole, whole], 'thetao')
+        assert years.num_times == 24
+        with pytest.raises(ValueError):
+            years.read_month(2)
+        assert np.ma.allclose(years.read_time(13), data[1])
+
+    def test_read_packed(self, grid, tmpdir):
+
+        shape = (1,) + grid.shape
+        data = np.random.random(shape)*30.0 - 2.0
+
+        packed = str(tmpdir.join('thetao_packed.nc'))
+        with nc.Dataset(packed, 'w') as f:
+            for name, size in zip(['time', 'z', 'y', 'x'], shape):
+                f.createDimension(name, size)
+            var = f.createVariable('thetao', 'i2', ('time', 'z', 'y', 'x'),
+                                   fill_value=-32767)
+            var.scale_factor = np.float32(0.001)
+            var.add_offset = np.float32(10.0)
+            var[:] = data
+
+        # Unpacked values aren't truncated to the packed integers.
+        field = SourceField(packed, 'thetao')
+        assert field.dtype == np.float32
+        assert np.allclose(field.read_month(), data[0], atol=1e-3)
+
+    def test_apply_levels(self):
+
+        n_a, n_b, n_s = 50, 30, 120
+        row = np.random.randint(0, n_b, n_s)
+        col = np.random.randint(0, n_a, n_s)
+        s = np.random.random(n_s)
+        src = np.random.random((7, n_a))
+
+        expected = np.array([np.bincount(row, weights=s*src[l, col],
+                                         minlength=n_b) for l in range(7)])
+
+        weights = RegridWeights(row, col, s, n_a, n_b)
+        assert weights.matrix.indices.dtype == np.int32
+        assert np.allclose(weights.apply_levels(src, batch_levels=3), expected)
+        assert np.allclose(weights.apply(src[4, :]), expected[4, :])
+
+        weights = RegridWeights(row, col, s, n_a, n_b, dtype='f4')
+        dest = weights.apply_levels(src.astype('f4'))
+        assert dest.dtype == np.float32
+        assert np.allclose(dest, expected, rtol=1e-5)
+
+    def test_regrid_fields(self, grid, tmpdir):
+
+        weights = str(tmpdir.join('weights.nc'))
+        write_identity_weights(weights, grid.x_t.size)
+
+        shape = (12,) + grid.shape
+        temp = np.random.random(shape)*30.0 + 273.15
+        salt = np.random.random(shape)*0.01 + 0.03
+        temp_file = str(tmpdir.join('temp.nc'))
+        salt_file = str(tmpdir.join('salt.nc'))
+        write_src_file(temp_file, 'pottmp', temp, 'K')
+        write_src_file(salt_file, 'salt', salt, 'kg/kg')
+
+        grid.mask = np.zeros(grid.x_t.shape, dtype=bool)
+        grid.mask[0, :] = True
+        pipeline = RegridPipeline('ORAS4', grid, grid,
+                                  regrid_weights=weights)
+
+        output = str(tmpdir.join('ic.nc'))
+        encoding = {'zlib': True, 'complevel': 1, 'shuffle': True,
+                    'least_significant_digit': 4}
+        regrid_fields(pipeline, [(temp_file, 'pottmp', 'temp'),
+                                 (salt_file, 'salt', 'salt')],
+                      output, 'MOM', month=3, encoding=encoding)
+
+        with nc.Dataset(output) as f:
+            out_temp = f.variables['temp'][0, :]
+            out_salt = f.variables['salt'][0, :]
+            # Units are converted on the way out.
+            assert f.variables['temp'].units == 'C'
+            assert f.variables['salt'].units == 'psu'
+            assert f.variables['temp'].chunking() == [1, 1] + list(grid.x_t.shape)
+            assert f.variables['temp'].filters()['zlib']
+
+        assert np.ma.allclose(out_temp[:, 1:, :], temp[2, :, 1:, :] - 273.15,
+                              atol=1e-4)
+        assert np.ma.allclose(out_salt[:, 1:, :], salt[2, :, 1:, :]*1000,
+                              atol=1e-4)
+        assert np.all(out_temp.mask[:, 0, :])
+
+    def test_prefetch(self):
+
+        assert list(prefetch(iter(range(10)), 2)) == list(range(10))
+
+        def fail():
+            yield 1
+            raise IOError('read failed')
+        with pytest.raises(IOError):
+            list(prefetch(fail()))
+
+        # Stopping early stops the thread.
+        threads = threading.active_count()
+        items = prefetch(iter(range(100)), 2)
+        assert next(items) == 0
+        items.close()
+        assert threading.active_count() == threads
+
+    def test_report_peak(self, monkeypatch):
+
+        # A fake process whose peak RSS is reset by clear_refs.
+        rss = {'current': 100.0, 'peak': 100.0}
+        def reset():
+            rss['peak'] = rss['current']
+            return True
+        monkeypatch.setattr(profiling, '_reset_peak_rss', reset)
+        monkeypatch.setattr(profiling, '_peak_rss_mb', lambda: rss['peak'])
+
+        report = profiling.RunReport()
+        with report.stage('outer'):
+            rss['peak'] = 500.0
+            rss['current'] = 120.0
+            with report.stage('inner'):
+                pass
+        with report.stage('last'):
+            pass
+
+        stages = dict((s['stage'], s) for s in report.stages)
+        # The nested stage doesn't reset the peak of the outer one.
+        assert stages['inner']['peak_rss_mb'] == 500.0
+        assert not stages['inner']['peak_rss_is_stage']
+        assert stages['outer']['peak_rss_mb'] == 500.0
+        assert stages['last']['peak_rss_mb'] == 120.0
+        # The run peak is kept across resets.
+        assert report.as_dict()['peak_rss_mb'] == 500.0
+
+    def test_stream(self, tmpdir):
+
+        # A regional source, extended to the poles, and a deep model grid
+        # with much larger levels.
+        src_grid = grids.rectilinear_grid(np.arange(0.5, 360, 5.0),
+                                          np.arange(-74, 65, 4.0),
+                                          np.linspace(5, 4000, 30))
+        dest_grid = grids.rectilinear_grid(np.arange(0.1, 360, 0.8),
+                                           np.linspace(-80, 80, 300),
+                                           np.linspace(2, 5000, 50))
+        dest_grid.mask = np.zeros(dest_grid.x_t.shape, dtype=bool)
+        dest_grid.mask[:20, :] = True
+
+        depth = np.random.randint(0, 31, size=src_grid.x_t.shape)
+        mask = np.arange(30)[:, np.newaxis, np.newaxis] >= depth
+        temp = np.ma.array(np.random.random((1,) + src_grid.shape)*30.0,
+                           mask=mask[np.newaxis])
+        temp_file = str(tmpdir.join('temp.nc'))
+        write_src_file(temp_file, 'pottmp', temp, 'C')
+
+        weights = str(tmpdir.join('weights.nc'))
+        out = {}
+        for stream in [False, True]:
+            pipeline = RegridPipeline('GODAS', src_grid, dest_grid,
+                                      regrid_weights=weights, stream=stream)
+            output = str(tmpdir.join('ic_{}.nc'.format(stream)))
+            tracemalloc.start()
+            regrid_fields(pipeline, [(temp_file, 'pottmp', 'temp')],
+                          output, 'MOM')
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with nc.Dataset(output) as f:
+                out[stream] = f.variables['temp'][0, :]
+
+            level_bytes = dest_grid.x_t.size*8
+            if stream:
+                # A few levels no matter how many there are.
+                assert peak < 8*level_bytes
+            else:
+                assert peak > 50*level_bytes
+
+        assert np.array_equal(out[True].mask, out[False].mask)
+        assert np.ma.allclose(out[True], out[False])
+
+    def test_float32(self, grid, tmpdir):
+
+        weights = str(tmpdir.join('weights.nc'))
+        write_identity_weights(weights, grid.x_t.size)
+        dest_grid = grids.rectilinear_grid(grid.x_t[0, :], grid.y_t[:, 0],
+                                           [10.0, 20.0, 25.0])
+
+        temp = np.random.random((1,) + grid.shape)*30.0 + 273.15
+        temp_file = str(tmpdir.join('temp.nc'))
+        write_src_file(temp_file, 'pottmp', temp, 'K')
+
+        out = {}
+        for dtype in ['f8', 'f4']:
+            pipeline = RegridPipeline('ORAS4', grid, dest_grid,
+                                      regrid_weights=weights, dtype=dtype)
+            assert pipeline.weights.dtype == dtype
+            output = str(tmpdir.join('ic_{}.nc'.format(dtype)))
+            regrid_fields(pipeline, [(temp_file, 'pottmp', 'temp')],
+                          output, 'MOM')
+            with nc.Dataset(output) as f:
+                assert f.variables['temp'].dtype == dtype
+                out[dtype] = f.variables['temp'][0, :]
+
+        # Temperature in K is held to about 3e-5 in single precision.
+        assert np.allclose(out['f4'], out['f8'], rtol=0, atol=1e-4)
+
+    def test_conservative_land(self, tmpdir):
+
+        # Each model cell is covered by two source cells of equal area.
+        lats = [-30.0, 0.0, 30.0]
+        src_grid = grids.rectilinear_grid(np.arange(5.0, 360, 10.0), lats,
+                                          [5.0, 15.0])
+        dest_grid = grids.rectilinear_grid(np.arange(10.0, 360, 20.0), lats,
+                                           [5.0, 15.0])
+        dest_grid.mask = np.zeros(dest_grid.x_t.shape, dtype=bool)
+        dest_grid.mask[:, 5] = True
+
+        ny, nx = dest_grid.x_t.shape
+        row = np.repeat(np.arange(ny*nx), 2)
+        col = (np.arange(ny)[:, None]*2*nx +
+               2*np.arange(nx)[None, :]).ravel()
+        col = np.column_stack((col, col + 1)).ravel()
+        weights = str(tmpdir.join('weights.nc'))
+        write_weights(weights, row, col, np.full(len(row), 0.5),
+                      src_grid.x_t.size, dest_grid.x_t.size)
+
+        # Land in the second half of model cell 1 and all of cell 3.
+        temp = np.random.random((1,) + src_grid.shape)*30.0 + 273.15
+        temp[:, :, :, [3, 6, 7]] = -9.99e33
+        temp_file = str(tmpdir.join('temp.nc'))
+        write_src_file(temp_file, 'pottmp', temp, 'K')
+        src = read_src_field(temp_file, 'pottmp', 1)[0]
+
+        pipeline = RegridPipeline('ORAS4', src_grid, dest_grid,
+                                  regrid_weights=weights, method='conserve')
+        dest = pipeline.regrid(src)
+
+        # Coastal cells are the mean of the ocean they cover, not of land.
+        assert np.allclose(dest[:, :, 1], src[:, :, 2])
+        assert np.allclose(dest[:, :, 0], src[:, :, :2].mean(axis=-1))
+        # Cells with no ocean under them are regridded from the fill.
+        assert np.allclose(dest[:, :, 3],
+                           0.5*(src[:, :, 5] + src[:, :, 8]))
+        assert np.all(dest.mask[:, :, 5])
+
+        # Streaming and updates give the same.
+        stream = np.ma.stack(list(pipeline.regrid_levels(iter(src))))
+        assert np.ma.allclose(stream, dest)
+        columns = np.arange(nx, 2*nx)
+        assert np.allclose(pipeline.regrid_columns(src, columns),
+                           dest.data.reshape((2, -1))[:, columns])
+
+    def test_scrip_mask(self, grid, tmpdir):
+
+        grid.mask = np.zeros(grid.shape, dtype=bool)
+        grid.mask[:, 0, :] = True
+        grid.mask[1:, 1, :] = True
+
+        scrip = str(tmpdir.join('scrip.nc'))
+        grids.write_scrip(grid, scrip, use_mask=True)
+        with nc.Dataset(scrip) as f:
+            imask = f.variables['grid_imask'][:].reshape(grid.x_t.shape)
+
+        # Only land on every level is masked.
+        assert np.all(imask[0, :] == 0)
+        assert np.all(imask[1:, :] == 1)
+
+    @pytest.mark.parametrize('north_to_south', [False, True])
+    def test_rectilinear_weights(self, grid, north_to_south):
+
+        lons = grid.x_t[0, :]
+        lats = grid.y_t[:, 0]
+        if north_to_south:
+            lats = lats[::-1]
+        src_grid = grids.rectilinear_grid(lons, lats, [5.0])
+        # Destination points between source points and across the
+        # longitude wrap, 355.5E is between 350.5E and 0.5E.
+        dest_grid = grids.rectilinear_grid([3.0, 100.0, 355.5, -4.5],
+                                           [-80.0, 0.0, 42.0], [5.0])
+
+        src = 2.0*src_grid.y_t + np.cos(np.deg2rad(src_grid.x_t))
+        row, col, s = rectilinear_weights(src_grid, dest_grid)
+        weights = RegridWeights(row, col, s, src_grid.x_t.size,
+                                dest_grid.x_t.size)
+        dest = weights.apply(src.ravel()).reshape(dest_grid.x_t.shape)
+
+        # Exact in latitude where the field is linear.
+        assert np.allclose(dest[:, 2] - np.cos(np.deg2rad(355.5)),
+                           2.0*dest_grid.y_t[:, 2], atol=1e-2)
+        assert np.allclose(dest[:, 2], dest[:, 3])
+        assert np.allclose(np.bincount(row, s), 1.0)
+
+        row, col, s = rectilinear_weights(src_grid, dest_grid, 'neareststod')
+        nearest = src.ravel()[col].reshape(dest_grid.x_t.shape)
+        assert np.allclose(nearest[1, 1], src[lats == 5.0, lons == 100.5])
+        assert np.allclose(nearest[:, 2], nearest[:, 0])
+
+    def test_generate_rectilinear(self, grid, tmpdir):
+
+        # No ESMF needed for rectilinear sources.
+        weights = str(tmpdir.join('weights.nc'))
+        src = np.ma.array(np.random.random(grid.shape))
+        pipeline = RegridPipeline('ORAS4', grid, grid, regrid_weights=weights)
+        assert os.path.exists(weights)
+        assert np.allclose(pipeline.regrid(src), src)
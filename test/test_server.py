@@ -0,0 +1,125 @@
+from __future__ import print_function
+
+import pytest
+import os
+import threading
+import numpy as np
+import netCDF4 as nc
+
+import makeic
+from ocean_ic import server, update
+
+from test_pipeline import write_src_file
+
+class TestServer():
+
+    parameters = {'method': 'bilinear'}
+
+    @pytest.fixture
+    def ic_server(self, identity_pipeline, tmpdir):
+        shape = (12,) + identity_pipeline.src_grid.shape
+        write_src_file(str(tmpdir.join('pottmp.nc')), 'pottmp',
+                       np.arange(12.0)[:, None, None, None] + np.zeros(shape),
+                       'C')
+        write_src_file(str(tmpdir.join('salt.nc')), 'salt',
+                       np.full(shape, 35.0), 'psu')
+
+        def fields(temp_file, salt_file):
+            return [(temp_file, 'pottmp', 'temp'), (salt_file, 'salt', 'salt')]
+
+        ic_server = server.ICServer(identity_pipeline, 'MOM', fields,
+                                    workers=2, parameters=self.parameters,
+                                    mask='none')
+        yield ic_server
+        ic_server.close()
+
+    def serve(self, ic_server, address):
+        listener = server.listen(ic_server, address)
+        thread = threading.Thread(target=listener.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return listener
+
+    def job(self, tmpdir, month):
+        return {'temp_file': str(tmpdir.join('pottmp.nc')),
+                'salt_file': str(tmpdir.join('salt.nc')),
+                'output_file': str(tmpdir.join('ic_{}.nc'.format(month))),
+                'month': month}
+
+    @pytest.mark.parametrize('transport', ['unix', 'http'])
+    def test_jobs(self, ic_server, tmpdir, transport):
+
+        if transport == 'unix':
+            address = str(tmpdir.join('ic.sock'))
+        else:
+            address = ('127.0.0.1', 0)
+        listener = self.serve(ic_server, address)
+        if transport == 'http':
+            address = listener.server_address[:2]
+
+        try:
+            # Several clients at once.
+            replies = {}
+            def client(month):
+                replies[month] = server.request(address, self.job(tmpdir, month),
+                                                timeout=60)
+            clients = [threading.Thread(target=client, args=(m,))
+                       for m in [1, 2, 3]]
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+
+            for month in [1, 2, 3]:
+                reply = replies[month]
+                assert reply['status'] == 'ok'
+                assert reply['latency'] >= reply['run_time'] > 0
+                with nc.Dataset(reply['output_file']) as f:
+                    assert np.allclose(f.variables['temp'][:], month - 1)
+                    assert np.allclose(f.variables['salt'][:], 35.0)
+                    # Stamped, so --update finds nothing to do.
+                    job = self.job(tmpdir, month)
+                    fields = ic_server.fields(job['temp_file'],
+                                              job['salt_file'])
+                    plan = update.plan_update(f, self.parameters, fields,
+                                              month, 'none')
+                    assert [action for _, action, _ in plan] == [None, None]
+
+            stats = server.request(address, {'command': 'stats'})
+            assert stats['jobs_done'] == 3
+            assert stats['max_latency'] >= stats['mean_latency']
+
+            # Errors are replied to and don't stop the server.
+            reply = server.request(address, self.job(tmpdir, 1))
+            assert reply['status'] == 'error'
+            assert 'exists' in reply['error']
+            assert server.request(address, {'month': 1})['status'] == 'error'
+
+            # Two jobs can't make the same output.
+            job = self.job(tmpdir, 5)
+            ic_server.writing.add(os.path.realpath(job['output_file']))
+            reply = server.request(address, job)
+            assert reply['status'] == 'error'
+            assert 'another job' in reply['error']
+            ic_server.writing.clear()
+
+            job = self.job(tmpdir, 4)
+            job['temp_file'] = str(tmpdir.join('missing.nc'))
+            reply = server.request(address, job)
+            assert reply['status'] == 'error'
+            assert not os.path.exists(job['output_file'])
+            assert server.request(address, {'command': 'stats'})['jobs_failed'] == 1
+        finally:
+            listener.shutdown()
+            listener.server_close()
+
+
+@pytest.mark.parametrize('option', ['--update', '--profile', '--mpi',
+                                    '--report=report.json'])
+def test_serve_options(option, capsys):
+
+    argv = ['GODAS', 'hgrid', 'vgrid', 'MOM', 'hgrid', 'vgrid',
+            '--socket', 'ic.sock', option]
+    with pytest.raises(SystemExit):
+        makeic.serve_main(argv)
+    assert 'not supported by serve' in capsys.readouterr().err
@@ -0,0 +1,288 @@
+from __future__ import print_function
+
+import pytest
+import os
+import sys
+import csv
+import json
+import numpy as np
+import netCDF4 as nc
+
+import ic_stability_metric as ism
+
+def stability_index_by_column(density):
+    """
+    Column by column calculation of the stability index, as it was done
+    before calc_stability_index() was vectorized.
+    """
+
+    lats = density.shape[1]
+    lons = density.shape[2]
+    si_ret = np.zeros((lats, lons))
+
+    for lat in range(lats):
+        for lon in range(lons):
+            if hasattr(density, 'mask'):
+                column_mask = np.ma.getmaskarray(density[:, lat, lon])
+                lev = 0
+                for lev in range(len(column_mask)):
+                    if column_mask[lev]:
+                        break
+                if lev == 0:
+                    continue
+            else:
+                lev = density.shape[0]
+
+            si = np.count_nonzero(np.sort(density[:lev, lat, lon]) - density[:lev, lat, lon])
+            si_ret[lat, lon] = si / float(lev)
+
+    return si_ret
+
+def write_ic(filename, temp, salt, levels, nemo=False):
+
+    if nemo:
+        # The depth coordinate isn't named after its dimension.
+        temp_var, salt_var, z, depth = 'votemper', 'vosaline', 'z', 'deptht'
+    else:
+        temp_var, salt_var, z, depth = 'temp', 'salt', 'zt', 'zt'
+
+    with nc.Dataset(filename, 'w') as f:
+        f.createDimension('time', None)
+        f.createDimension(z, temp.shape[0])
+        f.createDimension('y', temp.shape[1])
+        f.createDimension('x', temp.shape[2])
+        f.createVariable(depth, 'f8', (z,))[:] = levels
+        t = f.createVariable(temp_var, 'f8', ('time', z, 'y', 'x'),
+                             fill_value=-1e20)
+        t.units = 'K'
+        t[0, :] = temp + 273.15
+        s = f.createVariable(salt_var, 'f8', ('time', z, 'y', 'x'),
+                             fill_value=-1e20)
+        s.units = 'kg/kg'
+        s[0, :] = salt / 1000.0
+
+class TestStabilityMetric():
+
+    @pytest.fixture
+    def fields(self):
+        np.random.seed(1)
+        levels = np.linspace(5.0, 5000.0, 20)
+        shape = (len(levels), 6, 8)
+
+        # Mostly stable: warm at the top with some noise.
+        temp = np.linspace(25.0, 2.0, len(levels))[:, np.newaxis, np.newaxis] + \
+                np.random.normal(0.0, 1.0, shape)
+        salt = 35.0 + np.random.normal(0.0, 0.2, shape)
+
+        # Land and bottom topography.
+        mask = np.zeros(shape, dtype=bool)
+        mask[:, 0, :] = True
+        mask[10:, 1, :] = True
+        mask[1:, 2, 3] = True
+
+        return np.ma.array(temp, mask=mask), np.ma.array(salt, mask=mask), levels
+
+    def test_matches_column_loop(self, fields):
+        temp, salt, levels = fields
+
+        density = ism.calc_density(temp, salt, levels)
+        expected = stability_index_by_column(density)
+        si = ism.calc_stability_index(temp, salt, levels)
+
+        assert np.any(si > 0)
+        assert np.array_equal(si, expected)
+
+    def test_chunked(self, fields):
+        temp, salt, levels = fields
+
+        expected = ism.calc_stability_index(temp, salt, levels)
+        for chunk_rows in [1, 4, 100]:
+            si = ism.calc_stability_index(temp, salt, levels, chunk_rows)
+            assert np.array_equal(si, expected)
+
+    def test_unmasked(self, fields):
+        temp, salt, levels = fields
+        temp = temp.filled(10.0)
+        salt = salt.filled(35.0)
+
+        density = ism.calc_density(temp, salt, levels)
+        expected = stability_index_by_column(density)
+        si = ism.calc_stability_index(temp, salt, levels)
+
+        assert np.array_equal(si, expected)
+
+    def test_main(self, fields, tmpdir, monkeypatch):
+        temp, salt, levels = fields
+
+        ic = str(tmpdir.join('ic.nc'))
+        write_ic(ic, temp, salt, levels)
+        monkeypatch.chdir(str(tmpdir))
+        monkeypatch.setattr(sys, 'argv', ['ic_stability_metric.py', ic, ic,
+                                          '--chunk_rows', '2'])
+        assert ism.main() == 0
+
+        expected = ism.calc_stability_index(temp, salt, levels)
+        with nc.Dataset(str(tmpdir.join('stability_index.nc'))) as f:
+            assert np.allclose(f.variables['stability'][:], expected)
+
+    def test_float32(self, fields, tmpdir, monkeypatch):
+        temp, salt, levels = fields
+
+        ic = str(tmpdir.join('ic.nc'))
+        write_ic(ic, temp, salt, levels)
+        monkeypatch.chdir(str(tmpdir))
+        monkeypatch.setattr(sys, 'argv', ['ic_stability_metric.py', ic, ic,
+                                          '--dtype', 'float32'])
+        assert ism.main() == 0
+
+        expected = ism.calc_stability_index(temp, salt, levels)
+        with nc.Dataset(str(tmpdir.join('stability_index.nc'))) as f:
+            si = f.variables['stability']
+            assert si.dtype == np.float32
+            # Density differences below float32 precision can reorder
+            # near neutral cells, no more than one cell per column here.
+            assert np.all(np.abs(si[:] - expected) <= 1.0/len(levels) + 1e-6)
+
+    def test_masked_gaussian_filter(self, fields):
+        temp, _, _ = fields
+
+        # Land values must not leak into the ocean.
+        land = np.ma.array(np.where(temp.mask, 1e20, temp.data),
+                           mask=temp.mask)
+        modes = ('reflect', 'reflect', 'wrap')
+        smoothed = ism.masked_gaussian_filter(land, (2, 3, 3), modes)
+
+        assert np.array_equal(smoothed.mask, temp.mask)
+        assert smoothed.min() >= temp.min() and smoothed.max() <= temp.max()
+
+        # A constant ocean stays constant.
+        const = np.ma.array(np.full(temp.shape, 4.0), mask=temp.mask)
+        smoothed = ism.masked_gaussian_filter(const, (2, 3, 3), modes)
+        assert np.allclose(smoothed.compressed(), 4.0)
+
+    def test_output_more_stable(self, fields, tmpdir, monkeypatch):
+        temp, salt, levels = fields
+        # Tall enough for several bands with halos.
+        temp = np.ma.concatenate([temp]*6, axis=1)
+        salt = np.ma.concatenate([salt]*6, axis=1)
+
+        ic = str(tmpdir.join('ic.nc'))
+        write_ic(ic, temp, salt, levels)
+        monkeypatch.chdir(str(tmpdir))
+        monkeypatch.setattr(sys, 'argv', ['ic_stability_metric.py', ic, ic,
+                                          '--output_more_stable',
+                                          '--chunk_rows', '5'])
+        assert ism.main() == 0
+
+        modes = ('reflect', 'reflect', 'wrap')
+        with nc.Dataset(ic) as f:
+            expected = ism.masked_gaussian_filter(f.variables['temp'][0, :],
+                                                  (2, 3, 3), modes)
+        with nc.Dataset(str(tmpdir.join('more_stable_ic.nc'))) as f:
+            assert f.variables['temp'].units == 'K'
+            assert 'salt' in f.variables and 'zt' in f.variables
+            out_temp = f.variables['temp'][0, :]
+            out_salt = f.variables['salt'][0, :]
+
+        assert np.array_equal(out_temp.mask, expected.mask)
+        assert np.allclose(out_temp, expected)
+
+        si = ism.calc_stability_index(out_temp - 273.15, out_salt*1000.0,
+                                      levels)
+        assert np.mean(si) < np.mean(ism.calc_stability_index(temp, salt,
+                                                              levels))
+
+    def test_repair_stability(self, fields):
+        temp, salt, levels = fields
+        # A column that is already stable must be left alone.
+        temp[:, 3, 4] = np.linspace(25.0, 2.0, len(levels))
+        salt[:, 3, 4] = 35.0
+
+        before = ism.calc_stability_index(temp, salt, levels)
+        t, s, report = ism.repair_stability(temp, salt, levels)
+
+        assert np.any(before > 0)
+        assert np.all(ism.calc_stability_index(t, s, levels) == 0)
+        assert report.columns_not_converged == 0
+        assert report.columns_changed == np.count_nonzero(before > 0)
+        assert report.max_temp_change > 0
+
+        assert np.array_equal(t.mask, temp.mask)
+        assert np.array_equal(t[:, 3, 4], temp[:, 3, 4])
+
+        # Mixing conserves the heat and salt content of each column.
+        dz = ism.layer_thickness(levels)[:, np.newaxis, np.newaxis]
+        assert np.ma.allclose((t*dz).sum(axis=0), (temp*dz).sum(axis=0))
+        assert np.ma.allclose((s*dz).sum(axis=0), (salt*dz).sum(axis=0))
+
+    def test_main_repair(self, fields, tmpdir, monkeypatch):
+        temp, salt, levels = fields
+
+        ic = str(tmpdir.join('ic.nc'))
+        write_ic(ic, temp, salt, levels)
+        monkeypatch.chdir(str(tmpdir))
+        monkeypatch.setattr(sys, 'argv', ['ic_stability_metric.py', ic, ic,
+                                          '--repair', '--chunk_rows', '4'])
+        assert ism.main() == 0
+
+        with nc.Dataset(str(tmpdir.join('stable_ic.nc'))) as f:
+            assert f.variables['temp'].units == 'K'
+            out_temp = f.variables['temp'][0, :] - 273.15
+            out_salt = f.variables['salt'][0, :]*1000.0
+
+        assert np.array_equal(out_temp.mask, temp.mask)
+        assert np.all(ism.calc_stability_index(out_temp, out_salt, levels) == 0)
+
+    def test_summarize(self):
+        si = np.zeros((3, 4))
+        si[1, 2] = 0.5
+        si[2, 0] = 0.25
+        ocean = np.ones(si.shape, dtype=bool)
+        ocean[0, :] = False
+
+        summary = ism.summarize(si, ocean, worst=3)
+        assert summary['worst_columns'] == [(1, 2, 0.5), (2, 0, 0.25)]
+        assert summary['unstable_fraction'] == 2 / 8.0
+        assert summary['mean'] == 0.75 / 12
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_batch(self, fields, tmpdir, workers):
+        temp, salt, levels = fields
+
+        for i, name in enumerate(['a/ic_01.nc', 'a/ic_02.nc', 'b/ic_03.nc']):
+            tmpdir.ensure(os.path.dirname(name), dir=True)
+            write_ic(str(tmpdir.join(name)), temp + i, salt, levels,
+                     nemo=(i == 2))
+        tmpdir.join('b/ic_04.nc').write('not netcdf')
+
+        summary = str(tmpdir.join('summary.json'))
+        argv = [str(tmpdir.join('a/ic_*.nc')), str(tmpdir.join('b/*.nc')),
+                '--workers', str(workers), '--summary', summary]
+        # The bad file fails on its own.
+        assert ism.batch_main(argv) == 1
+
+        with open(summary) as f:
+            summaries = json.load(f)
+        assert [os.path.basename(s['temp_ic']) for s in summaries] == \
+                ['ic_01.nc', 'ic_02.nc', 'ic_03.nc', 'ic_04.nc']
+        assert 'error' in summaries[3]
+        for i, s in enumerate(summaries[:3]):
+            expected = ism.calc_stability_index(temp + i, salt, levels)
+            with nc.Dataset(s['output_file']) as f:
+                assert np.allclose(f.variables['stability'][:], expected)
+            assert s['output_file'].endswith('_stability_index.nc')
+            assert s['mean'] == pytest.approx(expected.mean())
+            assert 0 < s['unstable_fraction'] < 1
+            assert s['worst_columns'][0][2] == expected.max()
+        assert summaries[2]['temp_var'] == 'votemper'
+
+        csv_file = str(tmpdir.join('summary.csv'))
+        argv = [str(tmpdir.join('a/*.nc')), '--summary', csv_file,
+                '--output_dir', str(tmpdir)]
+        assert ism.batch_main(argv) == 0
+        expected = ism.calc_stability_index(temp, salt, levels)
+        with open(csv_file) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 2
+        assert rows[0]['output_file'] == str(tmpdir.join('ic_01_stability_index.nc'))
+        assert float(rows[0]['mean']) == pytest.approx(expected.mean())
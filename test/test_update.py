@@ -0,0 +1,109 @@
+from __future__ import print_function
+
+import pytest
+import os
+import time
+import numpy as np
+import netCDF4 as nc
+
+from ocean_ic import grids, update
+from ocean_ic.pipeline import RegridPipeline, regrid_fields
+
+from test_pipeline import write_src_file
+
+class TestUpdate():
+
+    def make_pipeline(self, tmpdir, mask):
+        src_grid = grids.rectilinear_grid(np.arange(0.5, 360, 10.0),
+                                          np.arange(-85, 90, 10.0),
+                                          [5.0, 15.0, 30.0])
+        dest_grid = grids.rectilinear_grid(np.arange(0.25, 360, 7.5),
+                                           np.linspace(-60, 60, 17),
+                                           [5.0, 15.0, 30.0])
+        dest_grid.mask = mask
+        return RegridPipeline('ORAS4', src_grid, dest_grid,
+                              regrid_weights=str(tmpdir.join('weights.nc')))
+
+    @pytest.fixture
+    def ic(self, tmpdir):
+        mask = np.zeros((17, 48), dtype=bool)
+        mask[:2, :] = True
+        pipeline = self.make_pipeline(tmpdir, mask)
+
+        shape = (12,) + pipeline.src_grid.shape
+        write_src_file(str(tmpdir.join('temp.nc')), 'thetao',
+                       np.random.random(shape)*30.0 + 273.15, 'K')
+        write_src_file(str(tmpdir.join('salt.nc')), 'so',
+                       np.random.random(shape)*5.0 + 32.0, 'psu')
+
+        fields = [(str(tmpdir.join('temp.nc')), 'thetao', 'temp'),
+                  (str(tmpdir.join('salt.nc')), 'so', 'salt')]
+        output = str(tmpdir.join('ic.nc'))
+        parameters = {'method': 'bilinear',
+                      'grids': update.grids_key(pipeline.src_grid,
+                                                pipeline.dest_grid)}
+        regrid_fields(pipeline, fields, output, 'MOM', month=3)
+        update.stamp_ic(output, parameters, fields, 3, 'mask1')
+
+        return pipeline, fields, output, parameters
+
+    def update(self, pipeline, fields, output, parameters, mask='mask1'):
+        return update.update_ic(pipeline, fields, output, 'MOM', parameters,
+                                mask, month=3)
+
+    def fresh(self, pipeline, fields, tmpdir):
+        output = str(tmpdir.join('fresh.nc'))
+        if os.path.exists(output):
+            os.remove(output)
+        regrid_fields(pipeline, fields, output, 'MOM', month=3)
+        with nc.Dataset(output) as f:
+            return dict((v, f.variables[v][:]) for _, _, v in fields)
+
+    def assert_same(self, output, expected):
+        with nc.Dataset(output) as f:
+            for var, data in expected.items():
+                result = f.variables[var][:]
+                assert np.array_equal(result.mask, data.mask)
+                assert np.ma.allclose(result, data)
+
+    def test_up_to_date(self, ic):
+        pipeline, fields, output, parameters = ic
+        assert self.update(pipeline, fields, output, parameters) == []
+
+        # Other parameters or grids mean the IC has to be remade.
+        other = dict(parameters, method='conserve')
+        assert self.update(pipeline, fields, output, other) is None
+
+    def test_mask_edit(self, ic, tmpdir):
+        pipeline, fields, output, parameters = ic
+
+        # Open a strait and close a bay.
+        mask = pipeline.dest_grid.mask.copy()
+        mask[1, 10:13] = False
+        mask[8, 20] = True
+        edited = self.make_pipeline(tmpdir, mask)
+
+        with nc.Dataset(output) as f:
+            cells = update.changed_cells(f.variables['temp'],
+                                         edited.dest_mask)
+        assert all(len(c) == 4 for c in cells)
+
+        done = self.update(edited, fields, output, parameters, 'mask2')
+        assert done == [('temp', 'mask'), ('salt', 'mask')]
+        self.assert_same(output, self.fresh(edited, fields, tmpdir))
+        assert self.update(edited, fields, output, parameters, 'mask2') == []
+
+    def test_changed_and_new_variables(self, ic, tmpdir):
+        pipeline, fields, output, parameters = ic
+
+        shape = (12,) + pipeline.src_grid.shape
+        write_src_file(str(tmpdir.join('temp.nc')), 'thetao',
+                       np.random.random(shape)*30.0 + 273.15, 'K')
+        # Files are recognised by modification time, make sure it moves.
+        later = time.time() + 10
+        os.utime(str(tmpdir.join('temp.nc')), (later, later))
+        fields = fields + [(str(tmpdir.join('salt.nc')), 'so', 'asalt')]
+
+        done = self.update(pipeline, fields, output, parameters)
+        assert done == [('temp', 'all'), ('asalt', 'all')]
+        self.assert_same(output, self.fresh(pipeline, fields, tmpdir))